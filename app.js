@@ -21,6 +21,8 @@ let duplicateAccounts = [];
 let authorizedEmails = []; // 已授权邮箱列表
 let pendingEmails = []; // 待授权邮箱列表（从账号辅助邮箱收集）
 let verificationCodes = []; // 验证码列表（最近5条）
+let pendingRecheckTimer = null; // 有邮箱仍在拉取时的补查定时器
+let codesCursor = null; // /emails/refresh 返回的游标，下次只取之后的新验证码
 let selectedProvider = 'gmail'; // 当前选择的邮箱类型
 let pushSettings = JSON.parse(localStorage.getItem('pushSettings') || '{"notify":true,"toast":true}');
 let codeToastTimer = null; // 验证码弹窗定时器
@@ -2950,6 +2952,7 @@ async function show2FAPopup(accountId) {
             });
         }
         
+        openTOTPStream(accountId);
         totpIntervals[accountId] = setInterval(() => updateTOTPDisplayFromBackend(accountId, data), 1000);
     } catch { 
         close2FAPopup(accountId);
@@ -2957,21 +2960,76 @@ async function show2FAPopup(accountId) {
     }
 }
 
+// 一次向后端取的后续验证码窗口数（当前窗口 + N 个）
+const TOTP_PREFETCH_WINDOWS = 3;
+let totpWindowCache = {};
+
+async function fetchTOTPWindows(accountId) {
+    // 只在本地窗口用完时请求，no-cache 保证拿到新的 server_time 用于时钟校准
+    const res = await apiRequest(`/accounts/${accountId}/totp/generate?windows=${TOTP_PREFETCH_WINDOWS}`, { cache: 'no-cache' });
+    if (!res.ok) return null;
+    const data = await res.json();
+    data.skew = Date.now() / 1000 - data.server_time;
+    totpWindowCache[accountId] = data;
+    return data;
+}
+
+// SSE 推送：服务端在周期边界推送新验证码，不可用时回退为按窗口拉取
+let totpStreams = {};
+
+async function openTOTPStream(accountId) {
+    if (typeof EventSource === 'undefined' || totpStreams[accountId]) return;
+    // 令牌不放进 URL，先换取一次性票据；占位防止并发重复打开，等待期间弹窗关闭则放弃
+    const pending = { closed: false, close() { this.closed = true; } };
+    totpStreams[accountId] = pending;
+    let ticket;
+    try {
+        const res = await apiRequest('/totp/stream-ticket', { method: 'POST' });
+        if (!res.ok) throw new Error();
+        ticket = (await res.json()).ticket;
+    } catch (e) {
+        if (totpStreams[accountId] === pending) delete totpStreams[accountId];
+        return;
+    }
+    if (pending.closed) return;
+    const es = new EventSource(`${API}/totp/stream?ids=${accountId}&ticket=${encodeURIComponent(ticket)}`);
+    es.addEventListener('code', e => {
+        const d = JSON.parse(e.data);
+        totpWindowCache[accountId] = {
+            type: d.type, period: d.period, skew: Date.now() / 1000 - d.server_time,
+            codes: [{ code: d.code, valid_from: d.valid_from, valid_until: d.valid_until }]
+        };
+    });
+    es.addEventListener('error', () => { es.close(); delete totpStreams[accountId]; });
+    totpStreams[accountId] = es;
+}
+
 async function updateTOTPDisplayFromBackend(accountId, configData) {
     const codeEl = document.getElementById(`totp-code-${accountId}`);
     const progressEl = document.getElementById(`totp-progress-${accountId}`);
     const remainingEl = document.getElementById(`totp-remaining-${accountId}`);
-    if (!codeEl) { clearInterval(totpIntervals[accountId]); return; }
+    if (!codeEl) { close2FAPopup(accountId); return; }
     
     try {
-        // 从后端获取验证码
-        const res = await apiRequest(`/accounts/${accountId}/totp/generate`);
-        if (!res.ok) return;
-        const data = await res.json();
+        // 本地按窗口边界倒计时，窗口用完才从后端拉取下一批验证码
+        const findWindow = (cached) => {
+            if (!cached || !cached.codes) return null;
+            const serverNow = Date.now() / 1000 - cached.skew;
+            return cached.codes.find(w => serverNow >= w.valid_from && serverNow < w.valid_until) || null;
+        };
+        let data = totpWindowCache[accountId];
+        let win = findWindow(data);
+        if (!win) {
+            // 推送连接正常时，边界后稍等下一条推送，避免重复请求
+            if (totpStreams[accountId] && data && Date.now() / 1000 - data.skew < data.codes[data.codes.length - 1].valid_until + 3) return;
+            data = await fetchTOTPWindows(accountId);
+            win = findWindow(data);
+            if (!win) return;
+        }
         
-        const code = data.code;
-        const remaining = data.remaining;
+        const code = win.code;
         const period = data.period || 30;
+        const remaining = Math.max(1, Math.ceil(win.valid_until - (Date.now() / 1000 - data.skew)));
         const progress = (remaining / period) * 100;
         
         // 显示验证码（Steam 5位字母，标准TOTP分隔显示）
@@ -3038,6 +3096,8 @@ function copyTOTPCode(accountId) {
 function close2FAPopup(accountId) {
     document.getElementById(`totp-popup-${accountId}`)?.remove();
     if (totpIntervals[accountId]) { clearInterval(totpIntervals[accountId]); delete totpIntervals[accountId]; }
+    delete totpWindowCache[accountId];
+    if (totpStreams[accountId]) { totpStreams[accountId].close(); delete totpStreams[accountId]; }
 }
 
 // ==================== v5.0 新增：二维码扫描 + 2FA 配置模态框 ====================
@@ -4485,10 +4545,15 @@ async function checkNewEmails() {
     try {
         const res = await apiRequest('/emails/refresh', { 
             method: 'POST',
-            body: JSON.stringify({})
+            body: JSON.stringify(codesCursor === null ? {} : { after_id: codesCursor })
         });
         if (res.ok) {
             const data = await res.json();
+            if (data.cursor !== undefined) codesCursor = data.cursor;
+            // 服务端只等很短时间，还在拉取的邮箱稍后补查一次，不必等到下个轮询周期
+            if (data.pending && data.pending.length > 0 && !pendingRecheckTimer) {
+                pendingRecheckTimer = setTimeout(() => { pendingRecheckTimer = null; checkNewEmails(); }, 3000);
+            }
             if (data.new_codes && data.new_codes.length > 0) {
                 const now = new Date();
                 // 过滤掉已过期的验证码
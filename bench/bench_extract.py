@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+验证码提取基准测试
+
+用 code_corpus.jsonl 中标注好的邮件衡量 extract_verification_code 的准确率和吞吐量，
+并与改造前的逐条 re.search 版本对比。
+
+用法: python bench/bench_extract.py [--rounds 200]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+# main 导入时会初始化数据目录和密钥，放到临时目录，避免碰到真实数据
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="accbox-bench-"))
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from main import extract_verification_code  # noqa: E402
+
+LEGACY_PATTERNS = [
+    (r'(?:Google|谷歌).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Google'),
+    (r'Email verification code[：:\s]*(\d{4,6})', 'Google'),
+    (r'(?:Microsoft|微软).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Microsoft'),
+    (r'(?:Apple|苹果).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Apple'),
+    (r'(?:Amazon|亚马逊).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Amazon'),
+    (r'(?:Facebook|脸书|Meta).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Facebook'),
+    (r'(?:Twitter|推特|X).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Twitter'),
+    (r'(?:LinkedIn).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'LinkedIn'),
+    (r'(?:GitHub).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'GitHub'),
+    (r'(?:Discord).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Discord'),
+    (r'(?:Telegram).*?(?:code|验证码)[：:\s]*(\d{5,6})', 'Telegram'),
+    (r'(?:WhatsApp).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'WhatsApp'),
+    (r'(?:支付宝|Alipay).*?(?:code|验证码)[：:\s]*(\d{4,6})', '支付宝'),
+    (r'(?:微信|WeChat).*?(?:code|验证码)[：:\s]*(\d{4,6})', '微信'),
+    (r'(?:淘宝|Taobao).*?(?:code|验证码)[：:\s]*(\d{4,6})', '淘宝'),
+    (r'(?:京东|JD).*?(?:code|验证码)[：:\s]*(\d{4,6})', '京东'),
+    (r'(?:Steam).*?(?:code|验证码)[：:\s]*(\d{5})', 'Steam'),
+    (r'(\d{4,6})\s*(?:是你的|为你的|is your)', 'unknown'),
+    (r'(?:verification code|验证码)[：:\s]*(\d{4,6})', 'unknown'),
+    (r'(?:code|码)[：:\s]+(\d{4,6})\b', 'unknown'),
+]
+
+
+def legacy_extract(text, sender=''):
+    """改造前的实现，仅作对照"""
+    for pattern, service in LEGACY_PATTERNS:
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match:
+            return match.group(1), service
+    match = re.search(r'(?<![0-9])(\d{6})(?![0-9])', text)
+    if match:
+        code = match.group(1)
+        if not code.startswith('20') and not code.startswith('19'):
+            return code, 'unknown'
+    return None, None
+
+
+def load_corpus():
+    with open(BENCH_DIR / "code_corpus.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def accuracy(extract, corpus, verbose=False):
+    code_ok = service_ok = 0
+    for sample in corpus:
+        code, service = extract(sample["body"], sample["from"])
+        if code == sample["code"]:
+            code_ok += 1
+        elif verbose:
+            print(f"  ✗ {sample['from']}: 期望 {sample['code']}，得到 {code}")
+        if code == sample["code"] and service == sample["service"]:
+            service_ok += 1
+    return code_ok, service_ok
+
+
+def throughput(extract, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for sample in corpus:
+            extract(sample["body"], sample["from"])
+    elapsed = time.perf_counter() - start
+    return rounds * len(corpus) / elapsed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="验证码提取基准测试")
+    parser.add_argument("--rounds", type=int, default=200, help="吞吐量测试的轮数")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    total = len(corpus)
+    print(f"语料: {total} 封邮件，{sum(1 for s in corpus if s['code'])} 封含验证码")
+
+    for name, extract, rounds in (("当前", extract_verification_code, args.rounds),
+                                  ("旧版", legacy_extract, max(1, args.rounds // 20))):
+        code_ok, service_ok = accuracy(extract, corpus, verbose=(extract is extract_verification_code))
+        rate, elapsed = throughput(extract, corpus, rounds)
+        print(f"[{name}] 验证码准确率 {code_ok}/{total} ({code_ok / total:.1%})，"
+              f"验证码+服务准确率 {service_ok}/{total} ({service_ok / total:.1%})，"
+              f"吞吐量 {rate:,.0f} 封/秒（{rounds} 轮，{elapsed:.2f}s）")
+
+
+if __name__ == "__main__":
+    main()
@@ -57,6 +57,8 @@ check_dependencies()
 import os
 import json
 import sqlite3
+import asyncio
+import io
 import hashlib  # 保留用于兼容旧密码
 import secrets
 import base64
@@ -67,12 +69,17 @@ import hmac
 import struct
 import urllib.parse
 from datetime import datetime, timedelta, timezone
+from email.utils import parseaddr
 from contextlib import contextmanager
 from pathlib import Path
 import threading
+import queue
+import socket
+import imaplib
 from fastapi import FastAPI, HTTPException, Depends, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 from cryptography.fernet import Fernet
@@ -155,7 +162,7 @@ app.add_middleware(
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_headers=["Authorization", "Content-Type", "Idempotency-Key"],
 )
 
 # ==================== 加密模块 ====================
@@ -192,6 +199,71 @@ def decrypt_password(encrypted: str) -> str:
     except:
         return encrypted
 
+# ==================== 批量加解密 (大批量导入导出) ====================
+# CRYPTO_POOL: thread(默认) / process
+#   process 用 fork 创建工作进程：服务运行后已有轮询、任务、备份等线程，fork 可能继承被占用的锁而卡死，
+#   只建议在确认过收益的环境中开启；spawn/forkserver 会在子进程重新执行 main.py 的启动逻辑，不能使用
+# CRYPTO_WORKERS: 工作进程/线程数，默认 CPU 核数，<=1 时始终串行
+# CRYPTO_PARALLEL_THRESHOLD: 超过此数量才并行，小批量串行更快
+CRYPTO_POOL_KIND = os.environ.get("CRYPTO_POOL", "thread").lower()
+CRYPTO_WORKERS = int(os.environ.get("CRYPTO_WORKERS", "0") or 0) or (os.cpu_count() or 1)
+CRYPTO_PARALLEL_THRESHOLD = int(os.environ.get("CRYPTO_PARALLEL_THRESHOLD", "5000"))
+CRYPTO_CHUNK = 1000  # 每个任务处理的条数
+
+crypto_pool = None
+crypto_pool_lock = threading.Lock()
+
+def init_crypto_worker(key: bytes):
+    """工作进程初始化：使用与主进程相同的密钥"""
+    global cipher
+    cipher = Fernet(key)
+
+def encrypt_chunk(values: list) -> list:
+    return [encrypt_password(v) for v in values]
+
+def decrypt_chunk(values: list) -> list:
+    return [decrypt_password(v) for v in values]
+
+def get_crypto_pool():
+    global crypto_pool
+    with crypto_pool_lock:
+        if crypto_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+            if CRYPTO_POOL_KIND != "process":
+                crypto_pool = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto")
+            else:
+                # fork 避免子进程重新执行本模块的启动逻辑（定时备份线程等）
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("fork" if "fork" in methods else None)
+                crypto_pool = ProcessPoolExecutor(max_workers=CRYPTO_WORKERS, mp_context=context,
+                                                  initializer=init_crypto_worker, initargs=(ENCRYPTION_KEY,))
+        return crypto_pool
+
+def run_crypto_batch(func, values: list) -> list:
+    """按块分发到工作池并保持原顺序；数量较少或并行失败时串行执行"""
+    if len(values) < CRYPTO_PARALLEL_THRESHOLD or CRYPTO_WORKERS <= 1:
+        return func(values)
+    global crypto_pool
+    chunks = [values[i:i + CRYPTO_CHUNK] for i in range(0, len(values), CRYPTO_CHUNK)]
+    try:
+        return [v for chunk in get_crypto_pool().map(func, chunks) for v in chunk]
+    except Exception as e:
+        print(f"并行加解密失败，改为串行: {e}")
+        with crypto_pool_lock:
+            broken, crypto_pool = crypto_pool, None
+        if broken is not None:
+            broken.shutdown(wait=False)  # 回收残留的工作进程/线程，下次用时重建
+        return func(values)
+
+def encrypt_many(values: list) -> list:
+    """批量加密，结果顺序与输入一致"""
+    return run_crypto_batch(encrypt_chunk, values)
+
+def decrypt_many(values: list) -> list:
+    """批量解密，结果顺序与输入一致"""
+    return run_crypto_batch(decrypt_chunk, values)
+
 # ==================== 密码哈希 (bcrypt + 兼容旧SHA256) ====================
 
 def hash_password(password: str) -> str:
@@ -355,6 +427,11 @@ class TOTPCreate(BaseModel):
     period: int = 30
     backup_codes: List[str] = []
 
+class TOTPImport(BaseModel):
+    uris: List[str]  # otpauth:// 或 otpauth-migration:// (Google 身份验证器导出)
+    overwrite: bool = False  # 是否覆盖已配置 2FA 的账号
+    dry_run: bool = False  # 仅预览匹配结果，不写入
+
 # ==================== 数据库 ====================
 
 @contextmanager
@@ -466,6 +543,10 @@ def init_user_tables(user_id: int):
             )
         """)
         
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_user_{user_id}_accounts_email ON user_{user_id}_accounts(email)")
+        ensure_change_tracking(conn, user_id)
+        ensure_import_tracking(conn, user_id)
+        
         # 邮箱授权表
         conn.execute(f"""
             CREATE TABLE IF NOT EXISTS user_{user_id}_emails (
@@ -505,6 +586,8 @@ def init_user_tables(user_id: int):
             conn.execute(f"ALTER TABLE user_{user_id}_verification_codes ADD COLUMN source_msg_id TEXT DEFAULT ''")
         except:
             pass
+        ensure_mailbox_state(conn, user_id)
+        ensure_code_constraints(conn, user_id)
         
         # 初始化默认数据
         cursor = conn.execute(f"SELECT COUNT(*) FROM user_{user_id}_account_types")
@@ -575,6 +658,157 @@ def migrate_add_2fa_columns():
                     pass
         conn.commit()
 
+def ensure_change_tracking(conn, user_id: int):
+    """
+    增量导出所需：账号 updated_at 索引和已删除账号记录表
+    旧记录的 updated_at 是 CURRENT_TIMESTAMP 格式（YYYY-MM-DD HH:MM:SS），与现在写入的 ISO 格式按字符串比较会错位，
+    统一改写为 ISO 格式，since 过滤仍可直接比较字符串并使用索引
+    """
+    conn.execute(f"""
+        UPDATE user_{user_id}_accounts SET updated_at = strftime('%Y-%m-%dT%H:%M:%SZ', updated_at)
+        WHERE updated_at NOT LIKE '%T%' AND strftime('%Y-%m-%dT%H:%M:%SZ', updated_at) IS NOT NULL
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_user_{user_id}_accounts_updated ON user_{user_id}_accounts(updated_at)")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS user_{user_id}_deleted_accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_id INTEGER,
+            email TEXT NOT NULL,
+            deleted_at TEXT NOT NULL
+        )
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_user_{user_id}_deleted_accounts_at ON user_{user_id}_deleted_accounts(deleted_at)")
+
+def ensure_import_tracking(conn, user_id: int):
+    """幂等导入所需：账号 import_hash 列和导入记录表"""
+    try:
+        conn.execute(f"ALTER TABLE user_{user_id}_accounts ADD COLUMN import_hash TEXT DEFAULT ''")
+    except sqlite3.OperationalError:
+        pass
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS user_{user_id}_import_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT,
+            content_hash TEXT NOT NULL,
+            result TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_user_{user_id}_import_log_key ON user_{user_id}_import_log(idempotency_key)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_user_{user_id}_import_log_hash ON user_{user_id}_import_log(content_hash)")
+
+def migrate_add_import_tracking():
+    """迁移：为已有用户添加幂等导入所需的列和表"""
+    with get_db() as conn:
+        for user in conn.execute("SELECT id FROM users").fetchall():
+            try:
+                ensure_import_tracking(conn, user["id"])
+            except sqlite3.OperationalError:
+                pass
+        conn.commit()
+
+def ensure_mailbox_state(conn, user_id: int):
+    """
+    邮箱增量同步状态表：IMAP 的 UIDVALIDITY 和已处理的最大 UID，Gmail 的 historyId，Outlook 的 deltaLink
+    以及已处理邮件台账，记录处理过的邮件 ID，保证每封邮件只下载和解析一次
+    """
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS user_{user_id}_mailbox_state (
+            email_id INTEGER PRIMARY KEY,
+            uidvalidity INTEGER,
+            last_uid INTEGER DEFAULT 0,
+            history_id TEXT,
+            delta_link TEXT,
+            updated_at TEXT
+        )
+    """)
+    for column in ("history_id", "delta_link"):
+        try:
+            conn.execute(f"ALTER TABLE user_{user_id}_mailbox_state ADD COLUMN {column} TEXT")
+        except sqlite3.OperationalError:
+            pass
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS user_{user_id}_seen_messages (
+            email_id INTEGER NOT NULL,
+            msg_id TEXT NOT NULL,
+            seen_at REAL NOT NULL,
+            PRIMARY KEY (email_id, msg_id)
+        ) WITHOUT ROWID
+    """)
+
+def migrate_add_mailbox_state():
+    """迁移：为已有用户添加邮箱增量同步状态表和已处理邮件台账"""
+    with get_db() as conn:
+        for user in conn.execute("SELECT id FROM users").fetchall():
+            try:
+                ensure_mailbox_state(conn, user["id"])
+            except sqlite3.OperationalError:
+                pass
+        conn.commit()
+
+CODE_DEDUPE_WINDOW = 300  # 没有邮件 ID 的记录，同一邮箱同一验证码在同一个 5 分钟时间段内只保存一次
+
+def ensure_code_constraints(conn, user_id: int):
+    """
+    验证码去重约束：同一邮箱的同一封邮件只保存一次；没有邮件 ID 的记录，同一验证码在同一时间段内只保存一次
+    （不同邮件碰巧带同一个验证码时各自保留）
+    建唯一索引前先清掉已有的重复记录（保留最早的一条）
+    """
+    table = f"user_{user_id}_verification_codes"
+    try:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN dedupe_bucket INTEGER")
+    except sqlite3.OperationalError:
+        pass
+    existing = {row[0]: row[1] or "" for row in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (table,)).fetchall()}
+    
+    # 早期版本的时间段索引覆盖全部记录，会把不同邮件里的相同验证码当成重复，重建为只约束无邮件 ID 的记录
+    if f"idx_{table}_bucket" in existing and "WHERE" not in existing[f"idx_{table}_bucket"].upper():
+        conn.execute(f"DROP INDEX idx_{table}_bucket")
+        del existing[f"idx_{table}_bucket"]
+    
+    if f"idx_{table}_msg" not in existing:
+        conn.execute(f"""
+            DELETE FROM {table} WHERE source_msg_id != '' AND id NOT IN (
+                SELECT MIN(id) FROM {table} WHERE source_msg_id != '' GROUP BY email, source_msg_id
+            )
+        """)
+        conn.execute(f"CREATE UNIQUE INDEX idx_{table}_msg ON {table}(email, source_msg_id) WHERE source_msg_id != ''")
+    
+    if f"idx_{table}_bucket" not in existing:
+        conn.execute(f"""
+            UPDATE {table} SET dedupe_bucket = CAST(strftime('%s', created_at) AS INTEGER) / {CODE_DEDUPE_WINDOW}
+            WHERE dedupe_bucket IS NULL
+        """)
+        conn.execute(f"""
+            DELETE FROM {table} WHERE source_msg_id = '' AND dedupe_bucket IS NOT NULL AND id NOT IN (
+                SELECT MIN(id) FROM {table} WHERE source_msg_id = '' AND dedupe_bucket IS NOT NULL
+                GROUP BY email, code, dedupe_bucket
+            )
+        """)
+        conn.execute(f"CREATE UNIQUE INDEX idx_{table}_bucket ON {table}(email, code, dedupe_bucket) "
+                     f"WHERE source_msg_id = ''")
+
+def migrate_add_code_constraints():
+    """迁移：为已有用户的验证码表去重并添加唯一约束"""
+    with get_db() as conn:
+        for user in conn.execute("SELECT id FROM users").fetchall():
+            try:
+                ensure_code_constraints(conn, user["id"])
+            except sqlite3.OperationalError:
+                pass
+        conn.commit()
+
+def migrate_add_change_tracking():
+    """迁移：为已有用户添加增量导出所需的索引和删除记录表"""
+    with get_db() as conn:
+        for user in conn.execute("SELECT id FROM users").fetchall():
+            try:
+                ensure_change_tracking(conn, user["id"])
+            except sqlite3.OperationalError:
+                pass
+        conn.commit()
+
 # ==================== 工具函数 ====================
 
 def migrate_add_hidden_column():
@@ -613,6 +847,33 @@ def get_current_user(authorization: str = Header(None)):
         raise HTTPException(status_code=401, detail="无效令牌或已过期")
     return {"id": user["id"], "username": user["username"]}
 
+# SSE 票据：EventSource 无法设置请求头，令牌又不能放进 URL（会进入代理和访问日志），
+# 先用令牌换一张短期一次性票据，再以 ?ticket= 建立连接
+STREAM_TICKET_TTL = 30
+stream_tickets: Dict[str, tuple] = {}  # ticket -> (过期时间, 用户)
+stream_tickets_lock = threading.Lock()
+
+def issue_stream_ticket(user: dict) -> str:
+    ticket = secrets.token_urlsafe(32)
+    now = time.time()
+    with stream_tickets_lock:
+        # 顺带清理过期未使用的票据
+        for key in [k for k, (expires, _) in stream_tickets.items() if expires <= now]:
+            del stream_tickets[key]
+        stream_tickets[ticket] = (now + STREAM_TICKET_TTL, {"id": user["id"], "username": user["username"]})
+    return ticket
+
+def get_stream_user(authorization: str = Header(None), ticket: Optional[str] = None):
+    """SSE 认证：优先使用请求头令牌，否则校验并消费一次性票据"""
+    if authorization:
+        return get_current_user(authorization)
+    if ticket:
+        with stream_tickets_lock:
+            entry = stream_tickets.pop(ticket, None)
+        if entry and entry[0] > time.time():
+            return entry[1]
+    raise HTTPException(status_code=401, detail="未授权")
+
 # ==================== 用户 API ====================
 
 @app.post("/api/register")
@@ -784,8 +1045,9 @@ def update_account_type(type_id: int, data: AccountTypeUpdate, user: dict = Depe
 
 @app.delete("/api/account-types/{type_id}")
 def delete_account_type(type_id: int, user: dict = Depends(get_current_user)):
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     with get_db() as conn:
-        conn.execute(f"UPDATE user_{user['id']}_accounts SET type_id = NULL WHERE type_id = ?", (type_id,))
+        conn.execute(f"UPDATE user_{user['id']}_accounts SET type_id = NULL, updated_at = ? WHERE type_id = ?", (now, type_id))
         conn.execute(f"DELETE FROM user_{user['id']}_account_types WHERE id = ?", (type_id,))
         conn.commit()
     return {"message": "删除成功"}
@@ -822,6 +1084,7 @@ def update_property_group(group_id: int, data: PropertyGroupUpdate, user: dict =
 
 @app.delete("/api/property-groups/{group_id}")
 def delete_property_group(group_id: int, user: dict = Depends(get_current_user)):
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     with get_db() as conn:
         # 先获取该属性组下所有属性值的ID
         cursor = conn.execute(f"SELECT id FROM user_{user['id']}_property_values WHERE group_id = ?", (group_id,))
@@ -843,8 +1106,9 @@ def delete_property_group(group_id: int, user: dict = Depends(get_current_user))
                             filtered = [vid for vid in combo if vid not in value_ids]
                             if filtered:  # 只保留非空的combo
                                 new_combos.append(filtered)
-                    conn.execute(f"UPDATE user_{user['id']}_accounts SET combos = ? WHERE id = ?",
-                                (json.dumps(new_combos), row['id']))
+                    if new_combos != combos:
+                        conn.execute(f"UPDATE user_{user['id']}_accounts SET combos = ?, updated_at = ? WHERE id = ?",
+                                    (json.dumps(new_combos), now, row['id']))
                 except:
                     pass
         
@@ -898,6 +1162,7 @@ def update_property_value(value_id: int, data: PropertyValueUpdate, user: dict =
 
 @app.delete("/api/property-values/{value_id}")
 def delete_property_value(value_id: int, user: dict = Depends(get_current_user)):
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     with get_db() as conn:
         # 删除属性值
         conn.execute(f"DELETE FROM user_{user['id']}_property_values WHERE id = ?", (value_id,))
@@ -913,8 +1178,9 @@ def delete_property_value(value_id: int, user: dict = Depends(get_current_user))
                         filtered = [vid for vid in combo if vid != value_id]
                         if filtered:  # 只保留非空的combo
                             new_combos.append(filtered)
-                conn.execute(f"UPDATE user_{user['id']}_accounts SET combos = ? WHERE id = ?",
-                            (json.dumps(new_combos), row['id']))
+                if new_combos != combos:
+                    conn.execute(f"UPDATE user_{user['id']}_accounts SET combos = ?, updated_at = ? WHERE id = ?",
+                                (json.dumps(new_combos), now, row['id']))
             except:
                 pass
         
@@ -926,6 +1192,7 @@ def delete_property_value(value_id: int, user: dict = Depends(get_current_user))
 @app.post("/api/cleanup-invalid-combos")
 def cleanup_invalid_combos(user: dict = Depends(get_current_user)):
     """清理所有账号中引用已删除属性值的combo"""
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     with get_db() as conn:
         # 获取所有有效的属性值ID
         cursor = conn.execute(f"SELECT id FROM user_{user['id']}_property_values")
@@ -934,8 +1201,11 @@ def cleanup_invalid_combos(user: dict = Depends(get_current_user)):
         # 遍历所有账号，清理无效引用
         cursor = conn.execute(f"SELECT id, combos FROM user_{user['id']}_accounts")
         cleaned_count = 0
+        rows = cursor.fetchall()
         
-        for row in cursor.fetchall():
+        for i, row in enumerate(rows):
+            if i % 1000 == 0:
+                job_checkpoint(i, len(rows))  # 后台任务中汇报进度，取消时整体回滚
             try:
                 combos = json.loads(row['combos'] or '[]')
                 new_combos = []
@@ -952,8 +1222,8 @@ def cleanup_invalid_combos(user: dict = Depends(get_current_user)):
                             changed = True
                 
                 if changed:
-                    conn.execute(f"UPDATE user_{user['id']}_accounts SET combos = ? WHERE id = ?",
-                                (json.dumps(new_combos), row['id']))
+                    conn.execute(f"UPDATE user_{user['id']}_accounts SET combos = ?, updated_at = ? WHERE id = ?",
+                                (json.dumps(new_combos), now, row['id']))
                     cleaned_count += 1
             except:
                 pass
@@ -1066,6 +1336,11 @@ def update_account(account_id: int, data: AccountUpdate, user: dict = Depends(ge
     values.append(account_id)
     
     with get_db() as conn:
+        if data.email is not None:
+            # 邮箱变更后旧邮箱在增量导出中视为已删除
+            old = conn.execute(f"SELECT id, email FROM user_{user['id']}_accounts WHERE id = ?", (account_id,)).fetchone()
+            if old and old["email"] != data.email:
+                record_deleted_accounts(conn, user['id'], [old], now)
         cursor = conn.execute(f"UPDATE user_{user['id']}_accounts SET {', '.join(updates)} WHERE id = ?", values)
         conn.commit()
         if cursor.rowcount == 0:
@@ -1088,17 +1363,23 @@ def toggle_favorite(account_id: int, user: dict = Depends(get_current_user)):
         if not row:
             raise HTTPException(status_code=404, detail="账号不存在")
         new_value = 0 if row["is_favorite"] else 1
-        conn.execute(f"UPDATE user_{user['id']}_accounts SET is_favorite = ? WHERE id = ?", (new_value, account_id))
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        conn.execute(f"UPDATE user_{user['id']}_accounts SET is_favorite = ?, updated_at = ? WHERE id = ?",
+                     (new_value, now, account_id))
         conn.commit()
     return {"message": "已更新", "is_favorite": bool(new_value)}
 
 @app.delete("/api/accounts/{account_id}")
 def delete_account(account_id: int, user: dict = Depends(get_current_user)):
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     with get_db() as conn:
+        rows = conn.execute(f"SELECT id, email FROM user_{user['id']}_accounts WHERE id = ?", (account_id,)).fetchall()
+        record_deleted_accounts(conn, user['id'], rows, now)
         cursor = conn.execute(f"DELETE FROM user_{user['id']}_accounts WHERE id = ?", (account_id,))
         conn.commit()
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="账号不存在")
+    invalidate_totp_cache(user['id'], [account_id])
     return {"message": "删除成功"}
 
 @app.post("/api/accounts/batch-delete")
@@ -1107,419 +1388,1423 @@ def batch_delete_accounts(data: dict, user: dict = Depends(get_current_user)):
     if not ids:
         raise HTTPException(status_code=400, detail="没有选择账号")
     
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     with get_db() as conn:
         placeholders = ",".join("?" * len(ids))
+        rows = conn.execute(f"SELECT id, email FROM user_{user['id']}_accounts WHERE id IN ({placeholders})", ids).fetchall()
+        record_deleted_accounts(conn, user['id'], rows, now)
         cursor = conn.execute(f"DELETE FROM user_{user['id']}_accounts WHERE id IN ({placeholders})", ids)
         conn.commit()
+    invalidate_totp_cache(user['id'], ids)
     
     return {"message": f"成功删除 {cursor.rowcount} 个账号", "deleted": cursor.rowcount}
 
 # ==================== 导入导出 API ====================
 
+EXPORT_VERSION = "5.1.4"
+EXPORT_BATCH_SIZE = 500  # 流式导出每次读取并解密的账号数
+EXPORT_FLUSH_BYTES = 64 * 1024  # 流式导出攒够多少字节再发送
+DELETED_RETENTION_DAYS = 180  # 删除记录保留天数，更早的 since 只能全量导出
+
+def record_deleted_accounts(conn, user_id: int, rows: list, now: str):
+    """记录被删除（或邮箱被修改）的账号 (id, email)，供增量导出生成 deleted 列表，顺带清理过期记录"""
+    if not rows:
+        return
+    conn.executemany(f"INSERT INTO user_{user_id}_deleted_accounts (account_id, email, deleted_at) VALUES (?, ?, ?)",
+                     [(row["id"], row["email"], now) for row in rows])
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=DELETED_RETENTION_DAYS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    conn.execute(f"DELETE FROM user_{user_id}_deleted_accounts WHERE deleted_at < ?", (cutoff,))
+
+def parse_export_since(since: str) -> str:
+    """since 支持 Unix 秒数或 ISO 8601 时间，统一为与 updated_at 相同的 UTC 格式"""
+    since = since.strip()
+    try:
+        if re.fullmatch(r"\d+(\.\d+)?", since):
+            cutoff = datetime.fromtimestamp(float(since), timezone.utc)
+        else:
+            cutoff = datetime.fromisoformat(since.replace("Z", "+00:00"))
+            if cutoff.tzinfo is None:
+                cutoff = cutoff.replace(tzinfo=timezone.utc)
+    except (ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="无效的 since 时间")
+    if cutoff < datetime.now(timezone.utc) - timedelta(days=DELETED_RETENTION_DAYS):
+        raise HTTPException(status_code=400, detail=f"since 早于删除记录保留期（{DELETED_RETENTION_DAYS} 天），请使用全量导出")
+    return cutoff.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def load_deleted_accounts(conn, user_id: int, since: str) -> list:
+    """since 之后删除、且当前已没有同邮箱账号的邮箱列表"""
+    cursor = conn.execute(f"""
+        SELECT d.email, MAX(d.deleted_at) AS deleted_at FROM user_{user_id}_deleted_accounts d
+        WHERE d.deleted_at >= ? AND NOT EXISTS (SELECT 1 FROM user_{user_id}_accounts a WHERE a.email = d.email)
+        GROUP BY d.email ORDER BY deleted_at
+    """, (since,))
+    return [{"email": row["email"], "deleted_at": row["deleted_at"]} for row in cursor.fetchall()]
+
+def load_export_taxonomy(conn, user_id: int) -> tuple:
+    """导出用的账号类型和属性组（含属性值），返回 (types, groups)"""
+    types_cursor = conn.execute(f"SELECT * FROM user_{user_id}_account_types ORDER BY sort_order")
+    types = [dict(row) for row in types_cursor.fetchall()]
+    
+    groups = []
+    groups_cursor = conn.execute(f"SELECT * FROM user_{user_id}_property_groups ORDER BY sort_order")
+    for row in groups_cursor.fetchall():
+        group = dict(row)
+        values_cursor = conn.execute(f"SELECT * FROM user_{user_id}_property_values WHERE group_id = ? ORDER BY sort_order", (group['id'],))
+        group['values'] = [dict(v) for v in values_cursor.fetchall()]
+        groups.append(group)
+    return types, groups
+
+def export_account_row(row) -> dict:
+    """账号行 -> 导出格式，password 和 totp.secret 仍为密文，由调用方批量解密"""
+    account_data = {
+        "type_id": row["type_id"],
+        "email": row["email"],
+        "password": row["password"],
+        "country": row["country"],
+        "customName": row["custom_name"] or "",
+        "properties": json.loads(row["properties"] or "{}"),
+        "combos": json.loads(row["combos"] if "combos" in row.keys() and row["combos"] else "[]"),
+        "tags": json.loads(row["tags"] or "[]"),
+        "notes": row["notes"] or "",
+        "backup_email": row["backup_email"] if "backup_email" in row.keys() else "",
+        "is_favorite": bool(row["is_favorite"]),
+        "created_at": row["created_at"]
+    }
+    if "totp_secret" in row.keys() and row["totp_secret"]:
+        account_data["totp"] = {
+            "secret": row["totp_secret"],
+            "issuer": row["totp_issuer"] or "",
+            "type": row["totp_type"] or "totp",
+            "algorithm": row["totp_algorithm"] or "SHA1",
+            "digits": row["totp_digits"] or 6,
+            "period": row["totp_period"] or 30,
+            "backup_codes": json.loads(row["backup_codes"] or "[]"),
+        }
+    return account_data
+
+def decrypt_export_accounts(accounts: list):
+    """批量解密导出账号的密码和 2FA 密钥（原地修改）"""
+    for account_data, password in zip(accounts, decrypt_many([a["password"] for a in accounts])):
+        account_data["password"] = password
+    with_totp = [a for a in accounts if "totp" in a]
+    for account_data, secret in zip(with_totp, decrypt_many([a["totp"]["secret"] for a in with_totp])):
+        account_data["totp"]["secret"] = secret
+
+def load_export_email_settings(conn, user_id: int) -> dict:
+    """导出邮箱相关配置：OAuth 应用凭证、已授权邮箱地址（需重新授权）、待授权邮箱"""
+    oauth_configs = []
+    pending_emails = []
+    email_addresses = []  # 已授权邮箱地址列表（用于在新环境提示需要重新授权）
+    
+    # 导出 OAuth 应用凭证（Client ID/Secret），而非 access_token
+    # 这样更安全：即使文件泄露，攻击者也无法直接访问邮箱
+    try:
+        oauth_cursor = conn.execute("SELECT provider, client_id, client_secret FROM oauth_configs")
+        for row in oauth_cursor.fetchall():
+            oauth_configs.append({
+                "provider": row["provider"],
+                "client_id": row["client_id"],
+                "client_secret": decrypt_password(row["client_secret"])
+            })
+    except:
+        pass
+    
+    # 获取已授权邮箱地址（仅地址，不含token，用于提示用户重新授权）
+    try:
+        emails_cursor = conn.execute(f"SELECT address, provider FROM user_{user_id}_emails WHERE status = 'active'")
+        for row in emails_cursor.fetchall():
+            email_addresses.append({
+                "address": row["address"],
+                "provider": row["provider"]
+            })
+    except:
+        pass
+    
+    # 获取待授权邮箱
+    try:
+        pending_cursor = conn.execute(f"SELECT email FROM user_{user_id}_pending_emails")
+        pending_emails = [row["email"] for row in pending_cursor.fetchall()]
+    except:
+        pass
+    
+    return {
+        "oauth_configs": oauth_configs,  # OAuth应用凭证
+        "email_addresses": email_addresses,  # 已授权邮箱地址（需重新授权）
+        "pending_emails": pending_emails  # 待授权邮箱
+    }
+
+def iter_ndjson_export(user: dict, include_emails: bool, compress: bool, since: str = None):
+    """
+    NDJSON 流式导出：第一行为 header（类型、属性组等），之后每行一个账号，最后一行为 end（账号总数）
+    账号按 ID 分页读取，每页单独连接、解密后立即输出，不在网络发送期间占用数据库连接
+    指定 since 时只输出之后新增/修改的账号，并在账号之后输出 deleted 记录
+    """
+    import zlib
+    
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31 输出 gzip 格式
+    buf = []
+    buf_size = 0
+    
+    def emit(record: dict):
+        nonlocal buf_size
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode()
+        buf.append(compressor.compress(line) if compressor else line)
+        buf_size += len(buf[-1])
+    
+    def drain() -> bytes:
+        nonlocal buf_size
+        data = b"".join(buf)
+        buf.clear()
+        buf_size = 0
+        return data
+    
+    with get_db() as conn:
+        types, groups = load_export_taxonomy(conn, user['id'])
+        header = {
+            "record": "header",
+            "version": EXPORT_VERSION,
+            "exported_at": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "user": user["username"],
+            "account_types": types,
+            "property_groups": groups
+        }
+        if since:
+            header.update({"patch": True, "since": since})
+        if include_emails:
+            header.update(load_export_email_settings(conn, user['id']))
+    emit(header)
+    yield drain()  # 立即发送 header，下载马上开始
+    
+    last_id = 0
+    count = 0
+    since_filter = "AND updated_at >= ?" if since else ""
+    while True:
+        with get_db() as conn:
+            rows = conn.execute(f"SELECT * FROM user_{user['id']}_accounts WHERE id > ? {since_filter} ORDER BY id LIMIT ?",
+                                (last_id, since, EXPORT_BATCH_SIZE) if since else (last_id, EXPORT_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        accounts = [export_account_row(row) for row in rows]
+        decrypt_export_accounts(accounts)
+        for account_data in accounts:
+            emit({"record": "account", **account_data})
+        count += len(accounts)
+        job_checkpoint(count)
+        if buf_size >= EXPORT_FLUSH_BYTES:
+            yield drain()
+    
+    end = {"record": "end", "count": count}
+    if since:
+        with get_db() as conn:
+            deleted = load_deleted_accounts(conn, user['id'], since)
+        for item in deleted:
+            emit({"record": "deleted", **item})
+        end["deleted"] = len(deleted)
+    emit(end)
+    if compressor:
+        buf.append(compressor.flush())
+    yield drain()
+
 @app.get("/api/export")
-def export_data(include_emails: bool = False, user: dict = Depends(get_current_user)):
+def export_data(include_emails: bool = False, format: str = "json", compress: Optional[str] = None,
+                since: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """
+    导出全部数据
+    format=json 返回单个 JSON 对象；format=ndjson 流式输出，每行一条记录，大库也能立即开始下载
+    compress=gzip 时边生成边压缩
+    since 为增量导出：只含之后新增/修改的账号和已删除的邮箱（patch），可直接交给导入接口应用，
+    下次以本次的 exported_at 作为 since
+    """
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="不支持的导出格式")
+    if compress not in (None, "", "gzip"):
+        raise HTTPException(status_code=400, detail="不支持的压缩方式")
+    if since:
+        since = parse_export_since(since)
+    
+    if format == "ndjson":
+        filename = f"accbox-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson"
+        if compress:
+            filename += ".gz"
+        return StreamingResponse(
+            iter_ndjson_export(user, include_emails, bool(compress), since),
+            media_type="application/gzip" if compress else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Accel-Buffering": "no"}
+        )
+    
     with get_db() as conn:
-        types_cursor = conn.execute(f"SELECT * FROM user_{user['id']}_account_types ORDER BY sort_order")
-        types = [dict(row) for row in types_cursor.fetchall()]
-        
-        groups = []
-        groups_cursor = conn.execute(f"SELECT * FROM user_{user['id']}_property_groups ORDER BY sort_order")
-        for row in groups_cursor.fetchall():
-            group = dict(row)
-            values_cursor = conn.execute(f"SELECT * FROM user_{user['id']}_property_values WHERE group_id = ? ORDER BY sort_order", (group['id'],))
-            group['values'] = [dict(v) for v in values_cursor.fetchall()]
-            groups.append(group)
+        types, groups = load_export_taxonomy(conn, user['id'])
         
-        accounts_cursor = conn.execute(f"SELECT * FROM user_{user['id']}_accounts")
-        accounts = []
-        for row in accounts_cursor.fetchall():
-            account_data = {
-                "type_id": row["type_id"],
-                "email": row["email"],
-                "password": decrypt_password(row["password"]),
-                "country": row["country"],
-                "customName": row["custom_name"] or "",
-                "properties": json.loads(row["properties"] or "{}"),
-                "combos": json.loads(row["combos"] if "combos" in row.keys() and row["combos"] else "[]"),
-                "tags": json.loads(row["tags"] or "[]"),
-                "notes": row["notes"] or "",
-                "backup_email": row["backup_email"] if "backup_email" in row.keys() else "",
-                "is_favorite": bool(row["is_favorite"]),
-                "created_at": row["created_at"]
-            }
-            if "totp_secret" in row.keys() and row["totp_secret"]:
-                account_data["totp"] = {
-                    "secret": decrypt_password(row["totp_secret"]),
-                    "issuer": row["totp_issuer"] or "",
-                    "type": row["totp_type"] or "totp",
-                    "algorithm": row["totp_algorithm"] or "SHA1",
-                    "digits": row["totp_digits"] or 6,
-                    "period": row["totp_period"] or 30,
-                    "backup_codes": json.loads(row["backup_codes"] or "[]"),
-                }
-            accounts.append(account_data)
+        if since:
+            accounts_cursor = conn.execute(f"SELECT * FROM user_{user['id']}_accounts WHERE updated_at >= ?", (since,))
+            deleted = load_deleted_accounts(conn, user['id'], since)
+        else:
+            accounts_cursor = conn.execute(f"SELECT * FROM user_{user['id']}_accounts")
+        accounts = [export_account_row(row) for row in accounts_cursor.fetchall()]
         
         # 导出邮箱相关配置（如果请求）
-        oauth_configs = []
-        pending_emails = []
-        email_addresses = []  # 已授权邮箱地址列表（用于在新环境提示需要重新授权）
-        
-        if include_emails:
-            # 导出 OAuth 应用凭证（Client ID/Secret），而非 access_token
-            # 这样更安全：即使文件泄露，攻击者也无法直接访问邮箱
-            try:
-                oauth_cursor = conn.execute("SELECT provider, client_id, client_secret FROM oauth_configs")
-                for row in oauth_cursor.fetchall():
-                    oauth_configs.append({
-                        "provider": row["provider"],
-                        "client_id": row["client_id"],
-                        "client_secret": decrypt_password(row["client_secret"])
-                    })
-            except:
-                pass
-            
-            # 获取已授权邮箱地址（仅地址，不含token，用于提示用户重新授权）
-            try:
-                emails_cursor = conn.execute(f"SELECT address, provider FROM user_{user['id']}_emails WHERE status = 'active'")
-                for row in emails_cursor.fetchall():
-                    email_addresses.append({
-                        "address": row["address"],
-                        "provider": row["provider"]
-                    })
-            except:
-                pass
-            
-            # 获取待授权邮箱
-            try:
-                pending_cursor = conn.execute(f"SELECT email FROM user_{user['id']}_pending_emails")
-                pending_emails = [row["email"] for row in pending_cursor.fetchall()]
-            except:
-                pass
+        email_settings = load_export_email_settings(conn, user['id']) if include_emails else {}
+    
+    # 连接释放后批量解密
+    decrypt_export_accounts(accounts)
     
     result = {
-        "version": "5.1.4",
+        "version": EXPORT_VERSION,
         "exported_at": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
-        "user": user["username"],
+        "user": user["username"]
+    }
+    if since:
+        result.update({"patch": True, "since": since})
+    result.update({
         "account_types": types,
         "property_groups": groups,
         "accounts": accounts
-    }
-    
-    if include_emails:
-        result["oauth_configs"] = oauth_configs  # OAuth应用凭证
-        result["email_addresses"] = email_addresses  # 已授权邮箱地址（需重新授权）
-        result["pending_emails"] = pending_emails  # 待授权邮箱
-    
+    })
+    if since:
+        result["deleted"] = deleted
+    result.update(email_settings)
+    
+    if compress:
+        import gzip
+        return Response(gzip.compress(json.dumps(result, ensure_ascii=False).encode()), media_type="application/gzip",
+                        headers={"Content-Disposition": 'attachment; filename="accbox-export.json.gz"'})
     return result
 
-@app.post("/api/import")
-def import_data(data: dict, user: dict = Depends(get_current_user)):
-    if "accounts" not in data:
-        raise HTTPException(status_code=400, detail="无效的导入数据")
-    
-    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-    import_mode = data.get("import_mode", "all")
-    
-    imported_accounts = 0
-    updated_accounts = 0
-    skipped_accounts = 0
+def import_account_types(conn, user_id: int, account_types: list, type_id_map: dict) -> int:
+    """导入账号类型（按名称合并），填充 旧ID -> 新ID 映射，返回新增数量"""
     imported_types = 0
+    existing_types = {}
+    cursor = conn.execute(f"SELECT id, name FROM user_{user_id}_account_types")
+    for row in cursor.fetchall():
+        existing_types[row["name"].lower()] = row["id"]
+    
+    for old_type in account_types:
+        old_id = old_type.get("id")
+        name = old_type.get("name", "")
+        name_lower = name.lower()
+        
+        if name_lower in existing_types:
+            type_id_map[old_id] = existing_types[name_lower]
+        else:
+            cursor = conn.execute(f"""
+                INSERT INTO user_{user_id}_account_types (name, icon, color, login_url, sort_order)
+                VALUES (?, ?, ?, ?, ?)
+            """, (name, old_type.get("icon", "🔑"), old_type.get("color", "#8b5cf6"),
+                  old_type.get("login_url", ""), old_type.get("sort_order", 0)))
+            new_id = cursor.lastrowid
+            type_id_map[old_id] = new_id
+            existing_types[name_lower] = new_id
+            imported_types += 1
+    return imported_types
+
+def import_property_groups(conn, user_id: int, property_groups: list, value_id_map: dict) -> tuple:
+    """导入属性组和值（按名称合并），填充值的 旧ID -> 新ID 映射，返回 (新增组数, 新增值数)"""
     imported_groups = 0
     imported_values = 0
-    
-    type_id_map = {}
-    value_id_map = {}
-    
-    with get_db() as conn:
-        # 导入账号类型
-        if "account_types" in data:
-            existing_types = {}
-            cursor = conn.execute(f"SELECT id, name FROM user_{user['id']}_account_types")
+    existing_groups = {}
+    cursor = conn.execute(f"SELECT id, name FROM user_{user_id}_property_groups")
+    for row in cursor.fetchall():
+        existing_groups[row["name"].lower()] = row["id"]
+    
+    for old_group in property_groups:
+        group_name = old_group.get("name", "")
+        group_name_lower = group_name.lower()
+        
+        if group_name_lower in existing_groups:
+            new_group_id = existing_groups[group_name_lower]
+        else:
+            cursor = conn.execute(f"INSERT INTO user_{user_id}_property_groups (name, sort_order) VALUES (?, ?)",
+                (group_name, old_group.get("sort_order", 0)))
+            new_group_id = cursor.lastrowid
+            existing_groups[group_name_lower] = new_group_id
+            imported_groups += 1
+        
+        if "values" in old_group:
+            existing_values = {}
+            cursor = conn.execute(f"SELECT id, name FROM user_{user_id}_property_values WHERE group_id = ?", (new_group_id,))
             for row in cursor.fetchall():
-                existing_types[row["name"].lower()] = row["id"]
+                existing_values[row["name"].lower()] = row["id"]
             
-            for old_type in data["account_types"]:
-                old_id = old_type.get("id")
-                name = old_type.get("name", "")
-                name_lower = name.lower()
+            for old_value in old_group["values"]:
+                old_value_id = old_value.get("id")
+                value_name = old_value.get("name", "")
+                value_name_lower = value_name.lower()
                 
-                if name_lower in existing_types:
-                    type_id_map[old_id] = existing_types[name_lower]
+                if value_name_lower in existing_values:
+                    value_id_map[old_value_id] = existing_values[value_name_lower]
                 else:
                     cursor = conn.execute(f"""
-                        INSERT INTO user_{user['id']}_account_types (name, icon, color, login_url, sort_order)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (name, old_type.get("icon", "🔑"), old_type.get("color", "#8b5cf6"),
-                          old_type.get("login_url", ""), old_type.get("sort_order", 0)))
-                    new_id = cursor.lastrowid
-                    type_id_map[old_id] = new_id
-                    existing_types[name_lower] = new_id
-                    imported_types += 1
-        
-        # 导入属性组和值
-        if "property_groups" in data:
-            existing_groups = {}
-            cursor = conn.execute(f"SELECT id, name FROM user_{user['id']}_property_groups")
-            for row in cursor.fetchall():
-                existing_groups[row["name"].lower()] = row["id"]
-            
-            for old_group in data["property_groups"]:
-                old_group_id = old_group.get("id")
-                group_name = old_group.get("name", "")
-                group_name_lower = group_name.lower()
-                
-                if group_name_lower in existing_groups:
-                    new_group_id = existing_groups[group_name_lower]
+                        INSERT INTO user_{user_id}_property_values (group_id, name, color, sort_order)
+                        VALUES (?, ?, ?, ?)
+                    """, (new_group_id, value_name, old_value.get("color", "#8b5cf6"), old_value.get("sort_order", 0)))
+                    value_id_map[old_value_id] = cursor.lastrowid
+                    imported_values += 1
+    return imported_groups, imported_values
+
+IMPORT_WRITE_CHUNK = 1000  # executemany 每次写入的行数
+
+ACCOUNT_INSERT_COLUMNS = (
+    "type_id", "email", "password", "country", "custom_name", "properties", "combos", "tags", "notes",
+    "is_favorite", "created_at", "updated_at",
+    "totp_secret", "totp_issuer", "totp_type", "totp_algorithm", "totp_digits", "totp_period", "backup_codes",
+    "import_hash"
+)
+ACCOUNT_OVERWRITE_COLUMNS = (
+    "type_id", "password", "country", "custom_name", "properties", "combos", "tags", "notes", "is_favorite", "updated_at",
+    "import_hash"
+)
+ACCOUNT_HASH_COLUMNS = ACCOUNT_OVERWRITE_COLUMNS[:-2]  # 覆盖导入会写入的内容字段
+# 记录哈希含明文密码，用由主密钥派生的 HMAC 密钥，避免库中出现可离线猜测的密码摘要
+RECORD_HASH_KEY = hashlib.sha256(b"accbox-import-record:" + ENCRYPTION_KEY).digest()
+
+def account_record_hash(fields: dict, updated_at: str) -> str:
+    """
+    导入时写入的内容指纹，格式为 "摘要@updated_at"
+    账号之后被任何接口修改都会刷新 updated_at，指纹随之失效
+    """
+    payload = json.dumps([fields[col] for col in ACCOUNT_HASH_COLUMNS], ensure_ascii=False, default=str)
+    digest = hmac.new(RECORD_HASH_KEY, payload.encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{digest}@{updated_at}"
+
+def load_account_email_ids(conn, user_id: int, after_id: int = 0) -> dict:
+    """邮箱 -> 账号ID，同邮箱多条时取最早的一条"""
+    email_ids = {}
+    cursor = conn.execute(f"SELECT id, email FROM user_{user_id}_accounts WHERE id > ? ORDER BY id", (after_id,))
+    for row in cursor:
+        email_ids.setdefault(row["email"], row["id"])
+    return email_ids
+
+def import_accounts(conn, user_id: int, accounts: list, import_mode: str, type_id_map: dict, value_id_map: dict,
+                    now: str, email_ids: dict = None) -> tuple:
+    """
+    导入一批账号，返回 (新增, 更新, 跳过, 未变化)
+    import_mode: all=全部新增, skip=跳过已存在邮箱, overwrite=覆盖已存在邮箱
+    email_ids 为已有账号的 邮箱 -> ID 映射，分批调用时传入同一个字典，新增的账号会补充进去
+    覆盖模式下内容指纹与上次导入相同且之后未被修改的账号不加密、不重写，计入未变化
+    """
+    if email_ids is None:
+        email_ids = load_account_email_ids(conn, user_id)
+    
+    imported_accounts = 0
+    updated_accounts = 0
+    skipped_accounts = 0
+    unchanged_accounts = 0
+    
+    inserts = []  # 待新增行（字段字典）
+    pending = {}  # 本批待新增的 邮箱 -> inserts 下标，同批重复邮箱按已存在处理
+    overwrites = []  # (字段字典, 账号ID)
+    
+    for acc in accounts:
+        email = acc.get("email", "")
+        fields = {
+            "type_id": type_id_map.get(acc.get("type_id")) if acc.get("type_id") else None,
+            "password": acc.get("password", ""),
+            "country": acc.get("country", "🌍"),
+            "custom_name": acc.get("customName", ""),
+            "properties": json.dumps(acc.get("properties", {})),
+            "combos": json.dumps([[value_id_map.get(v, v) for v in combo] for combo in acc.get("combos", [])]),
+            "tags": json.dumps(acc.get("tags", []), ensure_ascii=False),
+            "notes": acc.get("notes", ""),
+            "is_favorite": 1 if acc.get("is_favorite") else 0,
+            "updated_at": now
+        }
+        fields["import_hash"] = account_record_hash(fields, now)
+        
+        if email in email_ids or email in pending:
+            if import_mode == "skip":
+                skipped_accounts += 1
+                continue
+            elif import_mode == "overwrite":
+                if email in email_ids:
+                    overwrites.append((fields, email_ids[email]))
                 else:
-                    cursor = conn.execute(f"INSERT INTO user_{user['id']}_property_groups (name, sort_order) VALUES (?, ?)",
-                        (group_name, old_group.get("sort_order", 0)))
-                    new_group_id = cursor.lastrowid
-                    existing_groups[group_name_lower] = new_group_id
-                    imported_groups += 1
-                
-                if "values" in old_group:
-                    existing_values = {}
-                    cursor = conn.execute(f"SELECT id, name FROM user_{user['id']}_property_values WHERE group_id = ?", (new_group_id,))
-                    for row in cursor.fetchall():
-                        existing_values[row["name"].lower()] = row["id"]
-                    
-                    for old_value in old_group["values"]:
-                        old_value_id = old_value.get("id")
-                        value_name = old_value.get("name", "")
-                        value_name_lower = value_name.lower()
-                        
-                        if value_name_lower in existing_values:
-                            value_id_map[old_value_id] = existing_values[value_name_lower]
-                        else:
-                            cursor = conn.execute(f"""
-                                INSERT INTO user_{user['id']}_property_values (group_id, name, color, sort_order)
-                                VALUES (?, ?, ?, ?)
-                            """, (new_group_id, value_name, old_value.get("color", "#8b5cf6"), old_value.get("sort_order", 0)))
-                            value_id_map[old_value_id] = cursor.lastrowid
-                            imported_values += 1
-        
-        # 导入账号
-        for acc in data["accounts"]:
-            email = acc.get("email", "")
-            
-            cursor = conn.execute(f"SELECT id FROM user_{user['id']}_accounts WHERE email = ?", (email,))
-            existing = cursor.fetchone()
-            
-            if existing:
-                if import_mode == "skip":
-                    skipped_accounts += 1
-                    continue
-                elif import_mode == "overwrite":
-                    new_type_id = type_id_map.get(acc.get("type_id")) if acc.get("type_id") else None
-                    new_combos = []
-                    for combo in acc.get("combos", []):
-                        new_combo = [value_id_map.get(v, v) for v in combo]
-                        new_combos.append(new_combo)
-                    
-                    conn.execute(f"""
-                        UPDATE user_{user['id']}_accounts SET
-                        type_id=?, password=?, country=?, custom_name=?, properties=?, combos=?, tags=?, notes=?, is_favorite=?, updated_at=?
-                        WHERE id=?
-                    """, (
-                        new_type_id, encrypt_password(acc.get("password", "")),
-                        acc.get("country", "🌍"), acc.get("customName", ""),
-                        json.dumps(acc.get("properties", {})), json.dumps(new_combos),
-                        json.dumps(acc.get("tags", []), ensure_ascii=False),
-                        acc.get("notes", ""), 1 if acc.get("is_favorite") else 0, now, existing["id"]
-                    ))
-                    updated_accounts += 1
-                    continue
-            
-            new_type_id = type_id_map.get(acc.get("type_id")) if acc.get("type_id") else None
-            new_combos = []
-            for combo in acc.get("combos", []):
-                new_combo = [value_id_map.get(v, v) for v in combo]
-                new_combos.append(new_combo)
-            
-            cursor = conn.execute(f"""
-                INSERT INTO user_{user['id']}_accounts 
-                (type_id, email, password, country, custom_name, properties, combos, tags, notes, is_favorite, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                new_type_id, email, encrypt_password(acc.get("password", "")),
-                acc.get("country", "🌍"), acc.get("customName", ""),
-                json.dumps(acc.get("properties", {})), json.dumps(new_combos),
-                json.dumps(acc.get("tags", []), ensure_ascii=False),
-                acc.get("notes", ""), 1 if acc.get("is_favorite") else 0,
-                acc.get("created_at", now), now  # 保留原始创建时间
-            ))
-            
-            if "totp" in acc and acc["totp"].get("secret"):
-                totp = acc["totp"]
-                conn.execute(f"""
-                    UPDATE user_{user['id']}_accounts SET
-                    totp_secret=?, totp_issuer=?, totp_type=?, totp_algorithm=?, totp_digits=?, totp_period=?, backup_codes=?
-                    WHERE id=?
-                """, (
-                    encrypt_password(totp["secret"]), totp.get("issuer", ""),
-                    totp.get("type", "totp"), totp.get("algorithm", "SHA1"),
-                    totp.get("digits", 6), totp.get("period", 30),
-                    json.dumps(totp.get("backup_codes", [])), cursor.lastrowid
-                ))
-            
-            imported_accounts += 1
-        
-        # 导入 OAuth 应用凭证（Client ID/Secret）
-        imported_oauth = 0
-        if "oauth_configs" in data and data["oauth_configs"]:
-            for config in data["oauth_configs"]:
-                provider = config.get("provider")
-                client_id = config.get("client_id")
-                client_secret = config.get("client_secret")
-                
-                if not provider or not client_id or not client_secret:
-                    continue
-                
-                try:
-                    encrypted_secret = encrypt_password(client_secret)
-                    conn.execute("""
-                        INSERT OR REPLACE INTO oauth_configs (provider, client_id, client_secret)
-                        VALUES (?, ?, ?)
-                    """, (provider, client_id, encrypted_secret))
-                    imported_oauth += 1
-                except Exception as e:
-                    print(f"导入OAuth凭证 {provider} 失败: {e}")
+                    inserts[pending[email]].update(fields)
+                updated_accounts += 1
+                continue
         
-        # 导入待授权邮箱（包括之前已授权但需要重新授权的）
-        imported_pending = 0
+        totp = acc.get("totp") or {}
+        has_totp = bool(totp.get("secret"))
+        fields.update({
+            "email": email,
+            "created_at": acc.get("created_at", now),  # 保留原始创建时间
+            "totp_secret": totp["secret"] if has_totp else "",
+            "totp_issuer": totp.get("issuer", "") if has_totp else "",
+            "totp_type": totp.get("type", "totp") if has_totp else "",
+            "totp_algorithm": totp.get("algorithm", "SHA1") if has_totp else "SHA1",
+            "totp_digits": totp.get("digits", 6) if has_totp else 6,
+            "totp_period": totp.get("period", 30) if has_totp else 30,
+            "backup_codes": json.dumps(totp.get("backup_codes", []) if has_totp else [])
+        })
+        pending.setdefault(email, len(inserts))
+        inserts.append(fields)
+        imported_accounts += 1
+    
+    if overwrites:
+        # 库中指纹为 "摘要@写入时的updated_at"：摘要相同且 updated_at 未变，说明内容与上次导入相同且之后没有改动
+        current = {}
+        ids = [account_id for _, account_id in overwrites]
+        for i in range(0, len(ids), IMPORT_WRITE_CHUNK):
+            chunk = ids[i:i + IMPORT_WRITE_CHUNK]
+            for row in conn.execute(f"""SELECT id, import_hash, updated_at FROM user_{user_id}_accounts
+                                        WHERE id IN ({','.join('?' * len(chunk))})""", chunk):
+                current[row["id"]] = (row["import_hash"] or "", row["updated_at"])
+        changed = []
+        for fields, account_id in overwrites:
+            stored_hash, updated_at = current.get(account_id, ("", ""))
+            if stored_hash and stored_hash == f"{fields['import_hash'].partition('@')[0]}@{updated_at}":
+                unchanged_accounts += 1
+            else:
+                changed.append((fields, account_id))
+        updated_accounts -= unchanged_accounts
+        overwrites = changed
+    
+    # 加密在写入前集中批量完成
+    targets = [(fields, "password") for fields in inserts] + \
+              [(fields, "totp_secret") for fields in inserts if fields["totp_secret"]] + \
+              [(fields, "password") for fields, _ in overwrites]
+    for (fields, col), encrypted in zip(targets, encrypt_many([fields[col] for fields, col in targets])):
+        fields[col] = encrypted
+    
+    update_sql = f"""UPDATE user_{user_id}_accounts SET
+        {', '.join(f'{col}=?' for col in ACCOUNT_OVERWRITE_COLUMNS)} WHERE id=?"""
+    for i in range(0, len(overwrites), IMPORT_WRITE_CHUNK):
+        conn.executemany(update_sql, [
+            tuple(fields[col] for col in ACCOUNT_OVERWRITE_COLUMNS) + (account_id,)
+            for fields, account_id in overwrites[i:i + IMPORT_WRITE_CHUNK]
+        ])
+    
+    if inserts:
+        last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM user_{user_id}_accounts").fetchone()[0]
+        insert_sql = f"""INSERT INTO user_{user_id}_accounts ({', '.join(ACCOUNT_INSERT_COLUMNS)})
+            VALUES ({', '.join('?' * len(ACCOUNT_INSERT_COLUMNS))})"""
+        for i in range(0, len(inserts), IMPORT_WRITE_CHUNK):
+            conn.executemany(insert_sql, [
+                tuple(fields[col] for col in ACCOUNT_INSERT_COLUMNS) for fields in inserts[i:i + IMPORT_WRITE_CHUNK]
+            ])
+        # 新增账号加入映射，供后续批次判断重复
+        for email, account_id in load_account_email_ids(conn, user_id, after_id=last_id).items():
+            email_ids.setdefault(email, account_id)
+    
+    return imported_accounts, updated_accounts, skipped_accounts, unchanged_accounts
+
+def import_oauth_configs(conn, oauth_configs: list) -> int:
+    """导入 OAuth 应用凭证（Client ID/Secret），返回导入数量"""
+    imported_oauth = 0
+    for config in oauth_configs or []:
+        provider = config.get("provider")
+        client_id = config.get("client_id")
+        client_secret = config.get("client_secret")
         
-        # 从 email_addresses 添加到待授权（这些是之前授权过的，需要重新授权）
-        if "email_addresses" in data and data["email_addresses"]:
-            for email_info in data["email_addresses"]:
-                email = email_info.get("address") if isinstance(email_info, dict) else email_info
-                if email:
-                    try:
-                        conn.execute(f"""
-                            INSERT OR IGNORE INTO user_{user['id']}_pending_emails (email)
-                            VALUES (?)
-                        """, (email,))
-                        imported_pending += 1
-                    except:
-                        pass
-        
-        # 从 pending_emails 添加
-        if "pending_emails" in data and data["pending_emails"]:
-            for email in data["pending_emails"]:
-                if email:
-                    try:
-                        conn.execute(f"""
-                            INSERT OR IGNORE INTO user_{user['id']}_pending_emails (email)
-                            VALUES (?)
-                        """, (email,))
-                        imported_pending += 1
-                    except:
-                        pass
+        if not provider or not client_id or not client_secret:
+            continue
         
-        conn.commit()
+        try:
+            encrypted_secret = encrypt_password(client_secret)
+            conn.execute("""
+                INSERT OR REPLACE INTO oauth_configs (provider, client_id, client_secret)
+                VALUES (?, ?, ?)
+            """, (provider, client_id, encrypted_secret))
+            imported_oauth += 1
+        except Exception as e:
+            print(f"导入OAuth凭证 {provider} 失败: {e}")
+    return imported_oauth
+
+def import_pending_emails(conn, user_id: int, email_addresses: list, pending_emails: list) -> int:
+    """导入待授权邮箱（包括之前已授权但需要重新授权的），返回导入数量"""
+    imported_pending = 0
     
-    result_msg = f"导入完成：{imported_accounts} 新增, {updated_accounts} 更新, {skipped_accounts} 跳过"
-    if imported_oauth > 0:
-        result_msg += f", {imported_oauth} 个OAuth配置"
-    if imported_pending > 0:
-        result_msg += f", {imported_pending} 个待授权邮箱"
+    # 从 email_addresses 添加到待授权（这些是之前授权过的，需要重新授权）
+    emails = [e.get("address") if isinstance(e, dict) else e for e in email_addresses or []]
+    # 从 pending_emails 添加
+    emails += list(pending_emails or [])
     
+    for email in emails:
+        if email:
+            try:
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO user_{user_id}_pending_emails (email)
+                    VALUES (?)
+                """, (email,))
+                imported_pending += 1
+            except:
+                pass
+    return imported_pending
+
+def apply_deleted_accounts(conn, user_id: int, deleted: list, now: str, email_ids: dict = None) -> int:
+    """应用增量导出中的 deleted 列表：删除这些邮箱的账号，返回删除数量"""
+    emails = list({item.get("email") for item in deleted if isinstance(item, dict) and item.get("email")})
+    removed = 0
+    for i in range(0, len(emails), IMPORT_WRITE_CHUNK):
+        chunk = emails[i:i + IMPORT_WRITE_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT id, email FROM user_{user_id}_accounts WHERE email IN ({placeholders})", chunk).fetchall()
+        if not rows:
+            continue
+        record_deleted_accounts(conn, user_id, rows, now)
+        ids = [row["id"] for row in rows]
+        conn.execute(f"DELETE FROM user_{user_id}_accounts WHERE id IN ({','.join('?' * len(ids))})", ids)
+        invalidate_totp_cache(user_id, ids)
+        if email_ids is not None:
+            for row in rows:
+                email_ids.pop(row["email"], None)
+        removed += len(rows)
+    return removed
+
+def new_import_stats() -> dict:
     return {
-        "message": result_msg,
-        "imported_types": imported_types,
-        "imported_groups": imported_groups,
-        "imported_values": imported_values,
-        "imported": imported_accounts,
-        "updated": updated_accounts,
-        "skipped": skipped_accounts,
-        "imported_oauth": imported_oauth,
-        "imported_pending": imported_pending
+        "imported_types": 0,
+        "imported_groups": 0,
+        "imported_values": 0,
+        "imported": 0,
+        "updated": 0,
+        "skipped": 0,
+        "unchanged": 0,
+        "deleted": 0,
+        "imported_oauth": 0,
+        "imported_pending": 0
     }
 
-@app.post("/api/import-csv")
-def import_csv(data: dict, user: dict = Depends(get_current_user)):
-    csv_text = data.get("csv", "")
-    if not csv_text:
-        raise HTTPException(status_code=400, detail="CSV内容为空")
+def import_result(stats: dict, started: float) -> dict:
+    """生成导入结果（含提示信息和处理速度），started 为 time.perf_counter() 起始值"""
+    elapsed = time.perf_counter() - started
+    rows = stats["imported"] + stats["updated"] + stats["skipped"] + stats["unchanged"]
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    stats["rows_per_second"] = int(rows / elapsed) if elapsed > 0 else rows
+    result_msg = f"导入完成：{stats['imported']} 新增, {stats['updated']} 更新, {stats['skipped']} 跳过"
+    if stats["unchanged"] > 0:
+        result_msg += f", {stats['unchanged']} 未变化"
+    if stats["deleted"] > 0:
+        result_msg += f", {stats['deleted']} 删除"
+    if stats["imported_oauth"] > 0:
+        result_msg += f", {stats['imported_oauth']} 个OAuth配置"
+    if stats["imported_pending"] > 0:
+        result_msg += f", {stats['imported_pending']} 个待授权邮箱"
+    return {"message": result_msg, **stats}
+
+IMPORT_DEDUP_HOURS = 24  # 此时间内再次上传完全相同的内容，直接返回上次结果
+IMPORT_LOG_RETENTION_DAYS = 7  # 导入记录（含 Idempotency-Key）保留天数
+
+imports_in_progress = set()  # (user_id, 幂等键或内容摘要)
+imports_in_progress_lock = threading.Lock()
+
+def run_idempotent_import(user_id: int, content_hash: str, idempotency_key: Optional[str], force: bool,
+                          handler, *args) -> dict:
+    """
+    幂等执行 handler(*args)：
+    - 相同 Idempotency-Key 返回上次结果（内容不同则 409）
+    - 未带键时，IMPORT_DEDUP_HOURS 内内容摘要相同的导入返回上次结果，force=True 跳过此检查
+    - 相同导入并发进行时 409
+    只记录成功的导入；中途失败时已提交的批次保留，重试会重新处理
+    """
+    marker = (user_id, idempotency_key or content_hash)
+    with imports_in_progress_lock:
+        if marker in imports_in_progress:
+            raise HTTPException(status_code=409, detail="相同的导入正在进行中")
+        imports_in_progress.add(marker)
+    
+    try:
+        now = datetime.now(timezone.utc)
+        with get_db() as conn:
+            previous = None
+            if idempotency_key:
+                previous = conn.execute(f"""SELECT content_hash, result, created_at FROM user_{user_id}_import_log
+                    WHERE idempotency_key = ? ORDER BY id DESC LIMIT 1""", (idempotency_key,)).fetchone()
+                if previous and previous["content_hash"] != content_hash:
+                    raise HTTPException(status_code=409, detail="Idempotency-Key 已用于不同的导入内容")
+            if not previous and not force:
+                cutoff = (now - timedelta(hours=IMPORT_DEDUP_HOURS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                previous = conn.execute(f"""SELECT content_hash, result, created_at FROM user_{user_id}_import_log
+                    WHERE content_hash = ? AND created_at >= ? ORDER BY id DESC LIMIT 1""", (content_hash, cutoff)).fetchone()
+        if previous:
+            result = json.loads(previous["result"])
+            result.update({"replayed": True, "previous_import_at": previous["created_at"],
+                           "message": f"重复导入，已返回 {previous['created_at']} 的导入结果：{result.get('message', '')}"})
+            return result
+        
+        result = handler(*args)
+        
+        with get_db() as conn:
+            conn.execute(f"""INSERT INTO user_{user_id}_import_log (idempotency_key, content_hash, result, created_at)
+                VALUES (?, ?, ?, ?)""", (idempotency_key, content_hash, json.dumps(result, ensure_ascii=False),
+                                         now.strftime('%Y-%m-%dT%H:%M:%SZ')))
+            expired = (now - timedelta(days=IMPORT_LOG_RETENTION_DAYS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            conn.execute(f"DELETE FROM user_{user_id}_import_log WHERE created_at < ?", (expired,))
+            conn.commit()
+        return result
+    finally:
+        with imports_in_progress_lock:
+            imports_in_progress.discard(marker)
+
+def request_content_hash(data: dict) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+@app.post("/api/import")
+def import_data(data: dict, user: dict = Depends(get_current_user), idempotency_key: Optional[str] = Header(None)):
+    """
+    导入 JSON 数据，支持 Idempotency-Key 请求头；相同内容 24 小时内重复提交直接返回上次结果，
+    确需重复导入时传 "force": true
+    """
+    if "accounts" not in data:
+        raise HTTPException(status_code=400, detail="无效的导入数据")
     
+    force = bool(data.pop("force", False))
+    return run_idempotent_import(user['id'], request_content_hash(data), idempotency_key, force,
+                                 import_data_payload, data, user['id'])
+
+def import_data_payload(data: dict, user_id: int) -> dict:
+    started = time.perf_counter()
     now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-    imported = 0
-    errors = []
+    patch = bool(data.get("patch"))  # 增量导出（since）的结果，默认按覆盖模式应用
+    import_mode = data.get("import_mode", "overwrite" if patch else "all")
+    stats = new_import_stats()
+    
+    type_id_map = {}
+    value_id_map = {}
     
-    lines = csv_text.strip().split('\n')
     with get_db() as conn:
-        for i, line in enumerate(lines):
-            if not line.strip() or line.startswith('#'):
-                continue
-            parts = [p.strip() for p in line.split(',')]
-            if len(parts) < 2:
-                errors.append(f"第{i+1}行格式错误")
-                continue
-            try:
-                email = parts[0]
-                password = parts[1]
-                country = parts[2] if len(parts) > 2 and parts[2] else "🌍"
-                custom_name = parts[3] if len(parts) > 3 else ""
-                
-                conn.execute(f"""
-                    INSERT INTO user_{user['id']}_accounts 
-                    (email, password, country, custom_name, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (email, encrypt_password(password), country, custom_name, now, now))
-                imported += 1
-            except Exception as e:
-                errors.append(f"第{i+1}行: {str(e)}")
+        if "account_types" in data:
+            stats["imported_types"] = import_account_types(conn, user_id, data["account_types"], type_id_map)
+        
+        if "property_groups" in data:
+            stats["imported_groups"], stats["imported_values"] = import_property_groups(
+                conn, user_id, data["property_groups"], value_id_map)
+        
+        if patch and data.get("deleted"):
+            stats["deleted"] = apply_deleted_accounts(conn, user_id, data["deleted"], now)
+        
+        stats["imported"], stats["updated"], stats["skipped"], stats["unchanged"] = import_accounts(
+            conn, user_id, data["accounts"], import_mode, type_id_map, value_id_map, now)
+        
+        stats["imported_oauth"] = import_oauth_configs(conn, data.get("oauth_configs"))
+        stats["imported_pending"] = import_pending_emails(
+            conn, user_id, data.get("email_addresses"), data.get("pending_emails"))
+        
         conn.commit()
     
-    return {"message": f"成功导入 {imported} 个账号", "count": imported, "errors": errors[:10]}
-
-# ==================== 2FA TOTP API ====================
-
-STEAM_CHARS = "23456789BCDFGHJKMNPQRTVWXY"
+    return import_result(stats, started)
 
-def generate_totp(secret: str, time_offset: int = 0, digits: int = 6, period: int = 30, algorithm: str = "SHA1") -> str:
-    try:
-        key = base64.b32decode(secret.upper().replace(" ", "") + "=" * ((8 - len(secret) % 8) % 8))
-        counter = (int(time.time()) + time_offset) // period
-        counter_bytes = struct.pack(">Q", counter)
-        hash_func = {"SHA256": hashlib.sha256, "SHA512": hashlib.sha512}.get(algorithm.upper(), hashlib.sha1)
-        h = hmac.new(key, counter_bytes, hash_func).digest()
-        offset = h[-1] & 0x0F
-        code = struct.unpack(">I", h[offset:offset + 4])[0] & 0x7FFFFFFF
-        return str(code % (10 ** digits)).zfill(digits)
-    except:
-        return ""
+# ==================== 流式导入 (大文件) ====================
 
-def generate_steam_code(secret: str, time_offset: int = 0) -> str:
-    try:
-        key = base64.b64decode(secret)
-        counter = (int(time.time()) + time_offset) // 30
-        h = hmac.new(key, struct.pack(">Q", counter), hashlib.sha1).digest()
-        offset = h[-1] & 0x0F
-        code = struct.unpack(">I", h[offset:offset + 4])[0] & 0x7FFFFFFF
-        return "".join(STEAM_CHARS[code // (len(STEAM_CHARS) ** i) % len(STEAM_CHARS)] for i in range(5))
-    except:
-        return ""
+IMPORT_READ_CHUNK = 64 * 1024  # 每次读取的字符数
+IMPORT_BATCH_SIZE = 500  # 每批写入并提交的账号数
 
-def parse_otpauth_uri(uri: str) -> dict:
-    try:
-        match = re.match(r'otpauth://(totp|hotp)/([^?]+)\?(.+)', uri)
-        if not match:
+def iter_json_object_stream(fp, stream_keys: tuple = ()):
+    """
+    增量解析文件中的顶层 JSON 对象，逐个返回 (键, 值)
+    stream_keys 中的键必须是数组，其元素逐个以 (键, 元素) 返回，不会整体载入内存
+    """
+    decoder = json.JSONDecoder()
+    number_end = re.compile(r"[^0-9.eE+\-]")
+    state = {"buf": "", "pos": 0, "eof": False}
+    
+    def fill() -> bool:
+        if state["eof"]:
+            return False
+        chunk = fp.read(IMPORT_READ_CHUNK)
+        if not chunk:
+            state["eof"] = True
+            return False
+        state["buf"] = state["buf"][state["pos"]:] + chunk
+        state["pos"] = 0
+        return True
+    
+    def peek() -> str:
+        while True:
+            buf, pos = state["buf"], state["pos"]
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError("JSON 数据不完整")
+    
+    def take(expected: str):
+        ch = peek()
+        if ch not in expected:
+            raise ValueError(f"JSON 格式错误: 期望 {expected!r}，实际为 {ch!r}")
+        state["pos"] += 1
+        return ch
+    
+    def value():
+        if peek() in "-0123456789":
+            # 数字可能被缓冲区截断（如 "12" + "3.5"），先读到数字之后的分隔符
+            while not number_end.search(state["buf"], state["pos"]) and fill():
+                pass
+        while True:
+            try:
+                result, end = decoder.raw_decode(state["buf"], state["pos"])
+                state["pos"] = end
+                return result
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+    
+    take("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        if not isinstance(key, str):
+            raise ValueError("JSON 格式错误: 键必须是字符串")
+        take(":")
+        if key in stream_keys:
+            take("[")
+            if peek() == "]":
+                state["pos"] += 1
+            else:
+                while True:
+                    yield key, value()
+                    if take(",]") == "]":
+                        break
+        else:
+            yield key, value()
+        if take(",}") == "}":
+            return
+
+def iter_ndjson_records(fp):
+    """逐行解析 NDJSON 导出文件，返回与 iter_json_object_stream 相同的 (键, 值)"""
+    for line_no, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            raise ValueError(f"第{line_no}行不是有效的 JSON")
+        kind = record.pop("record", "account")
+        if kind == "header":
+            for key in ("patch", "account_types", "property_groups", "oauth_configs", "email_addresses", "pending_emails"):
+                if key in record:
+                    yield key, record[key]
+        elif kind == "account":
+            yield "accounts", record
+        elif kind == "deleted":
+            yield "deleted", [record]
+
+def import_json_stream(fp, user_id: int, import_mode: str = None, ndjson: bool = False) -> dict:
+    """
+    从文件流导入：分类数据（类型、属性组）按出现顺序先行导入，
+    账号逐条解析、每 IMPORT_BATCH_SIZE 条写入并提交一次，内存占用与文件大小无关
+    中途出错时已提交的批次保留，错误信息中带上已保存的数量
+    需要分类数据位于 accounts 之前（本系统导出的文件满足此顺序）
+    ndjson=True 时按 format=ndjson 的导出格式逐行解析
+    未指定 import_mode 时默认 all，增量导出（patch）默认 overwrite
+    """
+    explicit_mode = import_mode is not None
+    import_mode = import_mode or "all"
+    patch = False
+    started = time.perf_counter()
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    stats = new_import_stats()
+    type_id_map = {}
+    value_id_map = {}
+    extras = {}
+    batch = []
+    seen_accounts = False
+    committed = {"batches": 0}
+    
+    def flush(conn):
+        imported, updated, skipped, unchanged = import_accounts(conn, user_id, batch, import_mode, type_id_map, value_id_map,
+                                                     now, email_ids=email_ids)
+        stats["imported"] += imported
+        stats["updated"] += updated
+        stats["skipped"] += skipped
+        stats["unchanged"] += unchanged
+        conn.commit()
+        committed["batches"] += 1
+        batch.clear()
+        job_checkpoint(stats["imported"] + stats["updated"] + stats["skipped"] + stats["unchanged"])
+    
+    with get_db() as conn:
+        # 已有账号的邮箱只查询一次，各批次共用
+        email_ids = load_account_email_ids(conn, user_id)
+        records = iter_ndjson_records(fp) if ndjson else iter_json_object_stream(fp, stream_keys=("accounts",))
+        try:
+            for key, value in records:
+                if key == "patch":
+                    patch = bool(value)
+                    if patch and not explicit_mode:
+                        import_mode = "overwrite"
+                elif key == "deleted":
+                    if patch:
+                        stats["deleted"] += apply_deleted_accounts(conn, user_id, value, now, email_ids)
+                elif key == "accounts":
+                    seen_accounts = True
+                    batch.append(value)
+                    if len(batch) >= IMPORT_BATCH_SIZE:
+                        flush(conn)
+                elif key in ("account_types", "property_groups") and seen_accounts:
+                    raise ValueError(f"{key} 必须位于 accounts 之前")
+                elif key == "account_types":
+                    stats["imported_types"] += import_account_types(conn, user_id, value, type_id_map)
+                elif key == "property_groups":
+                    groups, values = import_property_groups(conn, user_id, value, value_id_map)
+                    stats["imported_groups"] += groups
+                    stats["imported_values"] += values
+                elif key in ("oauth_configs", "email_addresses", "pending_emails"):
+                    extras[key] = value
+            
+            if not seen_accounts and not ndjson:  # NDJSON 导出的空库没有账号行
+                raise ValueError("无效的导入数据")
+            if batch:
+                flush(conn)
+        except ValueError as e:
+            # 出错前提交的批次已经保存，不能只报“导入失败”
+            if committed["batches"]:
+                raise ValueError(f"{e}（出错前已保存 {committed['batches']} 批：{stats['imported']} 新增, "
+                                 f"{stats['updated']} 更新, {stats['skipped']} 跳过，未提交的部分已回滚）") from e
+            raise
+        
+        stats["imported_oauth"] = import_oauth_configs(conn, extras.get("oauth_configs"))
+        stats["imported_pending"] = import_pending_emails(
+            conn, user_id, extras.get("email_addresses"), extras.get("pending_emails"))
+        conn.commit()
+    
+    return import_result(stats, started)
+
+async def run_upload_import(request: Request, user_id: int, idempotency_key: Optional[str], force: bool,
+                            handler, *args) -> dict:
+    """
+    请求体先流式写入临时文件，再在线程池中以 UTF-8 文本流交给 handler(fp, user_id, *args) 处理
+    gzip 压缩的文件按魔数识别，边读边解压；按 文件内容 + 导入参数 计算摘要做幂等检查
+    """
+    import tempfile
+    
+    with tempfile.TemporaryFile() as raw:
+        hasher = hashlib.sha256()
+        async for chunk in request.stream():
+            raw.write(chunk)
+            hasher.update(chunk)
+        raw.seek(0)
+        hasher.update(json.dumps([handler.__name__, args], default=str).encode())
+        
+        fp = open_upload_text(raw)
+        try:
+            return await run_in_threadpool(run_idempotent_import, user_id, hasher.hexdigest(), idempotency_key, force,
+                                           handler, fp, user_id, *args)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"导入失败: {str(e)}")
+        finally:
+            fp.detach()
+
+@app.post("/api/import/upload")
+async def import_data_upload(request: Request, import_mode: Optional[str] = None, format: str = "json",
+                             force: bool = False, user: dict = Depends(get_current_user),
+                             idempotency_key: Optional[str] = Header(None)):
+    """
+    上传导出文件导入（请求体为原始文件内容，JSON 或 NDJSON，可 gzip 压缩）
+    请求体先流式写入临时文件，再增量解析，适合几百 MB 的大文件
+    """
+    if import_mode not in (None, "all", "skip", "overwrite"):
+        raise HTTPException(status_code=400, detail="无效的导入模式")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="不支持的导入格式")
+    return await run_upload_import(request, user['id'], idempotency_key, force,
+                                   import_json_stream, import_mode, format == "ndjson")
+
+# ==================== CSV 导入 ====================
+
+CSV_IMPORT_FIELDS = ("email", "password", "country", "customName", "type", "tags", "notes", "totp", "favorite")
+CSV_MAX_ERRORS = 100  # 结果中最多返回的错误行数
+
+# 无表头的简单格式：邮箱,密码,国家,自定义名称
+CSV_SIMPLE_COLUMNS = {"email": 0, "password": 1, "country": 2, "customName": 3}
+
+# 常见导出格式：字段 -> 候选表头（小写）
+CSV_PRESETS = {
+    "generic": {
+        "email": ["email", "邮箱", "username", "login"], "password": ["password", "密码"],
+        "country": ["country", "国家"], "customName": ["customname", "custom_name", "name", "名称"],
+        "type": ["type", "类型"], "tags": ["tags", "标签"], "notes": ["notes", "备注"],
+        "totp": ["totp", "totp_secret", "2fa"], "favorite": ["favorite", "is_favorite", "收藏"]
+    },
+    "bitwarden": {
+        "email": ["login_username"], "password": ["login_password"], "customName": ["name"],
+        "type": ["folder"], "notes": ["notes"], "totp": ["login_totp"], "favorite": ["favorite"]
+    },
+    "1password": {
+        "email": ["username"], "password": ["password"], "customName": ["title"], "tags": ["tags"],
+        "notes": ["notes", "notesplain"], "totp": ["otpauth", "one-time password"], "favorite": ["favorite"]
+    },
+    "lastpass": {
+        "email": ["username"], "password": ["password"], "customName": ["name"], "type": ["grouping"],
+        "notes": ["extra"], "totp": ["totp"], "favorite": ["fav"]
+    },
+    "keepassxc": {
+        "email": ["username"], "password": ["password"], "customName": ["title"], "type": ["group"],
+        "notes": ["notes"], "totp": ["totp"]
+    },
+    "keepass": {"email": ["login name"], "password": ["password"], "customName": ["account"], "notes": ["comments"]},
+    "chrome": {"email": ["username"], "password": ["password"], "customName": ["name"], "notes": ["note"]},
+    "firefox": {"email": ["username"], "password": ["password"], "customName": ["url"]}
+}
+
+# 自动识别用的特征表头（全部出现才算匹配），按顺序检查，更具体的格式在前
+CSV_PRESET_SIGNATURES = [
+    ("bitwarden", {"login_username", "login_password"}),
+    ("lastpass", {"url", "username", "password", "extra", "grouping"}),
+    ("1password", {"title", "username", "password", "otpauth"}),
+    ("keepassxc", {"group", "title", "username", "password"}),
+    ("keepass", {"account", "login name", "password"}),
+    ("firefox", {"url", "username", "password", "httprealm"}),
+    ("chrome", {"name", "url", "username", "password"})
+]
+
+def resolve_csv_columns(first_row: list, preset: str = None, mapping: dict = None, has_header: bool = None) -> tuple:
+    """
+    根据第一行确定列映射，返回 (字段 -> 列下标, 第一行是否为表头, 实际使用的预设)
+    mapping 的值为表头名或列下标（从 0 开始）；未指定 preset / mapping 时按表头自动识别
+    """
+    headers = [h.strip().lstrip("\ufeff").lower() for h in first_row]
+    
+    def by_names(candidates: dict) -> dict:
+        columns = {}
+        for field, names in candidates.items():
+            for name in names:
+                if name in headers:
+                    columns[field] = headers.index(name)
+                    break
+        return columns
+    
+    if mapping:
+        if all(isinstance(v, int) for v in mapping.values()):
+            return dict(mapping), bool(has_header), "custom"
+        columns = by_names({field: [str(name).strip().lower()] for field, name in mapping.items()})
+        missing = [str(mapping[field]) for field in mapping if field not in columns]
+        if missing:
+            raise ValueError(f"CSV 表头中找不到列: {', '.join(missing)}")
+        return columns, True, "custom"
+    
+    if preset == "simple" or has_header is False:
+        return dict(CSV_SIMPLE_COLUMNS), bool(has_header), "simple"
+    
+    if not preset:
+        header_set = set(headers)
+        preset = next((name for name, signature in CSV_PRESET_SIGNATURES if signature <= header_set), "generic")
+        columns = by_names(CSV_PRESETS[preset])
+        if "email" not in columns:
+            # 没有可识别的表头，按旧的无表头格式处理
+            return dict(CSV_SIMPLE_COLUMNS), False, "simple"
+        return columns, True, preset
+    
+    columns = by_names(CSV_PRESETS[preset])
+    if "email" not in columns:
+        raise ValueError(f"CSV 表头与预设 {preset} 不匹配")
+    return columns, True, preset
+
+def parse_csv_totp(value: str) -> dict:
+    """解析 CSV 中的 2FA 列：otpauth:// 链接、steam:// 密钥或 base32 密钥"""
+    if value.lower().startswith("otpauth://"):
+        parsed = parse_otpauth_uri(value)
+        if not parsed or not parsed["secret"]:
+            raise ValueError("无效的 2FA 链接")
+        problem = otp_entry_problem(parsed["type"], parsed["algorithm"])
+        if problem:
+            raise ValueError(problem)
+        return {k: parsed[k] for k in ("secret", "issuer", "type", "algorithm", "digits", "period")}
+    if value.lower().startswith("steam://"):
+        key = decode_totp_key(value[len("steam://"):])
+        if not key:
+            raise ValueError("无效的 Steam 密钥")
+        return {"secret": base64.b64encode(key).decode(), "issuer": "Steam", "type": "steam"}
+    secret = value.replace(" ", "").upper()
+    if not decode_totp_key(secret):
+        raise ValueError("无效的 2FA 密钥")
+    return {"secret": secret, "type": "totp"}
+
+def csv_row_to_account(row: list, columns: dict) -> dict:
+    """CSV 行 -> 导出格式的账号字典，账号类型以名称暂存在 type_id 中；格式错误抛出 ValueError"""
+    def get(field: str) -> str:
+        index = columns.get(field)
+        return row[index].strip() if index is not None and index < len(row) else ""
+    
+    email = get("email")
+    if not email:
+        raise ValueError("缺少邮箱")
+    acc = {
+        "email": email,
+        "password": get("password"),
+        "country": get("country") or "🌍",
+        "customName": get("customName"),
+        "notes": get("notes"),
+        "tags": [t.strip() for t in re.split(r"[,;]", get("tags")) if t.strip()],
+        "is_favorite": get("favorite").lower() in ("1", "true", "yes", "y", "是")
+    }
+    if get("type"):
+        acc["type_id"] = get("type")
+    if get("totp"):
+        acc["totp"] = parse_csv_totp(get("totp"))
+    return acc
+
+def import_csv_stream(fp, user_id: int, import_mode: str = "all", preset: str = None, mapping: dict = None,
+                      has_header: bool = None, delimiter: str = ",") -> dict:
+    """
+    逐行解析 CSV 并导入，每 IMPORT_BATCH_SIZE 条写入并提交一次，内存占用与文件大小无关
+    格式错误的行跳过并记录行号，不影响其余行；账号类型按名称匹配，不存在时自动创建
+    """
+    import csv
+    
+    if import_mode not in ("all", "skip", "overwrite"):
+        raise ValueError("无效的导入模式")
+    if preset and preset != "simple" and preset not in CSV_PRESETS:
+        raise ValueError(f"未知的预设: {preset}")
+    if mapping:
+        unknown = [field for field in mapping if field not in CSV_IMPORT_FIELDS]
+        if unknown:
+            raise ValueError(f"未知的映射字段: {', '.join(unknown)}")
+        if "email" not in mapping:
+            raise ValueError("列映射必须包含 email")
+    if len(delimiter) != 1:
+        raise ValueError("分隔符必须是单个字符")
+    
+    started = time.perf_counter()
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    stats = new_import_stats()
+    type_id_map = {}
+    errors = []
+    error_count = 0
+    batch = []
+    columns = None
+    used_preset = None
+    reader = csv.reader(fp, delimiter=delimiter)
+    
+    def add_error(message: str):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < CSV_MAX_ERRORS:
+            errors.append(f"第{reader.line_num}行: {message}")
+    
+    def flush(conn):
+        # 本批出现的新类型名先建好，再统一写入账号
+        new_types = {acc["type_id"] for acc in batch if acc.get("type_id")} - type_id_map.keys()
+        if new_types:
+            stats["imported_types"] += import_account_types(
+                conn, user_id, [{"id": name, "name": name} for name in sorted(new_types)], type_id_map)
+        imported, updated, skipped, unchanged = import_accounts(conn, user_id, batch, import_mode, type_id_map, {},
+                                                     now, email_ids=email_ids)
+        stats["imported"] += imported
+        stats["updated"] += updated
+        stats["skipped"] += skipped
+        stats["unchanged"] += unchanged
+        conn.commit()
+        batch.clear()
+        job_checkpoint(stats["imported"] + stats["updated"] + stats["skipped"] + stats["unchanged"])
+    
+    with get_db() as conn:
+        email_ids = load_account_email_ids(conn, user_id)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as e:
+                add_error(f"CSV 格式错误 ({str(e)})")
+                continue
+            
+            if not any(cell.strip() for cell in row):
+                continue
+            # 简单格式支持 # 注释行
+            if used_preset in (None, "simple") and row[0].lstrip().startswith("#"):
+                continue
+            if columns is None:
+                columns, is_header, used_preset = resolve_csv_columns(row, preset, mapping, has_header)
+                if is_header:
+                    continue
+            if used_preset == "simple" and len(row) < 2:
+                add_error("格式错误")
+                continue
+            
+            try:
+                batch.append(csv_row_to_account(row, columns))
+            except ValueError as e:
+                add_error(str(e))
+                continue
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush(conn)
+        
+        if batch:
+            flush(conn)
+    
+    result = import_result(stats, started)
+    if error_count:
+        result["message"] += f", {error_count} 行错误"
+    result.update({"count": stats["imported"], "preset": used_preset, "errors": errors, "error_count": error_count})
+    return result
+
+@app.post("/api/import-csv")
+def import_csv(data: dict, user: dict = Depends(get_current_user), idempotency_key: Optional[str] = Header(None)):
+    """
+    导入 CSV 文本：{"csv": 文本, "preset": 预设, "mapping": {字段: 表头或列下标},
+    "has_header": bool, "delimiter": ",", "import_mode": "all", "force": false}，除 csv 外均可省略
+    幂等规则同 /api/import
+    """
+    csv_text = data.get("csv", "")
+    if not csv_text:
+        raise HTTPException(status_code=400, detail="CSV内容为空")
+    
+    force = bool(data.pop("force", False))
+    try:
+        return run_idempotent_import(user['id'], request_content_hash(data), idempotency_key, force,
+                                     import_csv_stream, io.StringIO(csv_text, newline=""), user['id'],
+                                     data.get("import_mode", "all"), data.get("preset"), data.get("mapping"),
+                                     data.get("has_header"), data.get("delimiter") or ",")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"导入失败: {str(e)}")
+
+@app.post("/api/import-csv/upload")
+async def import_csv_upload(request: Request, import_mode: str = "all", preset: Optional[str] = None,
+                            mapping: Optional[str] = None, has_header: Optional[bool] = None,
+                            delimiter: str = ",", force: bool = False, user: dict = Depends(get_current_user),
+                            idempotency_key: Optional[str] = Header(None)):
+    """上传 CSV 文件导入（请求体为原始文件内容），mapping 为 JSON 字符串，其余参数同 /api/import-csv"""
+    try:
+        column_mapping = json.loads(mapping) if mapping else None
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="mapping 不是有效的 JSON")
+    return await run_upload_import(request, user['id'], idempotency_key, force, import_csv_stream,
+                                   import_mode, preset, column_mapping, has_header, delimiter)
+
+# ==================== 2FA TOTP API ====================
+
+STEAM_CHARS = "23456789BCDFGHJKMNPQRTVWXY"
+TOTP_HASH_FUNCS = {"SHA1": hashlib.sha1, "SHA256": hashlib.sha256, "SHA512": hashlib.sha512}
+
+def otp_entry_problem(otp_type: str, algorithm: str) -> Optional[str]:
+    """
+    检查令牌能否由本系统生成验证码，不能时返回原因
+    验证码始终按时间计数，HOTP（按次数计数）令牌生成的码必然不对，只能拒绝
+    """
+    if (otp_type or "").lower() == "hotp":
+        return "不支持 HOTP（计数器型）令牌"
+    if (otp_type or "").lower() != "steam" and (algorithm or "SHA1").upper() not in TOTP_HASH_FUNCS:
+        return f"不支持的算法: {algorithm}"
+    return None
+
+def decode_totp_key(secret: str, totp_type: str = "totp") -> bytes:
+    """解码 2FA 密钥（Steam 为 base64，其余为 base32），无效返回 None"""
+    try:
+        if totp_type == "steam":
+            return base64.b64decode(secret)
+        secret = secret.upper().replace(" ", "")
+        return base64.b32decode(secret + "=" * ((8 - len(secret) % 8) % 8))
+    except:
+        return None
+
+def hotp_value(key: bytes, counter: int, hash_func=hashlib.sha1) -> int:
+    """RFC 4226 动态截断，返回 31 位整数"""
+    h = hmac.new(key, struct.pack(">Q", counter), hash_func).digest()
+    offset = h[-1] & 0x0F
+    return struct.unpack(">I", h[offset:offset + 4])[0] & 0x7FFFFFFF
+
+def steam_code_from_value(value: int) -> str:
+    return "".join(STEAM_CHARS[value // (len(STEAM_CHARS) ** i) % len(STEAM_CHARS)] for i in range(5))
+
+def generate_totp(secret: str, time_offset: int = 0, digits: int = 6, period: int = 30, algorithm: str = "SHA1", at: int = None) -> str:
+    key = decode_totp_key(secret)
+    if key is None:
+        return ""
+    try:
+        counter = (int(time.time() if at is None else at) + time_offset) // period
+        value = hotp_value(key, counter, TOTP_HASH_FUNCS.get(algorithm.upper(), hashlib.sha1))
+        return str(value % (10 ** digits)).zfill(digits)
+    except:
+        return ""
+
+def generate_steam_code(secret: str, time_offset: int = 0, at: int = None) -> str:
+    key = decode_totp_key(secret, "steam")
+    if key is None:
+        return ""
+    try:
+        counter = (int(time.time() if at is None else at) + time_offset) // 30
+        return steam_code_from_value(hotp_value(key, counter))
+    except:
+        return ""
+
+def normalize_steam_entry(entry: dict, steam_encoder: bool = False) -> dict:
+    """
+    Steam 令牌以 base32 导出（otpauth 链接和身份验证器迁移二维码都是），本系统按 base64 存储 Steam 密钥，
+    验证码为 5 位 Steam 字母表；按 encoder=steam 或发行方 Steam 识别，otpauth 链接和迁移导入共用
+    """
+    if entry["type"] == "totp" and (steam_encoder or entry["issuer"].strip().lower() == "steam"):
+        key = decode_totp_key(entry["secret"])
+        if key:
+            entry.update(type="steam", secret=base64.b64encode(key).decode(), digits=5, period=30)
+    return entry
+
+def parse_otpauth_uri(uri: str) -> dict:
+    """解析 otpauth://TYPE/LABEL?PARAMS，label 和参数均做 URL 解码"""
+    try:
+        parsed = urllib.parse.urlparse(uri.strip())
+        if parsed.scheme.lower() != "otpauth" or parsed.netloc.lower() not in ("totp", "hotp"):
             return None
-        params = dict(p.split('=', 1) for p in match.group(3).split('&') if '=' in p)
-        return {
-            "type": match.group(1),
-            "label": match.group(2),
-            "secret": params.get("secret", ""),
-            "issuer": params.get("issuer", ""),
+        params = {k.lower(): v for k, v in urllib.parse.parse_qsl(parsed.query)}
+        label = urllib.parse.unquote(parsed.path.lstrip("/"))
+        # label 格式为 "Issuer:account" 或 "account"
+        label_issuer, _, account = label.rpartition(":")
+        issuer = params.get("issuer", "") or label_issuer.strip()
+        secret = params.get("secret", "").replace(" ", "").upper()
+        return normalize_steam_entry({
+            "type": parsed.netloc.lower(),
+            "label": label,
+            "account": account.strip(),
+            "secret": secret,
+            "issuer": issuer,
             "algorithm": params.get("algorithm", "SHA1").upper(),
             "digits": int(params.get("digits", 6)),
             "period": int(params.get("period", 30))
-        }
+        }, steam_encoder=params.get("encoder", "").lower() == "steam")
+    except:
+        return None
+
+def read_protobuf_varint(buf: bytes, pos: int) -> tuple:
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def iter_protobuf_fields(buf: bytes):
+    """逐个返回 (字段号, 值)，仅支持 varint / 定长 / length-delimited"""
+    pos = 0
+    while pos < len(buf):
+        tag, pos = read_protobuf_varint(buf, pos)
+        field, wire_type = tag >> 3, tag & 0x07
+        if wire_type == 0:
+            value, pos = read_protobuf_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_protobuf_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f"不支持的 protobuf wire type: {wire_type}")
+        yield field, value
+
+def parse_otpauth_migration(uri: str) -> list:
+    """
+    解析 Google 身份验证器导出的 otpauth-migration://offline?data=...
+    data 为 base64 编码的 MigrationPayload，返回与 parse_otpauth_uri 相同格式的列表
+    """
+    algorithms = {1: "SHA1", 2: "SHA256", 3: "SHA512", 4: "MD5"}
+    try:
+        parsed = urllib.parse.urlparse(uri.strip())
+        if parsed.scheme.lower() != "otpauth-migration":
+            return None
+        data = dict(urllib.parse.parse_qsl(parsed.query)).get("data", "")
+        payload = base64.b64decode(data + "=" * (-len(data) % 4))
+        
+        entries = []
+        for field, value in iter_protobuf_fields(payload):
+            if field != 1:  # otp_parameters
+                continue
+            otp = {}
+            for f, v in iter_protobuf_fields(value):
+                otp[f] = v
+            label = otp.get(2, b"").decode("utf-8", errors="ignore")
+            label_issuer, _, account = label.rpartition(":")
+            entries.append(normalize_steam_entry({
+                "type": "hotp" if otp.get(6) == 1 else "totp",
+                "label": label,
+                "account": account.strip(),
+                "secret": base64.b32encode(otp.get(1, b"")).decode().rstrip("="),
+                "issuer": otp.get(3, b"").decode("utf-8", errors="ignore") or label_issuer.strip(),
+                "algorithm": algorithms.get(otp.get(4), "SHA1"),
+                "digits": 8 if otp.get(5) == 2 else 6,
+                "period": 30
+            }))
+        return entries
     except:
         return None
 
+# 生成验证码所需的账号列，任一列变化即视为新版本配置
+TOTP_CONFIG_COLUMNS = ("totp_secret", "totp_type", "totp_algorithm", "totp_digits", "totp_period", "time_offset")
+
+# 已解码的 2FA 配置缓存: {(user_id, account_id): (版本, 配置)}
+# 命中时跳过 Fernet 解密和 base32 解码；配置内的 codes 记录本窗口及之后已算出的验证码
+totp_config_cache: Dict[tuple, tuple] = {}
+totp_cache_lock = threading.Lock()
+TOTP_CACHE_MAX = 1024
+
+def invalidate_totp_cache(user_id: int, account_ids: list):
+    """账号或其 2FA 被删除时清除缓存的密钥"""
+    with totp_cache_lock:
+        for account_id in account_ids:
+            totp_config_cache.pop((user_id, account_id), None)
+
+def totp_config_from_row(row, cache_key: tuple = None) -> dict:
+    """
+    从账号记录解析 2FA 配置（含解码后的密钥），未配置返回 None
+    传入 cache_key=(user_id, account_id) 时按配置版本缓存
+    """
+    if not row["totp_secret"]:
+        if cache_key is not None:
+            invalidate_totp_cache(cache_key[0], [cache_key[1]])
+        return None
+    
+    version = tuple(row[col] for col in TOTP_CONFIG_COLUMNS)
+    if cache_key is not None:
+        cached = totp_config_cache.get(cache_key)
+        if cached and cached[0] == version:
+            return cached[1]
+    
+    secret = decrypt_password(row["totp_secret"])
+    if not secret:
+        return None
+    totp_type = row["totp_type"] or "totp"
+    config = {
+        "type": totp_type,
+        "key": decode_totp_key(secret, totp_type),
+        "hash_func": TOTP_HASH_FUNCS.get((row["totp_algorithm"] or "SHA1").upper(), hashlib.sha1),
+        "digits": row["totp_digits"] or 6,
+        "period": 30 if totp_type == "steam" else (row["totp_period"] or 30),
+        "time_offset": row["time_offset"] or 0,
+        "codes": {}
+    }
+    
+    if cache_key is not None:
+        with totp_cache_lock:
+            if cache_key not in totp_config_cache and len(totp_config_cache) >= TOTP_CACHE_MAX:
+                totp_config_cache.pop(next(iter(totp_config_cache)))
+            totp_config_cache[cache_key] = (version, config)
+    return config
+
+def totp_code_at(config: dict, at: int) -> str:
+    """计算指定时刻（服务器 epoch 秒）的验证码，同一窗口只计算一次"""
+    if config["key"] is None:
+        return ""
+    counter = (at + config["time_offset"]) // config["period"]
+    codes = config["codes"]
+    code = codes.get(counter)
+    if code is not None:
+        return code
+    
+    value = hotp_value(config["key"], counter, config["hash_func"])
+    if config["type"] == "steam":
+        code = steam_code_from_value(value)
+    else:
+        code = str(value % (10 ** config["digits"])).zfill(config["digits"])
+    
+    # 已过去的窗口作废
+    current = (int(time.time()) + config["time_offset"]) // config["period"]
+    with totp_cache_lock:
+        for old in [c for c in codes if c < current]:
+            del codes[old]
+        codes[counter] = code
+    return code
+
 @app.post("/api/accounts/{account_id}/totp")
 def set_account_totp(account_id: int, data: TOTPCreate, user: dict = Depends(get_current_user)):
+    problem = otp_entry_problem(data.totp_type, data.algorithm)
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
     with get_db() as conn:
         row = conn.execute(f"SELECT id FROM user_{user['id']}_accounts WHERE id = ?", (account_id,)).fetchone()
         if not row:
@@ -1552,31 +2837,61 @@ def get_account_totp(account_id: int, user: dict = Depends(get_current_user)):
         "time_offset": row["time_offset"]
     }
 
+# 一次最多返回的后续验证码窗口数
+TOTP_MAX_WINDOWS = 10
+
 @app.get("/api/accounts/{account_id}/totp/generate")
-def generate_totp_code(account_id: int, user: dict = Depends(get_current_user)):
+def generate_totp_code(account_id: int, response: Response, windows: int = 0, user: dict = Depends(get_current_user),
+                       if_none_match: Optional[str] = Header(None)):
+    """
+    生成当前验证码
+    windows > 0 时额外返回后续 N 个周期的验证码及其有效时间边界，
+    客户端可本地倒计时，每 N 个周期才需要请求一次
+    """
     with get_db() as conn:
-        row = conn.execute(f"""SELECT totp_secret, totp_type, totp_algorithm, totp_digits, totp_period, time_offset 
-            FROM user_{user['id']}_accounts WHERE id = ?""", (account_id,)).fetchone()
+        row = conn.execute(f"SELECT {', '.join(TOTP_CONFIG_COLUMNS)} FROM user_{user['id']}_accounts WHERE id = ?",
+            (account_id,)).fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="账号不存在")
     
-    secret = decrypt_password(row["totp_secret"]) if row["totp_secret"] else None
-    if not secret:
+    config = totp_config_from_row(row, cache_key=(user['id'], account_id))
+    if not config:
         raise HTTPException(status_code=404, detail="未配置 2FA")
     
-    totp_type = row["totp_type"] or "totp"
-    time_offset = row["time_offset"] or 0
-    period = row["totp_period"] or 30
+    period = config["period"]
+    now = int(time.time())
+    remaining = period - ((now + config["time_offset"]) % period)
+    window_start = now + remaining - period
+    
+    result = {"code": totp_code_at(config, now), "type": config["type"], "remaining": remaining, "period": period}
+    
+    if windows > 0:
+        # 当前窗口 + 后续 N 个窗口，时间边界均为服务器 epoch 秒
+        result["server_time"] = now
+        result["codes"] = [
+            {
+                "code": totp_code_at(config, start),
+                "valid_from": start,
+                "valid_until": start + period
+            }
+            for start in (window_start + i * period for i in range(min(windows, TOTP_MAX_WINDOWS) + 1))
+        ]
     
-    if totp_type == "steam":
-        code = generate_steam_code(secret, time_offset)
-    else:
-        code = generate_totp(secret, time_offset=time_offset, digits=row["totp_digits"] or 6,
-            period=period, algorithm=row["totp_algorithm"] or "SHA1")
+    if windows > 0:
+        # 带 server_time 供客户端校准时钟，不能复用
+        response.headers["Cache-Control"] = "no-store"
+        return result
     
-    remaining = period - ((int(time.time()) + time_offset) % period)
+    # 每次都要重新验证（no-cache）：ETag 由 2FA 配置和当前周期决定，同一周期内配置没变返回 304，
+    # 修改或更换密钥后 ETag 随之改变，不会继续用缓存里的旧验证码
+    version = hashlib.sha256(json.dumps([user['id'], account_id, list(row), window_start]).encode()).hexdigest()[:32]
+    etag = f'W/"{version}"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.headers["ETag"] = etag
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
     
-    return {"code": code, "type": totp_type, "remaining": remaining, "period": period}
+    return result
 
 @app.delete("/api/accounts/{account_id}/totp")
 def delete_account_totp(account_id: int, user: dict = Depends(get_current_user)):
@@ -1585,6 +2900,7 @@ def delete_account_totp(account_id: int, user: dict = Depends(get_current_user))
             SET totp_secret='', totp_issuer='', totp_type='', backup_codes='[]', updated_at=?
             WHERE id=?""", (datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'), account_id))
         conn.commit()
+    invalidate_totp_cache(user['id'], [account_id])
     return {"message": "2FA 配置已删除"}
 
 @app.post("/api/accounts/{account_id}/totp/parse")
@@ -1592,6 +2908,9 @@ def parse_totp_uri(account_id: int, data: dict, user: dict = Depends(get_current
     parsed = parse_otpauth_uri(data.get("uri", ""))
     if not parsed:
         raise HTTPException(status_code=400, detail="无效的 otpauth URI")
+    problem = otp_entry_problem(parsed["type"], parsed["algorithm"])
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
     with get_db() as conn:
         conn.execute(f"""UPDATE user_{user['id']}_accounts 
             SET totp_secret=?, totp_issuer=?, totp_type=?, totp_algorithm=?, totp_digits=?, totp_period=?, updated_at=?
@@ -1601,6 +2920,232 @@ def parse_totp_uri(account_id: int, data: dict, user: dict = Depends(get_current
         conn.commit()
     return {"message": "2FA 配置已从 URI 导入", "parsed": {k: v for k, v in parsed.items() if k != "secret"}}
 
+@app.post("/api/totp/import")
+def import_totp_uris(data: TOTPImport, user: dict = Depends(get_current_user)):
+    """
+    批量导入 otpauth URI，按 邮箱 / 自定义名称 匹配账号，
+    多个账号同邮箱时再用 issuer 与账号类型名区分；所有密钥在一个事务中写入
+    无效条目只返回序号和 label，URI 中含密钥，不回传
+    """
+    entries, invalid = [], []
+    for index, uri in enumerate(data.uris):
+        if uri.strip().lower().startswith("otpauth-migration:"):
+            parsed = parse_otpauth_migration(uri)
+            if parsed is None:
+                invalid.append({"index": index, "label": "", "reason": "无效的迁移链接"})
+                continue
+        else:
+            parsed = parse_otpauth_uri(uri)
+            if not parsed or not parsed["secret"]:
+                invalid.append({"index": index, "label": parsed["label"] if parsed else "", "reason": "无效的 otpauth URI"})
+                continue
+            parsed = [parsed]
+        for entry in parsed:
+            problem = otp_entry_problem(entry["type"], entry["algorithm"])
+            if problem:
+                invalid.append({"index": index, "label": entry["label"], "reason": problem})
+            else:
+                entries.append(entry)
+    
+    with get_db() as conn:
+        rows = conn.execute(f"""
+            SELECT a.id, a.email, a.custom_name, a.totp_secret, t.name AS type_name
+            FROM user_{user['id']}_accounts a
+            LEFT JOIN user_{user['id']}_account_types t ON a.type_id = t.id
+        """).fetchall()
+    
+    # 匹配索引：邮箱 / 自定义名称（小写） -> 账号列表
+    by_email, by_name = {}, {}
+    for row in rows:
+        if row["email"]:
+            by_email.setdefault(row["email"].strip().lower(), []).append(row)
+        if row["custom_name"]:
+            by_name.setdefault(row["custom_name"].strip().lower(), []).append(row)
+    
+    matched, unmatched, skipped = [], [], []
+    assigned = set()
+    for entry in entries:
+        info = {"label": entry["label"], "issuer": entry["issuer"], "type": entry["type"]}
+        account = entry["account"].lower()
+        issuer = entry["issuer"].lower()
+        candidates = by_email.get(account) or by_name.get(account) or by_name.get(entry["label"].lower()) or []
+        if len(candidates) > 1 and issuer:
+            narrowed = [r for r in candidates if r["type_name"] and
+                        (r["type_name"].lower() in issuer or issuer in r["type_name"].lower())]
+            candidates = narrowed or candidates
+        
+        if not candidates:
+            unmatched.append({**info, "reason": "未找到匹配账号"})
+        elif len(candidates) > 1:
+            unmatched.append({**info, "reason": "匹配到多个账号", "account_ids": [r["id"] for r in candidates]})
+        elif candidates[0]["id"] in assigned:
+            unmatched.append({**info, "reason": "账号已被其他条目匹配", "account_id": candidates[0]["id"]})
+        elif candidates[0]["totp_secret"] and not data.overwrite:
+            skipped.append({**info, "account_id": candidates[0]["id"], "reason": "已配置 2FA"})
+        else:
+            assigned.add(candidates[0]["id"])
+            matched.append((candidates[0]["id"], entry))
+    
+    if matched and not data.dry_run:
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        # 先在事务外完成全部加密，写锁只覆盖一次 executemany
+        secrets_encrypted = encrypt_many([entry["secret"] for _, entry in matched])
+        params = [
+            (encrypted, entry["issuer"] or entry["label"], entry["type"],
+             entry["algorithm"], entry["digits"], entry["period"], now, account_id)
+            for (account_id, entry), encrypted in zip(matched, secrets_encrypted)
+        ]
+        with get_db() as conn:
+            conn.executemany(f"""UPDATE user_{user['id']}_accounts 
+                SET totp_secret=?, totp_issuer=?, totp_type=?, totp_algorithm=?, totp_digits=?, totp_period=?, updated_at=?
+                WHERE id=?""", params)
+            conn.commit()
+    
+    return {
+        "message": f"{'预览' if data.dry_run else '导入完成'}：{len(matched)} 匹配, {len(skipped)} 跳过, {len(unmatched)} 未匹配, {len(invalid)} 无效",
+        "imported": 0 if data.dry_run else len(matched),
+        "matched": [{"account_id": account_id, "label": e["label"], "issuer": e["issuer"], "type": e["type"]} for account_id, e in matched],
+        "skipped": skipped,
+        "unmatched": unmatched,
+        "invalid": invalid
+    }
+
+# ==================== 2FA 实时推送 (SSE) ====================
+
+# 单个 SSE 连接最多订阅的账号数
+TOTP_STREAM_MAX_IDS = 50
+
+def load_totp_config(user_id: int, account_id: int) -> dict:
+    """读取账号的 2FA 配置，不存在或未配置返回 None"""
+    with get_db() as conn:
+        row = conn.execute(f"SELECT {', '.join(TOTP_CONFIG_COLUMNS)} FROM user_{user_id}_accounts WHERE id = ?",
+            (account_id,)).fetchone()
+    if not row:
+        invalidate_totp_cache(user_id, [account_id])
+        return None
+    return totp_config_from_row(row, cache_key=(user_id, account_id))
+
+class TOTPStreamHub:
+    """
+    2FA 推送调度器
+    同一 (用户, 账号) 只有一个调度任务，每个周期只计算一次验证码，
+    再广播给所有订阅的连接（多个标签页共享）；两次周期边界之间任务处于 sleep，不占资源
+    """
+    
+    def __init__(self):
+        self.channels: Dict[tuple, Dict] = {}
+    
+    def subscribe(self, user_id: int, account_id: int, queue: "asyncio.Queue"):
+        key = (user_id, account_id)
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = {"queues": set(), "last": None}
+            self.channels[key] = channel
+            channel["task"] = asyncio.create_task(self._run(key, channel))
+        channel["queues"].add(queue)
+        # 新订阅者立即收到当前周期的验证码
+        if channel["last"]:
+            queue.put_nowait(channel["last"])
+    
+    def unsubscribe(self, user_id: int, account_id: int, queue: "asyncio.Queue"):
+        key = (user_id, account_id)
+        channel = self.channels.get(key)
+        if not channel or queue not in channel["queues"]:
+            return
+        channel["queues"].discard(queue)
+        if not channel["queues"]:
+            channel["task"].cancel()
+            del self.channels[key]
+    
+    def _broadcast(self, channel: Dict, payload: dict):
+        channel["last"] = payload
+        for queue in channel["queues"]:
+            queue.put_nowait(payload)
+    
+    async def _run(self, key: tuple, channel: Dict):
+        user_id, account_id = key
+        while True:
+            # 每个周期重新读取配置，修改 2FA / 时间偏移后下一周期即生效
+            try:
+                config = await asyncio.to_thread(load_totp_config, user_id, account_id)
+            except Exception as e:
+                print(f"2FA 推送读取配置失败 (账号 {account_id}): {e}")
+                config = None
+            if not config:
+                self._broadcast(channel, {"id": account_id, "error": "未配置 2FA"})
+                # 通知订阅者该账号的推送已结束，连接上没有其他账号时据此关闭响应
+                for queue in channel["queues"]:
+                    queue.put_nowait({"id": account_id, "end": True})
+                # 移出调度表，之后的订阅会重新尝试读取
+                if self.channels.get(key) is channel:
+                    del self.channels[key]
+                return
+            
+            now = time.time()
+            at = int(now)
+            period = config["period"]
+            remaining = period - ((at + config["time_offset"]) % period)
+            self._broadcast(channel, {
+                "id": account_id,
+                "code": totp_code_at(config, at),
+                "type": config["type"],
+                "period": period,
+                "remaining": remaining,
+                "server_time": at,
+                "valid_from": at + remaining - period,
+                "valid_until": at + remaining
+            })
+            # 睡到下一个周期边界
+            await asyncio.sleep(max(at + remaining - now, 0) + 0.05)
+
+totp_stream_hub = TOTPStreamHub()
+
+@app.post("/api/totp/stream-ticket")
+def create_stream_ticket(user: dict = Depends(get_current_user)):
+    """签发 SSE 连接票据，一次性使用，有效期 STREAM_TICKET_TTL 秒"""
+    return {"ticket": issue_stream_ticket(user), "expires_in": STREAM_TICKET_TTL}
+
+@app.get("/api/totp/stream")
+async def stream_totp_codes(ids: str, user: dict = Depends(get_stream_user)):
+    """
+    SSE 推送验证码：每个订阅账号在周期边界推送一条 code 事件
+    ids 为逗号分隔的账号 ID
+    """
+    try:
+        account_ids = list(dict.fromkeys(int(i) for i in ids.split(",") if i.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的账号 ID")
+    if not account_ids:
+        raise HTTPException(status_code=400, detail="没有选择账号")
+    if len(account_ids) > TOTP_STREAM_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"最多同时订阅 {TOTP_STREAM_MAX_IDS} 个账号")
+    
+    user_id = user['id']
+    
+    async def event_stream():
+        queue = asyncio.Queue()
+        for account_id in account_ids:
+            totp_stream_hub.subscribe(user_id, account_id, queue)
+        active = set(account_ids)
+        try:
+            yield "retry: 3000\n\n"
+            while active:
+                payload = await queue.get()
+                if payload.get("end"):
+                    # 该账号已停止推送，全部结束后关闭响应，避免连接一直挂起
+                    active.discard(payload["id"])
+                    continue
+                event = "error" if "error" in payload else "code"
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        finally:
+            for account_id in account_ids:
+                totp_stream_hub.unsubscribe(user_id, account_id, queue)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # 关闭 nginx 缓冲，事件立即送达
+    })
+
 # ==================== 备份 API ====================
 
 @app.post("/api/backup")
@@ -2064,11 +3609,161 @@ class OAuthConfigSave(BaseModel):
 # 存储OAuth状态（生产环境应用Redis）
 oauth_states: Dict[str, Dict] = {}
 
-# IMAP 请求频率限制（防止QQ等邮箱封号）
-# 格式: {email_address: last_fetch_timestamp}
-imap_last_fetch: Dict[str, float] = {}
+# IMAP 登录频率限制（防止QQ等邮箱封号），连接由 IMAPConnectionPool 复用，只有重连才受限
+# 格式: {email_address: last_login_timestamp}
+imap_last_login: Dict[str, float] = {}
 IMAP_MIN_INTERVAL = 60  # 最少间隔60秒
 
+# 出站 HTTPS 连接池（Gmail / Graph / OAuth 共用）
+HTTP_TIMEOUT = 10
+HTTP_MAX_PER_HOST = 8  # 每个主机的并发连接上限
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.5  # 重试退避基数（秒），每次翻倍
+HTTP_IDLE_TIMEOUT = 60  # 空闲超过这么久的 keep-alive 连接不再复用
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+class HTTPClientPool:
+    """
+    出站 HTTPS 连接池：Google、Microsoft Graph 和 OAuth 接口共用，按主机复用 keep-alive 连接，
+    省掉每次请求的 TCP + TLS 握手；每个主机的并发连接数受 HTTP_MAX_PER_HOST 限制
+    连接错误、429 和 5xx 按指数退避重试；非幂等请求只在建连失败（请求还没发出）或复用的连接已被服务器关闭时重试，
+    retry_stale=False 的请求连后一种重试也不做，改用新建的连接，见 request
+    route() 可把某个主机指向本地替身服务器，测试时不访问真实接口；
+    也可用环境变量 HTTP_ROUTES="主机=http://127.0.0.1:8001,..." 配置
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle: Dict[tuple, list] = {}  # (scheme, host, port) -> [(连接, 归还时间)]
+        self.slots: Dict[tuple, threading.BoundedSemaphore] = {}
+        self.routes: Dict[str, str] = {}
+        for item in os.environ.get("HTTP_ROUTES", "").split(","):
+            host, _, base_url = item.partition("=")
+            if host.strip() and base_url.strip():
+                self.route(host.strip(), base_url.strip())
+    
+    def route(self, host: str, base_url: str = None):
+        """把发往 host 的请求改发到 base_url（协议 + 主机 + 端口），base_url 为空时取消"""
+        if base_url:
+            self.routes[host] = base_url.rstrip('/')
+        else:
+            self.routes.pop(host, None)
+    
+    def slot(self, key: tuple) -> threading.BoundedSemaphore:
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(HTTP_MAX_PER_HOST)
+            return self.slots[key]
+    
+    def acquire(self, key: tuple, timeout: float, reuse: bool = True) -> tuple:
+        """取一条空闲连接，没有或 reuse=False 时新建；返回 (连接, 是否复用)"""
+        import http.client
+        
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key, []) if reuse else []
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at < HTTP_IDLE_TIMEOUT:
+                    conn.timeout = timeout
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        scheme, host, port = key
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(host, port, timeout=timeout), False
+    
+    def release(self, key: tuple, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < HTTP_MAX_PER_HOST:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+    
+    def request(self, method: str, url: str, headers: dict = None, body: bytes = None,
+                timeout: float = HTTP_TIMEOUT, idempotent: bool = None, retry_stale: bool = True) -> tuple:
+        """
+        发送请求，返回 (状态码, 响应头, 响应体)；状态码 >= 400 抛出 urllib.error.HTTPError，
+        连接失败或响应体解压失败抛出 urllib.error.URLError，与 urllib.request.urlopen 的错误处理保持一致
+        retry_stale=False 用于绝不能发送两次的请求（授权码换 token、refresh_token 刷新等 token 接口 POST）：服务器可能已处理请求
+        才断开连接，因此不做断连重试，并且不复用空闲连接，避免一开始就撞上已关闭的连接
+        """
+        import http.client
+        import gzip
+        import random
+        import zlib
+        import urllib.error
+        
+        target = urllib.parse.urlsplit(url)
+        if target.hostname in self.routes:
+            base = urllib.parse.urlsplit(self.routes[target.hostname])
+            target = target._replace(scheme=base.scheme, netloc=base.netloc)
+        key = (target.scheme, target.hostname, target.port or (443 if target.scheme == 'https' else 80))
+        path = (target.path or '/') + (f'?{target.query}' if target.query else '')
+        headers = {'Accept-Encoding': 'gzip', **(headers or {})}
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        
+        attempt = 0
+        while True:
+            error = None
+            retry_after = None
+            with self.slot(key):
+                conn, reused = self.acquire(key, timeout, reuse=retry_stale)
+                sent = False
+                try:
+                    if conn.sock is None:
+                        conn.connect()  # 建连（TCP + TLS）失败时请求还没发出
+                    sent = True
+                    conn.request(method, path, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    error = e
+                else:
+                    if resp.will_close:
+                        conn.close()
+                    else:
+                        self.release(key, conn)
+            
+            if error is not None:
+                # 复用的连接可能已被服务器关闭，请求没有送达，任何方法都可以立即重试
+                stale = reused and isinstance(error, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+                if stale and attempt == 0 and retry_stale:
+                    attempt += 1
+                    continue
+                # 非幂等请求只在连接都没建立、请求肯定没发出时重试
+                if (sent and not idempotent) or attempt >= HTTP_RETRIES:
+                    raise urllib.error.URLError(error)
+            else:
+                if resp.getheader('Content-Encoding') == 'gzip':
+                    try:
+                        data = gzip.decompress(data)
+                    except (OSError, EOFError, zlib.error) as e:
+                        raise urllib.error.URLError(f"响应解压失败: {e}")
+                if resp.status < 400:
+                    return resp.status, resp.headers, data
+                if not (idempotent and (resp.status == 429 or resp.status >= 500) and attempt < HTTP_RETRIES):
+                    raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(data))
+                retry_after = resp.getheader('Retry-After')
+            
+            delay = HTTP_BACKOFF * (2 ** attempt) * (1 + random.random() / 2)
+            if retry_after and retry_after.isdigit():
+                delay = min(max(delay, int(retry_after)), 30)
+            attempt += 1
+            time.sleep(delay)
+
+http_pool = HTTPClientPool()
+
+def http_json(method: str, url: str, headers: dict = None, body: bytes = None, idempotent: bool = None,
+              retry_stale: bool = True):
+    """通过连接池发请求并解析 JSON 响应"""
+    return json.loads(http_pool.request(method, url, headers, body, idempotent=idempotent,
+                                        retry_stale=retry_stale)[2].decode())
+
 @app.get("/api/emails")
 def get_emails(user: dict = Depends(get_current_user)):
     """获取已授权和待授权邮箱列表"""
@@ -2189,9 +3884,14 @@ def save_oauth_config(data: OAuthConfigSave, user: dict = Depends(get_current_us
             VALUES (?, ?, ?)
         """, (provider, data.client_id, encrypted_secret))
         conn.commit()
+    oauth_client_cache.pop(provider, None)
     
     return {"success": True}
 
+# OAuth 应用凭证缓存: {provider: ((client_id, client_secret), 读取时间)}
+oauth_client_cache: Dict[str, tuple] = {}
+OAUTH_CLIENT_CACHE_TTL = 300  # 导入或恢复备份改了配置，最迟这么久后生效
+
 def get_oauth_credentials(provider: str):
     """获取OAuth凭证（优先环境变量，其次数据库）"""
     if provider == 'gmail':
@@ -2205,7 +3905,12 @@ def get_oauth_credentials(provider: str):
         if client_id and client_secret:
             return client_id, client_secret
     
-    # 从数据库获取
+    # 从数据库获取（解密结果缓存一段时间，token 刷新不必每次查库解密）
+    cached = oauth_client_cache.get(provider)
+    if cached and time.time() - cached[1] < OAUTH_CLIENT_CACHE_TTL:
+        return cached[0]
+    
+    credentials = (None, None)
     with get_db() as conn:
         try:
             cursor = conn.execute("SELECT client_id, client_secret FROM oauth_configs WHERE provider = ?", (provider,))
@@ -2213,11 +3918,12 @@ def get_oauth_credentials(provider: str):
             if row:
                 client_id = row["client_id"]
                 client_secret = decrypt_password(row["client_secret"])
-                return client_id, client_secret
+                credentials = (client_id, client_secret)
         except:
             pass
     
-    return None, None
+    oauth_client_cache[provider] = (credentials, time.time())
+    return credentials
 
 @app.post("/api/emails/oauth/start")
 def start_oauth(data: EmailOAuthStart, request: Request, user: dict = Depends(get_current_user)):
@@ -2310,8 +4016,7 @@ def oauth_callback(code: str = None, state: str = None, error: str = None):
         return JSONResponse(content={"status": "error", "message": "OAuth凭证丢失"})
     
     try:
-        import urllib.request
-        import urllib.parse
+        import urllib.error
         
         # 使用授权时保存的 redirect_uri
         redirect_uri = state_data.get('redirect_uri') or os.environ.get('OAUTH_REDIRECT_URI', 'http://localhost:9111/api/emails/oauth/callback')
@@ -2327,12 +4032,8 @@ def oauth_callback(code: str = None, state: str = None, error: str = None):
                 "grant_type": "authorization_code"
             }).encode()
             
-            req = urllib.request.Request(token_url, data=token_data, method='POST')
-            req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-            
             try:
-                with urllib.request.urlopen(req, timeout=10) as resp:
-                    token_resp = json.loads(resp.read().decode())
+                token_resp = http_json('POST', token_url, FORM_HEADERS, token_data, retry_stale=False)
             except urllib.error.HTTPError as e:
                 error_body = e.read().decode() if e.fp else ""
                 oauth_states[state]["status"] = "error"
@@ -2349,12 +4050,8 @@ def oauth_callback(code: str = None, state: str = None, error: str = None):
             
             # 获取用户邮箱 - 使用 Gmail API
             profile_url = "https://gmail.googleapis.com/gmail/v1/users/me/profile"
-            req = urllib.request.Request(profile_url)
-            req.add_header('Authorization', f'Bearer {access_token}')
-            
             try:
-                with urllib.request.urlopen(req, timeout=10) as resp:
-                    profile = json.loads(resp.read().decode())
+                profile = http_json('GET', profile_url, {'Authorization': f'Bearer {access_token}'})
             except urllib.error.HTTPError as e:
                 error_body = e.read().decode() if e.fp else ""
                 oauth_states[state]["status"] = "error"
@@ -2368,6 +4065,7 @@ def oauth_callback(code: str = None, state: str = None, error: str = None):
                 credentials = json.dumps({
                     "access_token": access_token,
                     "refresh_token": refresh_token,
+                    "expires_at": oauth_expires_at(token_resp),
                     "token_type": token_resp.get('token_type'),
                     "expires_in": token_resp.get('expires_in')
                 })
@@ -2378,6 +4076,7 @@ def oauth_callback(code: str = None, state: str = None, error: str = None):
                     VALUES (?, 'gmail', 'active', ?)
                 """, (email, encrypted_creds))
                 conn.commit()
+                email_poller.reload()
             
             # 更新state状态
             oauth_states[state]["status"] = "success"
@@ -2408,29 +4107,22 @@ def oauth_callback(code: str = None, state: str = None, error: str = None):
                 "grant_type": "authorization_code"
             }).encode()
             
-            req = urllib.request.Request(token_url, data=token_data, method='POST')
-            req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-            
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                token_resp = json.loads(resp.read().decode())
+            token_resp = http_json('POST', token_url, FORM_HEADERS, token_data, retry_stale=False)
             
             access_token = token_resp.get('access_token')
             refresh_token = token_resp.get('refresh_token')
             
             # 获取用户邮箱
             profile_url = "https://graph.microsoft.com/v1.0/me"
-            req = urllib.request.Request(profile_url)
-            req.add_header('Authorization', f'Bearer {access_token}')
-            
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                profile = json.loads(resp.read().decode())
+            profile = http_json('GET', profile_url, {'Authorization': f'Bearer {access_token}'})
             
             email = profile.get('mail') or profile.get('userPrincipalName')
             
             with get_db() as conn:
                 credentials = json.dumps({
                     "access_token": access_token,
-                    "refresh_token": refresh_token
+                    "refresh_token": refresh_token,
+                    "expires_at": oauth_expires_at(token_resp)
                 })
                 encrypted_creds = encrypt_password(credentials)
                 
@@ -2439,6 +4131,7 @@ def oauth_callback(code: str = None, state: str = None, error: str = None):
                     VALUES (?, 'outlook', 'active', ?)
                 """, (email, encrypted_creds))
                 conn.commit()
+                email_poller.reload()
             
             oauth_states[state]["status"] = "success"
             oauth_states[state]["email"] = email
@@ -2512,22 +4205,14 @@ def oauth_callback_manual(data: ManualCallbackData, user: dict = Depends(get_cur
                 "grant_type": "authorization_code"
             }).encode()
             
-            req = urllib.request.Request(token_url, data=token_data, method='POST')
-            req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-            
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                token_resp = json.loads(resp.read().decode())
+            token_resp = http_json('POST', token_url, FORM_HEADERS, token_data, retry_stale=False)
             
             access_token = token_resp.get('access_token')
             refresh_token = token_resp.get('refresh_token')
             
             # 获取用户邮箱
             profile_url = "https://www.googleapis.com/oauth2/v2/userinfo"
-            req = urllib.request.Request(profile_url)
-            req.add_header('Authorization', f'Bearer {access_token}')
-            
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                profile = json.loads(resp.read().decode())
+            profile = http_json('GET', profile_url, {'Authorization': f'Bearer {access_token}'})
             
             email = profile.get('email')
             
@@ -2536,6 +4221,7 @@ def oauth_callback_manual(data: ManualCallbackData, user: dict = Depends(get_cur
                 credentials = json.dumps({
                     "access_token": access_token,
                     "refresh_token": refresh_token,
+                    "expires_at": oauth_expires_at(token_resp),
                     "token_type": token_resp.get('token_type'),
                     "expires_in": token_resp.get('expires_in')
                 })
@@ -2546,6 +4232,7 @@ def oauth_callback_manual(data: ManualCallbackData, user: dict = Depends(get_cur
                     VALUES (?, 'gmail', 'active', ?)
                 """, (email, encrypted_creds))
                 conn.commit()
+                email_poller.reload()
             
             return {"status": "success", "email": email}
             
@@ -2560,29 +4247,22 @@ def oauth_callback_manual(data: ManualCallbackData, user: dict = Depends(get_cur
                 "grant_type": "authorization_code"
             }).encode()
             
-            req = urllib.request.Request(token_url, data=token_data, method='POST')
-            req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-            
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                token_resp = json.loads(resp.read().decode())
+            token_resp = http_json('POST', token_url, FORM_HEADERS, token_data, retry_stale=False)
             
             access_token = token_resp.get('access_token')
             refresh_token = token_resp.get('refresh_token')
             
             # 获取用户邮箱
             profile_url = "https://graph.microsoft.com/v1.0/me"
-            req = urllib.request.Request(profile_url)
-            req.add_header('Authorization', f'Bearer {access_token}')
-            
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                profile = json.loads(resp.read().decode())
+            profile = http_json('GET', profile_url, {'Authorization': f'Bearer {access_token}'})
             
             email = profile.get('mail') or profile.get('userPrincipalName')
             
             with get_db() as conn:
                 credentials = json.dumps({
                     "access_token": access_token,
-                    "refresh_token": refresh_token
+                    "refresh_token": refresh_token,
+                    "expires_at": oauth_expires_at(token_resp)
                 })
                 encrypted_creds = encrypt_password(credentials)
                 
@@ -2591,6 +4271,7 @@ def oauth_callback_manual(data: ManualCallbackData, user: dict = Depends(get_cur
                     VALUES (?, 'outlook', 'active', ?)
                 """, (email, encrypted_creds))
                 conn.commit()
+                email_poller.reload()
             
             return {"status": "success", "email": email}
             
@@ -2636,6 +4317,7 @@ def add_imap_email(data: EmailIMAPAdd, user: dict = Depends(get_current_user)):
                 VALUES (?, ?, 'active', ?)
             """, (data.email, data.provider, encrypted_creds))
             conn.commit()
+            email_poller.reload()
         
         return {"success": True, "message": f"成功添加 {data.email}"}
         
@@ -2651,7 +4333,10 @@ def remove_email(email_id: int, user: dict = Depends(get_current_user)):
     
     with get_db() as conn:
         conn.execute(f"DELETE FROM user_{user_id}_emails WHERE id = ?", (email_id,))
+        conn.execute(f"DELETE FROM user_{user_id}_mailbox_state WHERE email_id = ?", (email_id,))
+        conn.execute(f"DELETE FROM user_{user_id}_seen_messages WHERE email_id = ?", (email_id,))
         conn.commit()
+    email_poller.reload()
     
     return {"success": True}
 
@@ -2688,522 +4373,1471 @@ def get_verification_codes(user: dict = Depends(get_current_user)):
     
     return {"codes": codes}
 
-def extract_verification_code(text: str) -> tuple:
-    """从文本中提取验证码，返回 (code, service)"""
-    import re
-    
-    # 常见验证码模式 - 按优先级排序（先匹配带服务名的，再匹配通用格式）
-    patterns = [
-        # 1. 带服务名的模式（优先识别来源）
-        (r'(?:Google|谷歌).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Google'),
-        (r'Email verification code[：:\s]*(\d{4,6})', 'Google'),  # Google 专用格式
-        (r'(?:Microsoft|微软).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Microsoft'),
-        (r'(?:Apple|苹果).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Apple'),
-        (r'(?:Amazon|亚马逊).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Amazon'),
-        (r'(?:Facebook|脸书|Meta).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Facebook'),
-        (r'(?:Twitter|推特|X).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Twitter'),
-        (r'(?:LinkedIn).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'LinkedIn'),
-        (r'(?:GitHub).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'GitHub'),
-        (r'(?:Discord).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'Discord'),
-        (r'(?:Telegram).*?(?:code|验证码)[：:\s]*(\d{5,6})', 'Telegram'),
-        (r'(?:WhatsApp).*?(?:code|验证码)[：:\s]*(\d{4,6})', 'WhatsApp'),
-        (r'(?:支付宝|Alipay).*?(?:code|验证码)[：:\s]*(\d{4,6})', '支付宝'),
-        (r'(?:微信|WeChat).*?(?:code|验证码)[：:\s]*(\d{4,6})', '微信'),
-        (r'(?:淘宝|Taobao).*?(?:code|验证码)[：:\s]*(\d{4,6})', '淘宝'),
-        (r'(?:京东|JD).*?(?:code|验证码)[：:\s]*(\d{4,6})', '京东'),
-        (r'(?:Steam).*?(?:code|验证码)[：:\s]*(\d{5})', 'Steam'),
-        
-        # 2. 通用验证码格式（无法识别来源时使用）
-        (r'(\d{4,6})\s*(?:是你的|为你的|is your)', 'unknown'),
-        (r'(?:verification code|验证码)[：:\s]*(\d{4,6})', 'unknown'),
-        (r'(?:code|码)[：:\s]+(\d{4,6})\b', 'unknown'),
-    ]
-    
-    for pattern, service in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+CODE_SCAN_CHARS = 4000  # 只扫描正文（折叠空白后）前这么多字符，验证码几乎都在开头
+# 发件人域名（含子域名）-> 服务名，能识别发件人时不必再在正文里猜服务
+CODE_SENDER_SERVICES = {
+    "google.com": "Google", "youtube.com": "Google",
+    "microsoft.com": "Microsoft", "microsoftonline.com": "Microsoft",
+    "apple.com": "Apple",
+    "amazon.com": "Amazon", "amazon.cn": "Amazon",
+    "facebookmail.com": "Facebook", "facebook.com": "Facebook", "meta.com": "Facebook",
+    "x.com": "Twitter", "twitter.com": "Twitter",
+    "linkedin.com": "LinkedIn",
+    "github.com": "GitHub",
+    "discord.com": "Discord", "discordapp.com": "Discord",
+    "telegram.org": "Telegram",
+    "whatsapp.com": "WhatsApp",
+    "alipay.com": "支付宝",
+    "wechat.com": "微信",
+    "taobao.com": "淘宝",
+    "jd.com": "京东",
+    "steampowered.com": "Steam",
+}
+# 正文中的服务名 -> 服务名（发件人无法识别时使用）
+CODE_SERVICE_NAMES = {
+    "google": "Google", "谷歌": "Google", "microsoft": "Microsoft", "微软": "Microsoft",
+    "apple": "Apple", "苹果": "Apple", "amazon": "Amazon", "亚马逊": "Amazon",
+    "facebook": "Facebook", "脸书": "Facebook", "meta": "Facebook", "twitter": "Twitter", "推特": "Twitter",
+    "linkedin": "LinkedIn", "github": "GitHub", "discord": "Discord", "telegram": "Telegram",
+    "whatsapp": "WhatsApp", "支付宝": "支付宝", "alipay": "支付宝", "微信": "微信", "wechat": "微信",
+    "淘宝": "淘宝", "taobao": "淘宝", "京东": "京东", "steam": "Steam",
+}
+CODE_SERVICE_RE = re.compile(
+    r'(?<![A-Za-z])(' + '|'.join(sorted(map(re.escape, CODE_SERVICE_NAMES), key=len, reverse=True)) + r')(?![A-Za-z])',
+    re.IGNORECASE
+)
+CODE_KEYWORDS = (r'(?<![A-Za-z])(?:verification code|security code|confirmation code|one[- ]time (?:pass)?code'
+                 r'|log[- ]?in code|sign[- ]in code|passcode|code|otp|验证码|校验码|动态码|确认码|驗證碼)')
+# 关键词和数字之间只允许空白、标点和 is/为/是 连接词，“code below ... 1234”这类中间夹着正文的不算；
+# 不用前导 .*?，大邮件不会回溯
+CODE_GAP = r'(?:[\s:：,，.。=\-–—\'"“”‘’「」【】\[\]()（）]|is(?![A-Za-z])|are(?![A-Za-z])|为|是|為){0,12}'
+CODE_PATTERNS = [
+    # Google 的 G-123456 格式
+    re.compile(r'(?<![A-Za-z0-9])G-(\d{6})(?!\d)'),
+    # 关键词在前：“验证码：123456”“Your code is 123456”
+    re.compile(CODE_KEYWORDS + CODE_GAP + r'(?<![A-Za-z0-9])(\d{4,8})(?!\d)', re.IGNORECASE),
+    # 数字在前：“123456 是你的验证码”“123456 is your code”
+    re.compile(r'(?<![\d.])(\d{4,8})\s?(?:是你的|是您的|为你的|为您的|為您的|is your|is the)', re.IGNORECASE),
+]
+# 按服务追加的格式，放在通用格式之前匹配
+CODE_SERVICE_PATTERNS = {
+    # Steam 令牌是 5 位大写字母数字（字母表不含元音，不会误中普通单词），至少含一个字母，纯数字的订单号等不算
+    "Steam": [re.compile(r'(?<![A-Za-z0-9])((?=[2-9]*[BCDFGHJKMNPQRTVWXY])[23456789BCDFGHJKMNPQRTVWXY]{5})(?![A-Za-z0-9])')],
+}
+CODE_FALLBACK_RE = re.compile(r'(?<![\d.,:/#-])(\d{6})(?![\d.,:/-])')
+
+def sender_service(sender: str) -> Optional[str]:
+    """按发件人域名（含子域名）识别服务"""
+    domain = parseaddr(sender or '')[1].rpartition('@')[2].lower()
+    labels = domain.split('.')
+    for i in range(len(labels) - 1):
+        service = CODE_SENDER_SERVICES.get('.'.join(labels[i:]))
+        if service:
+            return service
+    return None
+
+def extract_verification_code(text: str, sender: str = '') -> tuple:
+    """
+    从文本中提取验证码，返回 (code, service)
+    先按发件人域名确定服务，识别不了再在正文里找服务名；只扫描正文开头 CODE_SCAN_CHARS 个字符
+    """
+    text = ' '.join((text or '')[:CODE_SCAN_CHARS * 2].split())[:CODE_SCAN_CHARS]
+    if not text:
+        return None, None
+    
+    service = sender_service(sender)
+    if not service:
+        match = CODE_SERVICE_RE.search(text)
+        service = CODE_SERVICE_NAMES[match.group(1).lower()] if match else 'unknown'
+    
+    for pattern in CODE_SERVICE_PATTERNS.get(service, []):
+        match = pattern.search(text)
         if match:
             return match.group(1), service
     
+    for pattern in CODE_PATTERNS:
+        for match in pattern.finditer(text):
+            code = match.group(1)
+            # 4 位的 19xx/20xx 多半是年份（“code ... © 2025”），跳过继续找
+            if not (len(code) == 4 and code[:2] in ('19', '20')):
+                return code, service
+    
     # 最后尝试：独立的6位数字（但不要匹配年份等）
-    match = re.search(r'(?<![0-9])(\d{6})(?![0-9])', text)
-    if match:
+    for match in CODE_FALLBACK_RE.finditer(text):
         code = match.group(1)
         # 排除可能是年份的数字（如202x, 201x等）
         if not code.startswith('20') and not code.startswith('19'):
-            return code, 'unknown'
+            return code, service
     
     return None, None
 
-def refresh_gmail_token(refresh_token: str, email_id: int, user_id: int) -> str:
-    """使用 refresh_token 刷新 Gmail access_token"""
-    import urllib.request
-    import urllib.error
-    
-    # 获取 OAuth 凭证
-    client_id, client_secret = get_oauth_credentials('gmail')
-    if not client_id or not client_secret:
+OAUTH_TOKEN_URLS = {
+    "gmail": "https://oauth2.googleapis.com/token",
+    "outlook": "https://login.microsoftonline.com/common/oauth2/v2.0/token"
+}
+OAUTH_REFRESH_SCOPES = {"outlook": "https://graph.microsoft.com/Mail.Read offline_access"}
+OAUTH_REFRESH_MARGIN = 300  # 后台在 access_token 过期前多少秒主动刷新
+OAUTH_EXPIRY_SKEW = 60  # 取用时剩余有效期不足这么多秒就当作已过期
+OAUTH_REFRESH_CHECK = 30  # 后台检查即将过期 token 的间隔
+
+def oauth_expires_at(token_resp: dict) -> int:
+    """token 响应中的 expires_in（秒）换算成绝对过期时间"""
+    return int(time.time()) + int(token_resp.get('expires_in') or 3600)
+
+def refresh_oauth_token(provider: str, refresh_token: str) -> dict:
+    """使用 refresh_token 换取新的 access_token，返回 token 响应，失败返回 None"""
+    client_id, client_secret = get_oauth_credentials(provider)
+    if not client_id or not client_secret or not refresh_token:
         return None
     
-    # 请求新的 access_token
-    token_url = "https://oauth2.googleapis.com/token"
-    token_data = urllib.parse.urlencode({
+    fields = {
         'client_id': client_id,
         'client_secret': client_secret,
         'refresh_token': refresh_token,
         'grant_type': 'refresh_token'
-    }).encode()
+    }
+    if provider in OAUTH_REFRESH_SCOPES:
+        fields['scope'] = OAUTH_REFRESH_SCOPES[provider]
     
     try:
-        req = urllib.request.Request(token_url, data=token_data, method='POST')
-        req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-        
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            token_resp = json.loads(resp.read().decode())
-        
-        new_access_token = token_resp.get('access_token')
-        if not new_access_token:
-            return None
-        
-        # 更新数据库中的凭证
-        with get_db() as conn:
-            # 获取现有凭证
-            cursor = conn.execute(f"SELECT credentials FROM user_{user_id}_emails WHERE id = ?", (email_id,))
-            row = cursor.fetchone()
-            if row:
-                creds = json.loads(decrypt_password(row["credentials"]))
-                creds['access_token'] = new_access_token
-                # 如果返回了新的 refresh_token，也更新
-                if token_resp.get('refresh_token'):
-                    creds['refresh_token'] = token_resp['refresh_token']
-                if token_resp.get('expires_in'):
-                    creds['expires_in'] = token_resp['expires_in']
-                
-                # 保存更新后的凭证
-                conn.execute(
-                    f"UPDATE user_{user_id}_emails SET credentials = ? WHERE id = ?",
-                    (encrypt_password(json.dumps(creds)), email_id)
-                )
-                conn.commit()
-        
-        return new_access_token
+        # 部分服务商（如 Microsoft）每次刷新都会轮换 refresh_token，响应丢失后重发会用掉旧 token，
+        # 因此按非幂等请求处理：只在请求肯定没发出时重试
+        token_resp = http_json('POST', OAUTH_TOKEN_URLS[provider], FORM_HEADERS,
+                               urllib.parse.urlencode(fields).encode(), idempotent=False, retry_stale=False)
     except Exception as e:
-        print(f"刷新 Gmail token 失败: {e}")
+        print(f"刷新 {provider} token 失败: {e}")
         return None
+    return token_resp if token_resp.get('access_token') else None
 
-def refresh_outlook_token(refresh_token: str, email_id: int, user_id: int) -> str:
-    """使用 refresh_token 刷新 Outlook access_token"""
-    import urllib.request
-    import urllib.error
+class OAuthTokenCache:
+    """
+    OAuth access_token 内存缓存，按邮箱 (user_id, email_id) 记录 token 和过期时间
+    取用时快过期就先刷新，后台线程在过期前 OAUTH_REFRESH_MARGIN 秒主动刷新，轮询基本不会再碰到 401；
+    同一邮箱的并发刷新只发一次请求，其余调用等待结果
+    只有 refresh_token 轮换时才写回加密的 credentials，平时刷新不读写数据库
+    """
     
-    # 获取 OAuth 凭证
-    client_id, client_secret = get_oauth_credentials('outlook')
-    if not client_id or not client_secret:
-        return None
-    
-    # 请求新的 access_token
-    token_url = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
-    token_data = urllib.parse.urlencode({
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'refresh_token': refresh_token,
-        'grant_type': 'refresh_token',
-        'scope': 'https://graph.microsoft.com/Mail.Read offline_access'
-    }).encode()
-    
-    try:
-        req = urllib.request.Request(token_url, data=token_data, method='POST')
-        req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-        
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            token_resp = json.loads(resp.read().decode())
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (user_id, email_id) -> {"provider", "known", "refresh_token", "access_token", "expires_at", "lock", "last_used"}
+        # known 是这个缓存项用过的全部 refresh_token（初始凭证和之后轮换得到的）
+        self.entries: Dict[tuple, Dict] = {}
+        self.stopping = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+    
+    def entry(self, key: tuple, provider: str, creds: dict) -> Dict:
+        with self.lock:
+            entry = self.entries.get(key)
+            # 首次使用，或重新授权后库里出现了没见过的 refresh_token：以库里的凭证为准；
+            # 库里是轮换前的旧 token（读到的行过时、写回失败）时保留缓存，不能用旧 token 覆盖轮换后的
+            if entry is None or creds.get('refresh_token') not in entry["known"]:
+                entry = {
+                    "provider": provider,
+                    "known": {creds.get('refresh_token')},
+                    "refresh_token": creds.get('refresh_token'),
+                    "access_token": creds.get('access_token'),
+                    # 旧凭证没有记录过期时间，首次取用时刷新一次
+                    "expires_at": creds.get('expires_at') or 0,
+                    "lock": threading.Lock(),
+                    "last_used": time.time()
+                }
+                self.entries[key] = entry
+            return entry
+    
+    def get(self, user_id: int, email_id: int, provider: str, creds: dict, stale_token: str = None) -> str:
+        """
+        取可用的 access_token；stale_token 是刚被服务商以 401 拒绝的 token，
+        如果缓存里还是它就强制刷新，已被别的线程刷新过则直接返回新 token
+        """
+        key = (user_id, email_id)
+        entry = self.entry(key, provider, creds)
+        entry["last_used"] = time.time()
         
-        new_access_token = token_resp.get('access_token')
-        if not new_access_token:
-            return None
+        def usable():
+            return (entry["access_token"] and entry["access_token"] != stale_token
+                    and entry["expires_at"] - time.time() > OAUTH_EXPIRY_SKEW)
         
-        # 更新数据库中的凭证
-        with get_db() as conn:
-            cursor = conn.execute(f"SELECT credentials FROM user_{user_id}_emails WHERE id = ?", (email_id,))
-            row = cursor.fetchone()
-            if row:
+        if usable():
+            return entry["access_token"]
+        with entry["lock"]:
+            if usable():
+                return entry["access_token"]
+            if self.refresh(key, entry):
+                return entry["access_token"]
+        # 刷新失败时仍返回旧 token（过期时间未知的可能还有效），被拒绝过的除外
+        return entry["access_token"] if entry["access_token"] != stale_token else None
+    
+    def refresh(self, key: tuple, entry: Dict) -> bool:
+        """刷新一个邮箱的 token，调用方需持有 entry["lock"]"""
+        token_resp = refresh_oauth_token(entry["provider"], entry["refresh_token"])
+        if not token_resp:
+            return False
+        entry["access_token"] = token_resp['access_token']
+        entry["expires_at"] = oauth_expires_at(token_resp)
+        new_refresh_token = token_resp.get('refresh_token')
+        if new_refresh_token and new_refresh_token != entry["refresh_token"]:
+            entry["refresh_token"] = new_refresh_token
+            entry["known"].add(new_refresh_token)
+            self.persist(key, entry)
+        return True
+    
+    def persist(self, key: tuple, entry: Dict):
+        """refresh_token 轮换后写回数据库，旧的 refresh_token 可能很快失效"""
+        user_id, email_id = key
+        try:
+            with get_db() as conn:
+                row = conn.execute(f"SELECT credentials FROM user_{user_id}_emails WHERE id = ?", (email_id,)).fetchone()
+                if not row:
+                    return
                 creds = json.loads(decrypt_password(row["credentials"]))
-                creds['access_token'] = new_access_token
-                if token_resp.get('refresh_token'):
-                    creds['refresh_token'] = token_resp['refresh_token']
-                if token_resp.get('expires_in'):
-                    creds['expires_in'] = token_resp['expires_in']
-                
-                conn.execute(
-                    f"UPDATE user_{user_id}_emails SET credentials = ? WHERE id = ?",
-                    (encrypt_password(json.dumps(creds)), email_id)
-                )
+                creds.update({
+                    "access_token": entry["access_token"],
+                    "refresh_token": entry["refresh_token"],
+                    "expires_at": entry["expires_at"]
+                })
+                conn.execute(f"UPDATE user_{user_id}_emails SET credentials = ? WHERE id = ?",
+                             (encrypt_password(json.dumps(creds)), email_id))
                 conn.commit()
-        
-        return new_access_token
-    except Exception as e:
-        print(f"刷新 Outlook token 失败: {e}")
-        return None
+            email_poller.reload()  # 轮询缓存的邮箱行换成新凭证
+        except Exception as e:
+            print(f"保存轮换的 refresh_token 失败: {e}")
+    
+    def prune(self, keys: set):
+        """移除已删除邮箱的缓存"""
+        with self.lock:
+            for key in [key for key in self.entries if key not in keys]:
+                del self.entries[key]
+    
+    def _run(self):
+        while not self.stopping.wait(OAUTH_REFRESH_CHECK):
+            now = time.time()
+            with self.lock:
+                # 只刷新仍在轮询的邮箱
+                due = [(key, entry) for key, entry in self.entries.items()
+                       if entry["expires_at"] - now < OAUTH_REFRESH_MARGIN
+                       and now - entry["last_used"] < 2 * EMAIL_IDLE_POLL_INTERVAL]
+            for key, entry in due:
+                # 正在被取用线程刷新的跳过
+                if not entry["lock"].acquire(blocking=False):
+                    continue
+                try:
+                    self.refresh(key, entry)
+                except Exception as e:
+                    print(f"后台刷新 token 失败: {e}")
+                finally:
+                    entry["lock"].release()
 
-def fetch_imap_emails(email_address: str, creds: dict) -> list:
-    """通过 IMAP 获取最近5分钟的邮件"""
-    import imaplib
-    import email
-    from email.header import decode_header
-    from email.utils import parsedate_to_datetime
-    from datetime import datetime, timedelta, timezone
-    
-    server = creds.get('server')
-    port = creds.get('port', 993)
-    password = creds.get('password')
-    
-    if not server or not password:
+oauth_tokens = OAuthTokenCache()
+
+def load_mailbox_state(user_id: int, email_id: int) -> dict:
+    """读取邮箱的增量同步状态，没有记录时返回空字典"""
+    with get_db() as conn:
+        row = conn.execute(f"SELECT * FROM user_{user_id}_mailbox_state WHERE email_id = ?", (email_id,)).fetchone()
+    return dict(row) if row else {}
+
+def save_mailbox_state(conn, user_id: int, email_id: int, fields: dict):
+    """
+    写入邮箱的增量同步状态（只更新给出的列，由调用方提交事务）
+    拉取函数只返回新状态，和验证码、台账在同一个事务中写入，保存失败的邮件不会被跳过
+    """
+    fields = dict(fields, updated_at=datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+    columns = list(fields)
+    conn.execute(f"""
+        INSERT INTO user_{user_id}_mailbox_state (email_id, {', '.join(columns)})
+        VALUES (?, {', '.join('?' for _ in columns)})
+        ON CONFLICT(email_id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}
+    """, [email_id] + [fields[c] for c in columns])
+
+# 已处理邮件台账保留时间：远大于各同步方式回看的时间窗口（最近5分钟），过期的记录在写入时顺带清理
+SEEN_MESSAGE_TTL = 86400
+
+def unseen_message_ids(user_id: int, email_id: int, msg_ids: list) -> list:
+    """从邮件 ID 列表中去掉台账里已处理过的，保持原有顺序"""
+    msg_ids = [str(msg_id) for msg_id in msg_ids if msg_id]
+    if not msg_ids:
         return []
+    seen = set()
+    with get_db() as conn:
+        for i in range(0, len(msg_ids), 500):
+            chunk = msg_ids[i:i + 500]
+            rows = conn.execute(f"""
+                SELECT msg_id FROM user_{user_id}_seen_messages
+                WHERE email_id = ? AND msg_id IN ({', '.join('?' for _ in chunk)})
+            """, [email_id] + chunk).fetchall()
+            seen.update(row["msg_id"] for row in rows)
+    return [msg_id for msg_id in msg_ids if msg_id not in seen]
+
+def mark_messages_seen(conn, user_id: int, email_id: int, msg_ids: list):
+    """把处理完的邮件记入台账，并清理过期记录（由调用方提交事务）"""
+    msg_ids = [str(msg_id) for msg_id in msg_ids if msg_id]
+    if not msg_ids:
+        return
+    now = time.time()
+    conn.executemany(f"""
+        INSERT OR REPLACE INTO user_{user_id}_seen_messages (email_id, msg_id, seen_at) VALUES (?, ?, ?)
+    """, [(email_id, msg_id, now) for msg_id in msg_ids])
+    conn.execute(f"DELETE FROM user_{user_id}_seen_messages WHERE email_id = ? AND seen_at < ?",
+                 (email_id, now - SEEN_MESSAGE_TTL))
+
+IMAP_TIMEOUT = 10
+IMAP_NOOP_INTERVAL = 60  # 连接空闲超过这么久，使用前先 NOOP 探活
+IMAP_CONNECTION_TTL = 900  # 连接闲置超过这么久就关闭
+IMAP_IDLE_CYCLE = 300  # 每轮 IDLE 最长时间，之后重新确认用户是否仍活跃（RFC 2177 要求不超过 29 分钟）
+IMAP_PUSH_POLL_INTERVAL = 120  # 已在 IDLE 推送的邮箱，定时轮询只作兜底
+# IDLE 的读取依赖 imaplib 的内部实现（imap.file 为 BufferedReader、imap.sock），只在验证过的解释器版本上启用，
+# 其他版本不 IDLE，按普通间隔轮询（连接使用前照常 NOOP 探活）
+IMAP_IDLE_PYTHON_RANGE = ((3, 8), (3, 14))
+
+def imap_idle_supported(imap) -> bool:
+    low, high = IMAP_IDLE_PYTHON_RANGE
+    return (low <= sys.version_info[:2] < high and isinstance(getattr(imap, "file", None), io.BufferedReader)
+            and getattr(imap, "sock", None) is not None)
+
+def imap_peek(imap):
+    """
+    不阻塞地查看 imaplib 读缓冲中的数据：缓冲为空时只做一次非阻塞读
+    返回已缓冲的字节；对端关闭（或暂无数据）返回 b''；TLS 记录未收全返回 None
+    """
+    import ssl
     
-    emails_content = []
+    imap.sock.setblocking(False)
+    try:
+        return imap.file.peek()
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return None
+    finally:
+        imap.sock.settimeout(IMAP_TIMEOUT)
+
+def imap_wait_line(imap, wait: float):
+    """
+    最多等待 wait 秒读一行响应，没有数据返回 None
+    全部经 imaplib 自己的缓冲读取（imap.readline），之前命令预读的响应不会漏掉，读过的数据也不会留在 imaplib 之外；
+    等待用 select，不给 socket 设短超时——缓冲读超时一次后就不能再用
+    """
+    import select
     
-    # 固定查询5分钟前
-    since_datetime = datetime.now(timezone.utc) - timedelta(minutes=5)
+    if not imap_peek(imap):
+        if not getattr(imap.sock, 'pending', lambda: 0)() and not select.select([imap.sock], [], [], wait)[0]:
+            return None
+        data = imap_peek(imap)
+        if data is None:
+            return None
+        if not data:
+            raise imaplib.IMAP4.abort("IMAP 连接已关闭")
+    # 已有数据到达，整行随后就到，按正常超时阻塞读完这一行
+    line = imap.readline()
+    if not line:
+        raise imaplib.IMAP4.abort("IMAP 连接已关闭")
+    return line.rstrip(b'\r\n')
+
+def imap_idle(imap, timeout: float, should_stop) -> bool:
+    """
+    在已选中邮箱的连接上执行 IDLE，直到收到 EXISTS、超时或 should_stop() 为真，然后发送 DONE
+    返回是否有新邮件；每秒检查一次 should_stop
+    """
+    tag = b'IDLE%d' % (int(time.time() * 1000) % 1000000)
+    started = False
+    new_mail = False
+    sent_at = time.time()
+    imap.send(tag + b' IDLE\r\n')
+    while True:
+        if started and (new_mail or should_stop() or time.time() - sent_at >= timeout):
+            break
+        if not started and time.time() - sent_at >= IMAP_TIMEOUT:
+            raise imaplib.IMAP4.abort("IDLE 无响应")
+        line = imap_wait_line(imap, 1.0)
+        if line is None:
+            continue
+        if line.startswith(b'+'):
+            started = True
+        elif line.startswith(tag + b' '):
+            raise imaplib.IMAP4.error(f"服务器拒绝 IDLE: {line.decode(errors='ignore')}")
+        elif line.endswith(b' EXISTS'):
+            new_mail = True
+    
+    imap.send(b'DONE\r\n')
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("IMAP 连接已关闭")
+        line = line.rstrip(b'\r\n')
+        if line.startswith(tag + b' '):
+            if not line[len(tag) + 1:].upper().startswith(b'OK'):
+                raise imaplib.IMAP4.error(f"IDLE 结束失败: {line.decode(errors='ignore')}")
+            return new_mail
+        if line.endswith(b' EXISTS'):
+            new_mail = True
+
+class IMAPConnectionPool:
+    """
+    IMAP 连接池：每个邮箱保持一条已登录并选中 INBOX 的连接，不再每次轮询都重新登录
+    闲置过久的连接使用前先 NOOP 探活，断开后自动重连（重连受 IMAP_MIN_INTERVAL 限制）；
+    服务器支持 IDLE 时，用户活跃期间由后台线程在同一连接上 IDLE，新邮件到达即通知轮询服务
+    """
     
-    try:
-        # 设置超时，避免卡死
-        imaplib.IMAP4.timeout = 10
-        imap = imaplib.IMAP4_SSL(server, port)
-        imap.login(email_address, password)
-        imap.select('INBOX', readonly=True)
-        
-        # IMAP只支持按日期搜索
-        months = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
-        since_date = f"{since_datetime.day:02d}-{months[since_datetime.month-1]}-{since_datetime.year}"
-        status, messages = imap.search(None, f'SINCE {since_date}')
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (user_id, email_id) -> {"imap", "lock", "want", "creds", "uidvalidity", "last_used", "idle_thread", "retired"}
+        # retired: 已被 prune 移出连接池，正在使用它的线程用完后负责关闭
+        self.entries: Dict[tuple, Dict] = {}
+    
+    def entry(self, key: tuple) -> Dict:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = {"imap": None, "lock": threading.Lock(), "want": threading.Event(),
+                         "creds": None, "uidvalidity": None, "last_used": time.time(), "idle_thread": None,
+                         "retired": False}
+                self.entries[key] = entry
+            return entry
+    
+    def connect(self, email_address: str, creds: dict):
+        # 频率限制：防止频繁登录被封号
+        now = time.time()
+        if now - imap_last_login.get(email_address, 0) < IMAP_MIN_INTERVAL:
+            raise imaplib.IMAP4.error(f"距离上次登录不足 {IMAP_MIN_INTERVAL} 秒")
+        imap_last_login[email_address] = now
         
-        if status != 'OK':
+        imap = imaplib.IMAP4_SSL(creds.get('server'), creds.get('port', 993), timeout=IMAP_TIMEOUT)
+        try:
+            imap.login(email_address, creds.get('password'))
+            imap.select('INBOX', readonly=True)
+        except Exception:
+            self.logout(imap)
+            raise
+        return imap
+    
+    def uidvalidity(self, key: tuple):
+        """当前连接选中 INBOX 时服务器返回的 UIDVALIDITY"""
+        entry = self.entries.get(key)
+        return entry["uidvalidity"] if entry else None
+    
+    def logout(self, imap):
+        try:
             imap.logout()
-            return []
-        
-        msg_nums = messages[0].split()
-        # 只取最近5封
-        msg_nums = msg_nums[-5:] if len(msg_nums) > 5 else msg_nums
-        
-        for num in reversed(msg_nums):  # 从新到旧
+        except Exception:
+            pass
+    
+    def close(self, entry: Dict):
+        if entry["imap"] is not None:
+            self.logout(entry["imap"])
+            entry["imap"] = None
+    
+    def close_retired(self, entry: Dict):
+        """关闭已移出连接池的连接；正被占用时不等待，由占用者释放后再调用"""
+        if entry["lock"].acquire(blocking=False):
             try:
-                # 只获取邮件头和文本部分
-                status, msg_data = imap.fetch(num, '(BODY.PEEK[HEADER] BODY.PEEK[TEXT])')
-                if status != 'OK':
-                    continue
-                
-                # 解析邮件
-                raw_header = msg_data[0][1] if msg_data[0] else b''
-                raw_body = msg_data[1][1] if len(msg_data) > 1 and msg_data[1] else b''
-                
-                raw_email = raw_header + b'\r\n' + raw_body
-                msg = email.message_from_bytes(raw_email)
-                
-                # 检查邮件时间，只要最近5分钟的邮件
-                date_str = msg.get('Date', '')
-                if date_str:
-                    try:
-                        mail_datetime = parsedate_to_datetime(date_str)
-                        if mail_datetime < since_datetime:
-                            continue  # 跳过5分钟前的邮件
-                    except:
-                        pass
-                
-                # 获取发件人
-                from_header = msg.get('From', '')
-                
-                # 获取邮件内容
-                body = ''
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        if part.get_content_type() == 'text/plain':
-                            charset = part.get_content_charset() or 'utf-8'
-                            try:
-                                payload = part.get_payload(decode=True)
-                                if payload:
-                                    body = payload.decode(charset, errors='ignore')
-                            except:
-                                pass
-                            break
-                else:
-                    charset = msg.get_content_charset() or 'utf-8'
+                self.close(entry)
+            finally:
+                entry["lock"].release()
+    
+    @contextmanager
+    def connection(self, key: tuple, email_address: str, creds: dict):
+        """取出邮箱的连接（必要时探活或重连），使用期间独占；IDLE 中的连接会先退出 IDLE"""
+        entry = self.entry(key)
+        entry["want"].set()
+        try:
+            with entry["lock"]:
+                entry["want"].clear()
+                if entry["imap"] is not None and entry["creds"] != creds:
+                    self.close(entry)  # 凭证改过，用新凭证重新登录
+                if entry["imap"] is not None and time.time() - entry["last_used"] > IMAP_NOOP_INTERVAL:
                     try:
-                        payload = msg.get_payload(decode=True)
-                        if payload:
-                            body = payload.decode(charset, errors='ignore')
-                    except:
-                        pass
-                
-                if body:
-                    emails_content.append({
-                        'from': from_header,
-                        'body': body
-                    })
-            except Exception as e:
-                continue
-        
-        imap.logout()
-    except Exception as e:
-        print(f"IMAP 获取邮件失败 ({server}): {e}")
+                        entry["imap"].noop()
+                    except Exception:
+                        self.close(entry)
+                if entry["imap"] is None:
+                    entry["imap"] = self.connect(email_address, creds)
+                    entry["creds"] = creds
+                    _, data = entry["imap"].response('UIDVALIDITY')
+                    entry["uidvalidity"] = int(data[0]) if data and data[0] else None
+                try:
+                    yield entry["imap"]
+                except (imaplib.IMAP4.abort, OSError):
+                    self.close(entry)
+                    raise
+                finally:
+                    entry["last_used"] = time.time()
+        finally:
+            # 使用期间被 prune 移出了连接池：释放锁之后由这里关闭
+            if entry["retired"]:
+                self.close_retired(entry)
+    
+    def is_watching(self, key: tuple) -> bool:
+        entry = self.entries.get(key)
+        return bool(entry and entry["idle_thread"] and entry["idle_thread"].is_alive())
+    
+    def watch(self, key: tuple):
+        """服务器支持 IDLE 时启动推送线程，用户不再活跃或连接断开后线程自行退出"""
+        entry = self.entry(key)
+        with self.lock:
+            imap = entry["imap"]
+            if (imap is None or 'IDLE' not in imap.capabilities or not imap_idle_supported(imap)
+                    or self.is_watching(key)):
+                return
+            entry["idle_thread"] = threading.Thread(target=self._idle_loop, args=(key, entry), daemon=True)
+            entry["idle_thread"].start()
+    
+    def _idle_loop(self, key: tuple, entry: Dict):
+        while email_poller.is_active(key[0], time.time()) and not entry["retired"]:
+            with entry["lock"]:
+                if entry["imap"] is None:
+                    return
+                try:
+                    new_mail = imap_idle(entry["imap"], IMAP_IDLE_CYCLE,
+                                         lambda: entry["want"].is_set() or entry["retired"])
+                    # IDLE 正常结束后缓冲里只可能剩未请求的状态行（* ...），否则读写已错位，不能再交给拉取使用
+                    leftover = imap_peek(entry["imap"])
+                    if leftover and not leftover.startswith(b'* '):
+                        raise imaplib.IMAP4.abort("IDLE 结束后响应错位")
+                    entry["last_used"] = time.time()
+                except Exception as e:
+                    print(f"IMAP IDLE 中断 ({entry['creds'].get('server')}): {e}")
+                    self.close(entry)
+                    return
+            if new_mail:
+                email_poller.request_poll(key)
+            # 让等待连接的拉取先拿到锁
+            while entry["want"].is_set():
+                time.sleep(0.05)
+        if entry["retired"]:
+            self.close_retired(entry)
+    
+    def prune(self, keys: set):
+        """
+        关闭已移除邮箱的连接，以及闲置超过 IMAP_CONNECTION_TTL 的连接
+        在轮询调度线程中调用，不等待正在使用的连接：标记为 retired，由占用的拉取或 IDLE 线程用完后关闭
+        """
+        now = time.time()
+        with self.lock:
+            stale = [key for key, entry in self.entries.items()
+                     if key not in keys or (now - entry["last_used"] > IMAP_CONNECTION_TTL and not self.is_watching(key))]
+            entries = [self.entries.pop(key) for key in stale]
+        for entry in entries:
+            entry["retired"] = True
+            self.close_retired(entry)
+
+imap_pool = IMAPConnectionPool()
+
+IMAP_FETCH_BATCH = 20  # 每次轮询最多下载的新邮件数，剩下的紧接着下一轮处理
+IMAP_UID_RE = re.compile(rb'UID (\d+)')
+IMAP_SECTION_RE = re.compile(rb'BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$')
+
+def parse_imap_fetch(data: list) -> list:
+    """
+    把 FETCH 响应整理成 [{"uid", "attrs", 段名: bytes}]
+    imaplib 返回的列表中，带字面量的属性是 (前缀, 内容) 元组，其余属性是 bytes
+    """
+    messages = []
+    current = None
+    for item in data:
+        head = item[0] if isinstance(item, tuple) else item
+        if not isinstance(head, bytes):
+            continue
+        if re.match(rb'\d+ \(', head):
+            current = {"uid": None, "attrs": b''}
+            messages.append(current)
+        if current is None:
+            continue
+        match = IMAP_UID_RE.search(head)
+        if match:
+            current["uid"] = int(match.group(1))
+        section = IMAP_SECTION_RE.search(head) if isinstance(item, tuple) else None
+        if section:
+            current[section.group(1).decode().upper()] = item[1]
+            current["attrs"] += head
+        elif isinstance(item, tuple):
+            # BODYSTRUCTURE 中的字面量（如非 ASCII 文件名）换成带引号的字符串，便于解析
+            literal = item[1].replace(b'\\', b'\\\\').replace(b'"', b'\\"').replace(b'\r\n', b' ')
+            current["attrs"] += head[:head.rfind(b'{')] + b'"' + literal + b'"'
+        else:
+            current["attrs"] += head
+    return [msg for msg in messages if msg["uid"] is not None]
+
+IMAP_BODY_LIMIT = max(1024, int(os.environ.get("IMAP_BODY_LIMIT", 16384)))  # 每封邮件正文最多下载的字节数
+IMAP_ATOM_RE = re.compile(rb'[^\s()"]+')
+
+def parse_imap_sexp(data: bytes, pos: int = 0) -> tuple:
+    """解析一个 IMAP 括号表达式，返回 (值, 结束位置)；列表为 list，字符串为 str，NIL 为 None"""
+    while data[pos:pos + 1] == b' ':
+        pos += 1
+    char = data[pos:pos + 1]
+    if char == b'(':
+        items = []
+        pos += 1
+        while True:
+            while data[pos:pos + 1] == b' ':
+                pos += 1
+            if data[pos:pos + 1] == b')':
+                return items, pos + 1
+            if pos >= len(data):
+                raise ValueError("括号不匹配")
+            item, pos = parse_imap_sexp(data, pos)
+            items.append(item)
+    if char == b'"':
+        value = bytearray()
+        pos += 1
+        while data[pos:pos + 1] != b'"':
+            if data[pos:pos + 1] == b'\\':
+                pos += 1
+            if pos >= len(data):
+                raise ValueError("引号不匹配")
+            value += data[pos:pos + 1]
+            pos += 1
+        return value.decode(errors='replace'), pos + 1
+    match = IMAP_ATOM_RE.match(data, pos)
+    if not match:
+        raise ValueError("无法解析的内容")
+    atom = match.group().decode(errors='replace')
+    return (None if atom.upper() == 'NIL' else atom), match.end()
+
+def find_imap_text_part(structure, section: str = '') -> tuple:
+    """
+    在 BODYSTRUCTURE 中找正文段：优先 text/plain，其次 text/html，跳过附件和内嵌邮件
+    返回 (plain, html)，每项为 (段号, 传输编码, 字符集) 或 None
+    """
+    if not isinstance(structure, list) or not structure:
+        return None, None
+    if isinstance(structure[0], list):
+        # multipart：前面是子段，之后是子类型和扩展数据
+        plain = html = None
+        for index, part in enumerate(structure):
+            if not isinstance(part, list):
+                break
+            sub_plain, sub_html = find_imap_text_part(part, f"{section}.{index + 1}" if section else str(index + 1))
+            plain = plain or sub_plain
+            html = html or sub_html
+            if plain:
+                break
+        return plain, html
+    
+    if len(structure) < 7 or str(structure[0]).lower() != 'text':
+        return None, None
+    # 单段：type subtype params id description encoding size lines md5 disposition ...
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and str(disposition[0]).lower() == 'attachment':
+        return None, None
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = next((params[i + 1] for i in range(0, len(params) - 1, 2) if str(params[i]).lower() == 'charset'), None)
+    part = (section or '1', structure[5], charset)
+    subtype = str(structure[1]).lower()
+    if subtype == 'plain':
+        return part, None
+    if subtype == 'html':
+        return None, part
+    return None, None
+
+def decode_imap_part(raw: bytes, encoding: str, charset: str) -> str:
+    """按传输编码和字符集解码正文段；截断的 base64 只解码完整的部分"""
+    import quopri
+    
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        compact = re.sub(rb'[^A-Za-z0-9+/=]', b'', raw)
+        raw = base64.b64decode(compact[:len(compact) // 4 * 4])
+    elif encoding == 'quoted-printable':
+        raw = quopri.decodestring(raw)
+    try:
+        return raw.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return raw.decode('utf-8', errors='ignore')
+
+def html_to_text(content: str) -> str:
+    """HTML 正文转纯文本：去掉 style/script、标签，还原实体"""
+    import html
+    
+    content = re.sub(r'(?is)<(style|script)\b.*?</\1\s*>', ' ', content)
+    content = re.sub(r'<[^>]+>', ' ', content)
+    return html.unescape(content)
+
+def imap_recent_uids(imap, since_datetime) -> tuple:
+    """首次同步或 UIDVALIDITY 变化时：返回 (最近到达的 UID 列表, 当前最大 UID)"""
+    months = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
+    since_date = f"{since_datetime.day:02d}-{months[since_datetime.month-1]}-{since_datetime.year}"
+    status, data = imap.uid('SEARCH', None, f'SINCE {since_date}')
+    if status != 'OK' or not data[0]:
+        return [], 0
+    uids = sorted(int(uid) for uid in data[0].split())
+    # IMAP 只能按日期搜索，再按 INTERNALDATE 精确到时间
+    status, data = imap.uid('FETCH', ','.join(map(str, uids)), '(INTERNALDATE)')
+    recent = []
+    if status == 'OK':
+        since_ts = since_datetime.timestamp()
+        for msg in parse_imap_fetch(data):
+            received = imaplib.Internaldate2tuple(msg["attrs"])
+            if received and time.mktime(received) >= since_ts:
+                recent.append(msg["uid"])
+    return sorted(recent), uids[-1]
+
+def fetch_imap_messages(imap, uids: list, uidvalidity) -> list:
+    """
+    先取 BODYSTRUCTURE 和发件人，再只部分下载每封邮件的正文段（最多 IMAP_BODY_LIMIT 字节），
+    附件和内嵌图片不再下载；FETCH 失败时抛出 imaplib.IMAP4.error，这批 UID 留到下次
+    """
+    from email.header import decode_header, make_header
+    
+    status, data = imap.uid('FETCH', ','.join(map(str, uids)), '(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM)])')
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH 失败: {status}")
+    
+    messages = {}
+    sections: Dict[str, list] = {}  # 段号 -> UID 列表，同段号的邮件合并成一次 FETCH
+    for item in parse_imap_fetch(data):
+        raw_from = next((v for k, v in item.items() if k.startswith('HEADER')), b'')
+        from_header = raw_from.decode('utf-8', errors='ignore').partition(':')[2].strip()
+        try:
+            from_header = str(make_header(decode_header(from_header)))
+        except Exception:
+            pass
+        try:
+            start = item["attrs"].upper().index(b'BODYSTRUCTURE ') + len(b'BODYSTRUCTURE ')
+            plain, html = find_imap_text_part(parse_imap_sexp(item["attrs"], start)[0])
+        except ValueError:
+            continue
+        part = plain or html
+        if not part:
+            continue
+        messages[item["uid"]] = {"from": from_header, "part": part, "html": part is html}
+        sections.setdefault(part[0], []).append(item["uid"])
+    
+    for section, section_uids in sections.items():
+        status, data = imap.uid('FETCH', ','.join(map(str, section_uids)), f'(BODY.PEEK[{section}]<0.{IMAP_BODY_LIMIT}>)')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH 失败: {status}")
+        for item in parse_imap_fetch(data):
+            message = messages.get(item["uid"])
+            if message and section in item:
+                _, encoding, charset = message["part"]
+                message["body"] = decode_imap_part(item[section], encoding, charset)
     
+    emails_content = []
+    for uid in uids:
+        message = messages.get(uid)
+        if not message or not message.get("body"):
+            continue
+        body = html_to_text(message["body"]) if message["html"] else message["body"]
+        emails_content.append({
+            'from': message["from"],
+            'body': body,
+            'msg_id': f"{uidvalidity}:{uid}"
+        })
     return emails_content
 
-def fetch_outlook_emails(access_token: str) -> list:
-    """通过 Microsoft Graph API 获取最近5分钟的 Outlook 邮件"""
-    import urllib.request
-    import urllib.error
-    from datetime import datetime, timedelta, timezone
+def fetch_imap_emails(key: tuple, email_address: str, creds: dict) -> tuple:
+    """
+    通过连接池中的 IMAP 连接增量获取新邮件
+    每个邮箱持久化 UIDVALIDITY 和已处理的最大 UID，只 UID FETCH 之后的新邮件；
+    首次同步或 UIDVALIDITY 变化时只处理最近5分钟到达的邮件
+    返回 (邮件列表, 新的同步状态)，状态由调用方在验证码保存成功后写入
+    """
+    if not creds.get('server') or not creds.get('password'):
+        return [], {}
     
+    user_id, email_id = key
+    state = load_mailbox_state(user_id, email_id)
     emails_content = []
+    new_state = {}
     
     try:
-        # 固定查询最近5分钟
-        since_time = datetime.now(timezone.utc) - timedelta(minutes=5)
-        since_iso = since_time.strftime('%Y-%m-%dT%H:%M:%SZ')
-        
-        base_url = "https://graph.microsoft.com/v1.0/me/messages"
-        params = [
-            "$top=10", 
-            "$orderby=receivedDateTime desc", 
-            "$select=from,body,subject",
-            f"$filter=receivedDateTime ge {since_iso}"
-        ]
-        
-        url = f"{base_url}?{'&'.join(params)}"
+        with imap_pool.connection(key, email_address, creds) as imap:
+            uidvalidity = imap_pool.uidvalidity(key)
+            last_uid = state.get("last_uid") or 0
+            if uidvalidity and state.get("uidvalidity") == uidvalidity and last_uid:
+                status, data = imap.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+                # n:* 在没有新邮件时也会返回最后一封，需要再过滤一次
+                uids = sorted(int(uid) for uid in data[0].split() if int(uid) > last_uid) if status == 'OK' and data[0] else []
+                high_uid = uids[-1] if uids else last_uid
+            else:
+                uids, high_uid = imap_recent_uids(imap, datetime.now(timezone.utc) - timedelta(minutes=5))
+            
+            # 重新同步时回看的邮件里可能有已处理过的
+            if uids and uidvalidity:
+                unseen = set(unseen_message_ids(user_id, email_id, [f"{uidvalidity}:{uid}" for uid in uids]))
+                uids = [uid for uid in uids if f"{uidvalidity}:{uid}" in unseen]
+            
+            batch = uids[:IMAP_FETCH_BATCH]
+            if len(uids) > IMAP_FETCH_BATCH:
+                high_uid = batch[-1]
+                email_poller.request_poll(key)  # 积压的新邮件下一轮马上接着取
+            
+            if batch:
+                emails_content = fetch_imap_messages(imap, batch, uidvalidity)
+            
+            if uidvalidity and (uidvalidity != state.get("uidvalidity") or high_uid != last_uid):
+                new_state = {"uidvalidity": uidvalidity, "last_uid": high_uid}
         
-        req = urllib.request.Request(url)
-        req.add_header('Authorization', f'Bearer {access_token}')
+        if email_poller.is_active(user_id, time.time()):
+            imap_pool.watch(key)
+    except Exception as e:
+        print(f"IMAP 获取邮件失败 ({creds.get('server')}): {e}")
+        return [], {}
+    
+    return emails_content, new_state
+
+GMAIL_API = "https://gmail.googleapis.com/gmail/v1/users/me"
+GMAIL_BATCH_URL = "https://www.googleapis.com/batch/gmail/v1"
+GMAIL_FETCH_MAX = 50  # 每次轮询最多取的新邮件数（批量接口上限 100）
+GMAIL_HISTORY_PAGES = 5
+# 只取提取验证码用得到的字段
+GMAIL_MESSAGE_FIELDS = "id,snippet,payload(mimeType,headers,body/data,parts(mimeType,body/data,parts(mimeType,body/data)))"
+
+def mail_api_request(url: str, access_token: str, data: bytes = None, headers: dict = None) -> tuple:
+    """
+    请求邮箱服务商的 API（Gmail / Graph），返回 (响应体, 响应头)；HTTP 错误以 urllib.error.HTTPError 抛出
+    这些接口都是只读查询（批量接口也只是打包的 GET），失败可以安全重试
+    """
+    _, response_headers, content = http_pool.request(
+        'POST' if data is not None else 'GET', url,
+        {'Authorization': f'Bearer {access_token}', **(headers or {})}, data, idempotent=True)
+    return content, response_headers
+
+def gmail_batch_get(message_ids: list, access_token: str) -> tuple:
+    """
+    通过批量接口一次请求取回多封邮件，返回 (成功的邮件 JSON 列表, 需要重试的邮件 ID 列表)
+    已被删除（404）的邮件不再重试，限流、服务端错误等失败的子请求要重试
+    """
+    boundary = f"batch_{secrets.token_hex(8)}"
+    query = urllib.parse.urlencode({"format": "full", "fields": GMAIL_MESSAGE_FIELDS})
+    parts = []
+    for index, msg_id in enumerate(message_ids):
+        parts.append(
+            f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <m{index}>\r\n\r\n"
+            f"GET /gmail/v1/users/me/messages/{msg_id}?{query}\r\n\r\n"
+        )
+    body = (''.join(parts) + f"--{boundary}--\r\n").encode()
+    
+    content, headers = mail_api_request(GMAIL_BATCH_URL, access_token, body,
+                                     {'Content-Type': f'multipart/mixed; boundary={boundary}'})
+    match = re.search(r'boundary="?([^";]+)"?', headers.get('Content-Type', ''))
+    if not match:
+        return [], list(message_ids)
+    
+    messages = []
+    answered = set()
+    for part in content.split(b'--' + match.group(1).encode()):
+        # 每段是一个内嵌 HTTP 响应：段头（Content-ID 对应请求序号）、状态行和响应头、JSON
+        sections = part.split(b'\r\n\r\n', 2)
+        index = re.search(rb'Content-ID:\s*<response-m(\d+)>', sections[0], re.IGNORECASE)
+        status = re.match(rb'\s*HTTP/\S+ (\d{3})', sections[1]) if len(sections) > 1 else None
+        if not index or not status or int(index.group(1)) >= len(message_ids):
+            continue
+        if status.group(1) == b'404':
+            answered.add(int(index.group(1)))
+            continue
+        if status.group(1) != b'200' or len(sections) < 3:
+            continue
+        try:
+            messages.append(json.loads(sections[2].strip().decode('utf-8', errors='ignore')))
+        except ValueError:
+            continue
+        answered.add(int(index.group(1)))
+    return messages, [msg_id for index, msg_id in enumerate(message_ids) if index not in answered]
+
+def gmail_message_text(payload: dict) -> str:
+    """取 Gmail 邮件正文：优先 text/plain，没有时用 text/html 转纯文本"""
+    found = {}
+    pending = [payload]
+    while pending:
+        part = pending.pop(0)
+        mime_type = part.get('mimeType', '')
+        data = part.get('body', {}).get('data')
+        if data and mime_type in ('text/plain', 'text/html') and mime_type not in found:
+            found[mime_type] = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('utf-8', errors='ignore')
+        pending.extend(part.get('parts', []))
+    if 'text/plain' in found:
+        return found['text/plain']
+    return html_to_text(found.get('text/html', ''))
+
+def fetch_gmail_emails(email_address: str, creds: dict, email_id: int, user_id: int) -> tuple:
+    """
+    通过 Gmail API 增量获取新邮件
+    保存上次同步的 historyId，之后用 history.list 只取新增到收件箱的邮件，再用批量接口一次取回详情；
+    首次同步或 historyId 过期时按 after:<5分钟前> 查询
+    只有所有 history 分页和所有邮件详情都取到了才推进 historyId，否则下次从原来的 historyId 重试
+    （已处理的邮件由台账过滤，不会重复下载）
+    返回 (邮件列表, 新的同步状态)
+    """
+    import urllib.error
+    
+    access_token = oauth_tokens.get(user_id, email_id, 'gmail', creds)
+    if not access_token:
+        return [], {}
+    
+    def call(request):
+        # token 被提前吊销等情况下仍可能 401：刷新后重试一次
+        nonlocal access_token
+        try:
+            return request(access_token)
+        except urllib.error.HTTPError as e:
+            if e.code != 401:
+                raise
+            new_token = oauth_tokens.get(user_id, email_id, 'gmail', creds, stale_token=access_token)
+            if not new_token:
+                raise
+            access_token = new_token
+            return request(access_token)
+    
+    def get_json(url):
+        return json.loads(call(lambda token: mail_api_request(url, token))[0].decode())
+    
+    state = load_mailbox_state(user_id, email_id)
+    history_id = state.get("history_id")
+    message_ids = None
+    complete = True  # 本轮是否取全了 history_id 之后的所有新邮件
+    
+    try:
+        if history_id:
+            message_ids = []
+            page_token = None
+            for _ in range(GMAIL_HISTORY_PAGES):
+                params = {"startHistoryId": history_id, "historyTypes": "messageAdded", "labelId": "INBOX", "maxResults": 100}
+                if page_token:
+                    params["pageToken"] = page_token
+                data = get_json(f"{GMAIL_API}/history?{urllib.parse.urlencode(params)}")
+                for record in data.get('history', []):
+                    message_ids.extend(added['message']['id'] for added in record.get('messagesAdded', []))
+                new_history_id = data.get('historyId', history_id)
+                page_token = data.get('nextPageToken')
+                if not page_token:
+                    break
+            if page_token:
+                complete = False  # 还有没翻完的分页，historyId 留在原处
+            else:
+                history_id = new_history_id
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            print(f"[Gmail] {email_address}: history.list 失败 {e.code}")
+            return [], {}
+        message_ids = None  # historyId 过期，退回全量查询
+        print(f"[Gmail] {email_address}: historyId 已过期，重新同步")
+    except Exception as e:
+        print(f"[Gmail] {email_address}: history.list 失败 {e}")
+        return [], {}
+    
+    try:
+        if message_ids is None:
+            # 先记下当前 historyId 再查询，两者之间到达的邮件下次还会出现在 history 中，按邮件 ID 去重
+            history_id = get_json(f"{GMAIL_API}/profile").get('historyId')
+            query = f"after:{int(time.time()) - 300} in:inbox"
+            data = get_json(f"{GMAIL_API}/messages?{urllib.parse.urlencode({'q': query, 'maxResults': GMAIL_FETCH_MAX})}")
+            message_ids = [msg['id'] for msg in data.get('messages', [])]
         
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            data = json.loads(resp.read().decode())
+        # 按 after: 查询或 history 与查询重叠时会拿到处理过的邮件，取详情前先过滤掉
+        message_ids = unseen_message_ids(user_id, email_id, list(dict.fromkeys(message_ids)))
+        backlog = len(message_ids) > GMAIL_FETCH_MAX
+        message_ids = message_ids[-GMAIL_FETCH_MAX:]  # 优先取最新的，更早的下一轮接着取
+        messages, failed_ids = call(lambda token: gmail_batch_get(message_ids, token)) if message_ids else ([], [])
+    except Exception as e:
+        print(f"[Gmail] {email_address}: 获取邮件失败 {e}")
+        return [], {}
+    
+    if backlog or failed_ids:
+        complete = False
+    if backlog:
+        email_poller.request_poll((user_id, email_id))
+    new_state = {}
+    if complete and history_id and history_id != state.get("history_id"):
+        new_state["history_id"] = str(history_id)
+    
+    if message_ids:
+        print(f"[Gmail] {email_address}: 新邮件 {len(message_ids)} 封，取回 {len(messages)} 封"
+              + (f"，{len(failed_ids)} 封下次重试" if failed_ids else ""))
+    
+    emails_content = []
+    for msg_data in messages:
+        payload = msg_data.get('payload', {})
+        from_addr = ''
+        for h in payload.get('headers', []):
+            if h['name'].lower() == 'from':
+                from_addr = h['value']
+                break
         
-        for msg in data.get('value', []):
-            from_addr = msg.get('from', {}).get('emailAddress', {}).get('address', '')
-            body = msg.get('body', {}).get('content', '')
-            # 去除 HTML 标签（简单处理）
-            import re
-            body = re.sub(r'<[^>]+>', '', body)
-            
-            emails_content.append({
-                'from': from_addr,
-                'body': body
-            })
+        emails_content.append({
+            'from': from_addr,
+            'body': msg_data.get('snippet', '') + ' ' + gmail_message_text(payload),
+            'msg_id': msg_data['id']
+        })
+    
+    return emails_content, new_state
+
+GRAPH_DELTA_URL = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta"
+OUTLOOK_DELTA_PAGES = 10
+OUTLOOK_RECENT_MINUTES = 5  # 只处理最近几分钟收到的邮件，旧邮件的已读等变更也会出现在 delta 中
+
+def fetch_outlook_emails(email_address: str, creds: dict, email_id: int, user_id: int) -> tuple:
+    """
+    通过 Microsoft Graph 的 messages/delta 增量获取 Outlook 收件箱新邮件
+    保存 deltaLink，每次轮询只返回上次之后的变化；只 $select 需要的字段，并要求以纯文本返回正文
+    返回 (邮件列表, 新的同步状态)
+    """
+    import urllib.error
+    
+    access_token = oauth_tokens.get(user_id, email_id, 'outlook', creds)
+    if not access_token:
+        return [], {}
+    
+    def get_json(url):
+        # token 被提前吊销等情况下仍可能 401：刷新后重试一次
+        nonlocal access_token
+        headers = {'Prefer': 'outlook.body-content-type="text", odata.maxpagesize=50'}
+        try:
+            return json.loads(mail_api_request(url, access_token, headers=headers)[0].decode())
+        except urllib.error.HTTPError as e:
+            if e.code != 401:
+                raise
+            new_token = oauth_tokens.get(user_id, email_id, 'outlook', creds, stale_token=access_token)
+            if not new_token:
+                raise
+            access_token = new_token
+            return json.loads(mail_api_request(url, access_token, headers=headers)[0].decode())
+    
+    since_time = datetime.now(timezone.utc) - timedelta(minutes=OUTLOOK_RECENT_MINUTES)
+    since_iso = since_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+    initial_url = GRAPH_DELTA_URL + "?" + urllib.parse.urlencode({
+        "$select": "from,body,receivedDateTime",
+        "$filter": f"receivedDateTime ge {since_iso}"
+    })
+    
+    state = load_mailbox_state(user_id, email_id)
+    url = state.get("delta_link") or initial_url
+    messages = []
+    delta_link = None
+    resynced = False
+    
+    try:
+        for _ in range(OUTLOOK_DELTA_PAGES):
+            try:
+                data = get_json(url)
+            except urllib.error.HTTPError as e:
+                # 同步状态过期（410）或 deltaLink 失效：重新做一次初始同步
+                if e.code not in (400, 404, 410) or url == initial_url:
+                    raise
+                print(f"[Outlook] {email_address}: deltaLink 已失效，重新同步")
+                url = initial_url
+                messages = []
+                resynced = True
+                continue
+            messages.extend(data.get('value', []))
+            if data.get('@odata.nextLink'):
+                url = data['@odata.nextLink']
+                continue
+            delta_link = data.get('@odata.deltaLink')
+            break
     except Exception as e:
         print(f"Outlook 获取邮件失败: {e}")
+        return [], {}
     
-    return emails_content
+    # Graph 每次都返回新的 deltaLink，没有变化时沿用旧链接即可（仍能取到之后的变化），
+    # 只有本轮确有变化、首次同步或重新同步时才写库，空轮询不写数据库
+    changed = bool(messages) or resynced or not state.get("delta_link")
+    new_state = {"delta_link": delta_link} if delta_link and changed else {}
+    
+    # 已读等变更会让处理过的邮件再次出现在 delta 中
+    unseen = set(unseen_message_ids(user_id, email_id, [msg.get('id') for msg in messages if '@removed' not in msg]))
+    
+    emails_content = []
+    for msg in messages:
+        if msg.get('id') not in unseen:
+            continue
+        received = msg.get('receivedDateTime') or ''
+        if received and received < since_iso:
+            continue
+        body = msg.get('body') or {}
+        content = body.get('content', '')
+        if body.get('contentType') == 'html':
+            content = html_to_text(content)
+        emails_content.append({
+            'from': ((msg.get('from') or {}).get('emailAddress') or {}).get('address', ''),
+            'body': content,
+            'msg_id': msg.get('id', '')
+        })
+    
+    return emails_content, new_state
 
-@app.post("/api/emails/refresh")
-def refresh_emails(data: dict = None, user: dict = Depends(get_current_user)):
-    """刷新邮箱，获取最新验证码（支持 Gmail、Outlook、QQ、IMAP）"""
-    user_id = user['id']
+def fetch_mailbox_emails(user_id: int, email_row: dict) -> tuple:
+    """按邮箱类型拉取最近的邮件，返回 ([{from, body, msg_id}], 新的同步状态)"""
+    email_address = email_row["address"]
+    email_id = email_row["id"]
+    provider = email_row["provider"]
+    creds = json.loads(decrypt_password(email_row["credentials"]))
+    
+    # ==================== Gmail ====================
+    if provider == 'gmail':
+        return fetch_gmail_emails(email_address, creds, email_id, user_id)
+    
+    # ==================== Outlook ====================
+    if provider == 'outlook':
+        return fetch_outlook_emails(email_address, creds, email_id, user_id)
+    
+    # ==================== QQ / IMAP ====================
+    if provider in ['qq', 'imap']:
+        return fetch_imap_emails((user_id, email_id), email_address, creds)
+    
+    return [], {}
+
+def store_verification_codes(user_id: int, email_id: int, email_address: str, emails_content: list,
+                             new_state: dict = None) -> list:
+    """
+    从邮件中提取验证码并写库，返回新保存的验证码
+    先在内存中提取完所有验证码，再用一个短事务批量 INSERT OR IGNORE，去重交给唯一约束（见 ensure_code_constraints）；
+    处理过的邮件记入台账、邮箱的新同步状态（UID / historyId / deltaLink）在同一事务中写入
+    """
+    candidates = []
+    for email_data in emails_content:
+        from_addr = email_data.get('from', '')
+        code, service = extract_verification_code(email_data.get('body', ''), from_addr)
+        if not code:
+            continue
+        
+        # 如果服务未识别，用发件人
+        if service == 'unknown':
+            service = from_addr.split('<')[0].strip() or from_addr
+        candidates.append((code, service, email_data.get('msg_id', '')))
+    
     new_codes = []
+    # 计算过期时间（3分钟后）- 使用 UTC
+    expires_at = (datetime.now(timezone.utc) + timedelta(minutes=3)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    bucket = int(time.time()) // CODE_DEDUPE_WINDOW
     
-    # 获取客户端传来的启动时间戳（只检测此时间之后的邮件）
     with get_db() as conn:
-        # 确保 source_msg_id 列存在（兼容旧版升级）
+        for code, service, source_msg_id in candidates:
+            # 验证码有效期3分钟
+            cursor = conn.execute(f"""
+                INSERT OR IGNORE INTO user_{user_id}_verification_codes 
+                (email, service, code, account_name, is_read, expires_at, created_at, source_msg_id, dedupe_bucket)
+                VALUES (?, ?, ?, '', 0, datetime('now', '+3 minutes'), datetime('now'), ?, ?)
+            """, (email_address, service[:50], code, source_msg_id, bucket))
+            if not cursor.rowcount:
+                continue  # 去重命中
+            new_codes.append({
+                "email": email_address,
+                "service": service,
+                "code": code,
+                "expires_at": expires_at
+            })
+        mark_messages_seen(conn, user_id, email_id, [email_data.get('msg_id') for email_data in emails_content])
+        if new_state:
+            save_mailbox_state(conn, user_id, email_id, new_state)
+        conn.commit()
+    
+    return new_codes
+
+def poll_mailbox(user_id: int, email_row: dict) -> list:
+    """拉取一个邮箱的新邮件（不占用数据库连接），再在一个事务中保存验证码、记入台账并推进同步状态"""
+    emails_content, new_state = fetch_mailbox_emails(user_id, email_row)
+    if not emails_content and not new_state:
+        return []
+    return store_verification_codes(user_id, email_row["id"], email_row["address"], emails_content, new_state)
+
+# 邮箱轮询间隔（秒）：有客户端在看时按活跃间隔，否则退回空闲间隔
+EMAIL_POLL_INTERVAL = max(5, int(os.environ.get("EMAIL_POLL_INTERVAL", 15)))
+EMAIL_IDLE_POLL_INTERVAL = max(EMAIL_POLL_INTERVAL, int(os.environ.get("EMAIL_IDLE_POLL_INTERVAL", 300)))
+EMAIL_ACTIVE_WINDOW = 600  # 客户端最近一次刷新后多久内算活跃
+EMAIL_POLL_TICK = 2  # 调度线程检查到期邮箱的间隔
+EMAIL_MAILBOX_RELOAD = 60  # 重新加载邮箱列表的间隔
+EMAIL_NEW_CODE_MINUTES = 3  # /api/emails/refresh 只返回最近几分钟内的验证码
+EMAIL_FETCH_WORKERS = max(1, int(os.environ.get("EMAIL_FETCH_WORKERS", 8)))
+# 每类服务商同时拉取的邮箱数上限（QQ 与自定义 IMAP 共用 imap 配额）
+EMAIL_PROVIDER_LIMITS = {"gmail": 4, "outlook": 4, "imap": 2}
+EMAIL_REFRESH_DEADLINE = 1  # /api/emails/refresh 最多等待进行中的拉取多少秒，慢邮箱在 pending 中返回，不长时间占用工作线程
+
+def email_provider_group(provider: str) -> str:
+    return 'imap' if provider in ('qq', 'imap') else provider
+
+class EmailPoller:
+    """
+    邮箱轮询服务
+    后台线程按每个邮箱各自的间隔拉取邮件，验证码写入 verification_codes 表；
+    /api/emails/refresh 只读库，打开多少个标签页都不会增加对邮箱服务商的请求
+    到期的邮箱交给线程池并发拉取，每类服务商的并发数受 EMAIL_PROVIDER_LIMITS 限制，
+    慢邮箱只占自己的名额，不会拖住其他邮箱
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)  # 有邮箱拉取结束时通知等待者
+        self.mailboxes: Dict[tuple, Dict] = {}  # (user_id, email_id) -> {"row", "last_poll", "next_poll", "running", "error"}
+        self.active_users: Dict[int, float] = {}  # user_id -> 客户端最近一次刷新的时间
+        self.running: Dict[str, int] = {}  # 服务商 -> 进行中的拉取数
+        self.reload_at = 0.0
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.executor = None
+    
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        self.stopping.clear()
+        self.executor = ThreadPoolExecutor(max_workers=EMAIL_FETCH_WORKERS, thread_name_prefix="email-poll")
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """停止调度线程；进行中的拉取不等待，线程池不再接新任务"""
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+    
+    def reload(self):
+        """邮箱增删或凭证更新后调用：当场重新加载邮箱列表，之后的拉取都用库里最新的凭证"""
+        self.reload_at = time.time() + EMAIL_MAILBOX_RELOAD
         try:
-            conn.execute(f"ALTER TABLE user_{user_id}_verification_codes ADD COLUMN source_msg_id TEXT DEFAULT ''")
-            conn.commit()
-        except:
-            pass
+            self.load_mailboxes()
+        except Exception as e:
+            print(f"重新加载邮箱列表失败: {e}")
+            self.reload_at = 0.0  # 交给调度线程重试
+        self.wakeup.set()
+    
+    def is_active(self, user_id: int, now: float) -> bool:
+        return now - self.active_users.get(user_id, 0) < EMAIL_ACTIVE_WINDOW
+    
+    def interval(self, key: tuple, mailbox: Dict, active: bool) -> float:
+        if not active:
+            return EMAIL_IDLE_POLL_INTERVAL
+        if imap_pool.is_watching(key):
+            return IMAP_PUSH_POLL_INTERVAL
+        return EMAIL_POLL_INTERVAL
+    
+    def request_poll(self, key: tuple):
+        """IDLE 推送到新邮件时调用，邮箱立即到期；正在拉取的在结束后马上再拉一次"""
+        with self.lock:
+            mailbox = self.mailboxes.get(key)
+            if not mailbox:
+                return
+            if mailbox["running"]:
+                mailbox["requested"] = True
+            else:
+                mailbox["next_poll"] = 0.0
+        self.wakeup.set()
+    
+    def touch(self, user_id: int):
+        """客户端刷新时调用：标记用户活跃，空闲间隔中的邮箱提前到活跃间隔"""
+        now = time.time()
+        with self.lock:
+            was_active = self.is_active(user_id, now)
+            self.active_users[user_id] = now
+            if was_active:
+                return
+            for key, mailbox in self.mailboxes.items():
+                if key[0] == user_id:
+                    mailbox["next_poll"] = min(mailbox["next_poll"], mailbox["last_poll"] + self.interval(key, mailbox, True))
+        self.wakeup.set()
+    
+    def load_mailboxes(self):
+        rows = {}
+        with get_db() as conn:
+            try:
+                users = conn.execute("SELECT id FROM users").fetchall()
+            except sqlite3.OperationalError:
+                return  # 首次启动时 init_db 还没建表
+            for user in users:
+                try:
+                    cursor = conn.execute(f"SELECT id, address, provider, credentials FROM user_{user['id']}_emails WHERE status = 'active'")
+                except sqlite3.OperationalError:
+                    continue  # 用户还没登录过，表未创建
+                for row in cursor.fetchall():
+                    rows[(user["id"], row["id"])] = dict(row)
         
-        # 获取已授权的邮箱
+        with self.lock:
+            for key, row in rows.items():
+                if key in self.mailboxes:
+                    self.mailboxes[key]["row"] = row
+                else:
+                    self.mailboxes[key] = {"row": row, "last_poll": 0.0, "next_poll": 0.0, "running": False, "error": None}
+            for key in list(self.mailboxes):
+                if key not in rows:
+                    del self.mailboxes[key]
+        imap_pool.prune(set(rows))
+        oauth_tokens.prune(set(rows))
+    
+    def poll(self, key: tuple, mailbox: Dict, group: str):
+        user_id = key[0]
+        error = None
         try:
-            cursor = conn.execute(f"SELECT id, address, provider, credentials FROM user_{user_id}_emails WHERE status = 'active'")
-            emails = cursor.fetchall()
-        except:
-            return {"success": False, "message": "无法获取邮箱列表", "codes": []}
+            poll_mailbox(user_id, mailbox["row"])
+        except Exception as e:
+            error = str(e)
+            print(f"处理邮箱 {mailbox['row']['address']} 失败: {e}")
+        now = time.time()
+        with self.lock:
+            mailbox["error"] = error
+            mailbox["running"] = False
+            mailbox["last_poll"] = now
+            if mailbox.pop("requested", False):
+                mailbox["next_poll"] = now
+            else:
+                mailbox["next_poll"] = now + self.interval(key, mailbox, self.is_active(user_id, now))
+            self.running[group] -= 1
+            self.done.notify_all()
+        self.wakeup.set()  # 空出了名额，让调度线程补上排队的邮箱
+    
+    def dispatch(self, now: float):
+        """把到期的邮箱按到期先后提交到线程池，超出服务商并发上限的留到下一轮"""
+        with self.lock:
+            due = sorted(
+                ((key, mailbox) for key, mailbox in self.mailboxes.items()
+                 if not mailbox["running"] and mailbox["next_poll"] <= now),
+                key=lambda item: item[1]["next_poll"]
+            )
+            for key, mailbox in due:
+                group = email_provider_group(mailbox["row"]["provider"])
+                if self.running.get(group, 0) >= EMAIL_PROVIDER_LIMITS.get(group, 2):
+                    continue
+                mailbox["running"] = True
+                self.running[group] = self.running.get(group, 0) + 1
+                self.executor.submit(self.poll, key, mailbox, group)
+    
+    def wait_for_user(self, user_id: int, timeout: float) -> list:
+        """等待该用户到期或进行中的邮箱拉取完成，超时返回仍未完成的邮箱地址"""
+        deadline = time.time() + timeout
+        with self.done:
+            while True:
+                now = time.time()
+                pending = [
+                    mailbox["row"]["address"] for (uid, _), mailbox in self.mailboxes.items()
+                    if uid == user_id and (mailbox["running"] or mailbox["next_poll"] <= now)
+                ]
+                if not pending or now >= deadline:
+                    return pending
+                self.done.wait(deadline - now)
+    
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                now = time.time()
+                if now >= self.reload_at:
+                    self.reload_at = now + EMAIL_MAILBOX_RELOAD
+                    self.load_mailboxes()
+                self.dispatch(now)
+            except Exception as e:
+                print(f"邮箱轮询出错: {e}")
+            self.wakeup.wait(EMAIL_POLL_TICK)
+            self.wakeup.clear()
+
+email_poller = EmailPoller()
+
+def sqlite_time_to_iso(value):
+    """把 SQLite datetime('now') 格式的 UTC 时间转成带 Z 的 ISO 格式，前端按 UTC 解析"""
+    if value and 'T' not in value:
+        return value.replace(' ', 'T') + 'Z'
+    return value
+
+EMAIL_REFRESH_CACHE_TTL = 2  # 同一用户的刷新结果在这么多秒内直接复用
+EMAIL_REFRESH_SNAPSHOT_LIMIT = 100  # 快照最多带多少条最近的验证码，各调用方再按自己的 after_id 过滤
+
+class EmailRefreshCoalescer:
+    """
+    /api/emails/refresh 的按用户合并（single-flight）
+    同一用户同时只有一个请求真正等待拉取并读库，其余请求等它完成后共用结果；
+    结果再缓存 EMAIL_REFRESH_CACHE_TTL 秒，打开多少个标签页、设备都只算一次
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights: Dict[int, Dict] = {}  # user_id -> {"done", "result", "error", "finished_at"}
+    
+    def run(self, user_id: int, compute):
+        now = time.time()
+        with self.lock:
+            flight = self.flights.get(user_id)
+            reusable = flight and (not flight["done"].is_set() or (
+                flight["error"] is None and now - flight["finished_at"] < EMAIL_REFRESH_CACHE_TTL))
+            if not reusable:
+                for uid in [uid for uid, f in self.flights.items()
+                            if f["done"].is_set() and now - f["finished_at"] >= EMAIL_REFRESH_CACHE_TTL]:
+                    del self.flights[uid]
+                flight = {"done": threading.Event(), "result": None, "error": None, "finished_at": 0.0}
+                self.flights[user_id] = flight
         
-        for email_row in emails:
-            email_address = email_row["address"]
-            email_id = email_row["id"]
-            provider = email_row["provider"]
-            encrypted_creds = email_row["credentials"]
-            
+        if reusable:
+            flight["done"].wait()
+        else:
             try:
-                creds = json.loads(decrypt_password(encrypted_creds))
-                emails_content = []
-                
-                # ==================== Gmail ====================
-                if provider == 'gmail':
-                    access_token = creds.get('access_token')
-                    refresh_token = creds.get('refresh_token')
-                    
-                    if not access_token:
-                        continue
-                    
-                    import urllib.request
-                    import urllib.error
-                    import time
-                    
-                    # 使用 epoch 时间戳精确查询最近5分钟的邮件
-                    # Gmail API 支持 after:EPOCH_SECONDS 格式，比 newer_than 更精确
-                    five_minutes_ago = int(time.time()) - 300
-                    query = f"after:{five_minutes_ago}"
-                    
-                    list_url = f"https://gmail.googleapis.com/gmail/v1/users/me/messages?q={urllib.parse.quote(query)}&maxResults=50"
-                    
-                    # 尝试请求，如果401则刷新token重试
-                    messages_data = None
-                    for attempt in range(2):
-                        req = urllib.request.Request(list_url)
-                        req.add_header('Authorization', f'Bearer {access_token}')
-                        
-                        try:
-                            with urllib.request.urlopen(req, timeout=10) as resp:
-                                messages_data = json.loads(resp.read().decode())
-                            break
-                        except urllib.error.HTTPError as e:
-                            if e.code == 401 and attempt == 0 and refresh_token:
-                                new_token = refresh_gmail_token(refresh_token, email_id, user_id)
-                                if new_token:
-                                    access_token = new_token
-                                    continue
-                            break
-                    
-                    if not messages_data:
-                        print(f"[Gmail] {email_address}: messages_data 为空")
-                        continue
-                    
-                    msg_count = len(messages_data.get('messages', []))
-                    print(f"[Gmail] {email_address}: 查询 after:{five_minutes_ago}, 获取到 {msg_count} 封邮件")
-                    
-                    for msg in messages_data.get('messages', []):
-                        msg_id = msg['id']
-                        detail_url = f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{msg_id}?format=full"
-                        req = urllib.request.Request(detail_url)
-                        req.add_header('Authorization', f'Bearer {access_token}')
-                        
-                        try:
-                            with urllib.request.urlopen(req, timeout=10) as resp:
-                                msg_data = json.loads(resp.read().decode())
-                        except:
-                            continue
-                        
-                        snippet = msg_data.get('snippet', '')
-                        payload = msg_data.get('payload', {})
-                        body_data = ''
-                        
-                        if 'body' in payload and payload['body'].get('data'):
-                            body_data = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='ignore')
-                        elif 'parts' in payload:
-                            for part in payload['parts']:
-                                if part.get('mimeType') == 'text/plain' and part.get('body', {}).get('data'):
-                                    body_data = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-                                    break
-                        
-                        from_addr = ''
-                        for h in payload.get('headers', []):
-                            if h['name'].lower() == 'from':
-                                from_addr = h['value']
-                                break
-                        
-                        emails_content.append({
-                            'from': from_addr,
-                            'body': snippet + ' ' + body_data,
-                            'msg_id': msg_id
-                        })
-                        print(f"[Gmail] 添加邮件: from={from_addr[:30]}..., body长度={len(snippet + body_data)}")
-                
-                # ==================== Outlook ====================
-                elif provider == 'outlook':
-                    access_token = creds.get('access_token')
-                    refresh_token = creds.get('refresh_token')
-                    
-                    if not access_token:
-                        continue
-                    
-                    import urllib.request
-                    import urllib.error
-                    
-                    # 尝试获取邮件，如果401则刷新token
-                    for attempt in range(2):
-                        try:
-                            emails_content = fetch_outlook_emails(access_token)
-                            break
-                        except urllib.error.HTTPError as e:
-                            if e.code == 401 and attempt == 0 and refresh_token:
-                                new_token = refresh_outlook_token(refresh_token, email_id, user_id)
-                                if new_token:
-                                    access_token = new_token
-                                    continue
-                            break
-                        except:
-                            break
-                
-                # ==================== QQ / IMAP ====================
-                elif provider in ['qq', 'imap']:
-                    # 频率限制：防止频繁登录被封号
-                    import time
-                    now = time.time()
-                    last_fetch = imap_last_fetch.get(email_address, 0)
-                    if now - last_fetch < IMAP_MIN_INTERVAL:
-                        # 距离上次请求不足60秒，跳过
-                        continue
-                    
-                    emails_content = fetch_imap_emails(email_address, creds)
-                    imap_last_fetch[email_address] = now  # 更新最后请求时间
-                
-                # ==================== 提取验证码 ====================
-                print(f"[验证码] emails_content 数量: {len(emails_content)}")
-                for email_data in emails_content:
-                    full_text = email_data.get('body', '')
-                    from_addr = email_data.get('from', '')
-                    source_msg_id = email_data.get('msg_id', '')
-                    
-                    code, service = extract_verification_code(full_text)
-                    print(f"[验证码] 提取结果: code={code}, service={service}")
-                    
-                    if code:
-                        # 如果服务未识别，用发件人
-                        if service == 'unknown':
-                            service = from_addr.split('<')[0].strip() or from_addr
-                        
-                        # 去重检查
-                        already_exists = False
-                        if source_msg_id:
-                            # Gmail/Outlook: 按邮件ID去重，永不重复处理同一封邮件
-                            cursor = conn.execute(f"""
-                                SELECT id FROM user_{user_id}_verification_codes 
-                                WHERE email = ? AND source_msg_id = ?
-                            """, (email_address, source_msg_id))
-                            already_exists = cursor.fetchone() is not None
-                        else:
-                            # IMAP等: 保持原有的5分钟窗口去重
-                            cursor = conn.execute(f"""
-                                SELECT id FROM user_{user_id}_verification_codes 
-                                WHERE email = ? AND code = ? AND created_at > datetime('now', '-5 minutes')
-                            """, (email_address, code))
-                            already_exists = cursor.fetchone() is not None
-                        
-                        if not already_exists:
-                            # 计算过期时间（3分钟后）- 使用 UTC
-                            expires_at = (datetime.now(timezone.utc) + timedelta(minutes=3)).strftime('%Y-%m-%dT%H:%M:%SZ')
-                            
-                            # 验证码有效期3分钟
-                            conn.execute(f"""
-                                INSERT INTO user_{user_id}_verification_codes 
-                                (email, service, code, account_name, is_read, expires_at, created_at, source_msg_id)
-                                VALUES (?, ?, ?, ?, 0, datetime('now', '+3 minutes'), datetime('now'), ?)
-                            """, (email_address, service[:50], code, '', source_msg_id))
-                            conn.commit()
-                            
-                            print(f"[验证码] ✅ 新验证码已保存: {code} from {service}")
-                            
-                            new_codes.append({
-                                "email": email_address,
-                                "service": service,
-                                "code": code,
-                                "expires_at": expires_at
-                            })
-                        else:
-                            print(f"[验证码] ⏭️ 去重命中: code={code}")
-            
+                flight["result"] = compute()
             except Exception as e:
-                print(f"处理邮箱 {email_address} 失败: {e}")
-                continue
+                flight["error"] = e
+            finally:
+                flight["finished_at"] = time.time()
+                flight["done"].set()
+        
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"]
+    
+    def invalidate(self, user_id: int):
+        """验证码已读状态变化后调用，下次刷新重新读库（进行中的不受影响）"""
+        with self.lock:
+            flight = self.flights.get(user_id)
+            if flight and flight["done"].is_set():
+                del self.flights[user_id]
+
+email_refresh_flights = EmailRefreshCoalescer()
+
+def load_refresh_snapshot(user_id: int) -> dict:
+    """等待该用户进行中的邮箱拉取，再读出最近的验证码，供同一时刻的所有刷新请求共用"""
+    pending = email_poller.wait_for_user(user_id, EMAIL_REFRESH_DEADLINE)
+    with get_db() as conn:
+        # 两次查询放在同一个读事务里：中间插入的验证码要么都看得到，要么 cursor 也不会越过它
+        conn.execute("BEGIN")
+        try:
+            rows = conn.execute(f"""
+                SELECT id, email, service, code, is_read, expires_at FROM user_{user_id}_verification_codes
+                WHERE created_at > datetime('now', ?)
+                ORDER BY id DESC LIMIT ?
+            """, (f"-{EMAIL_NEW_CODE_MINUTES} minutes", EMAIL_REFRESH_SNAPSHOT_LIMIT)).fetchall()
+            last_id = conn.execute(f"SELECT MAX(id) FROM user_{user_id}_verification_codes").fetchone()[0] or 0
+        finally:
+            conn.rollback()
+    return {"rows": [dict(row) for row in rows], "cursor": last_id, "pending": pending}
+
+@app.post("/api/emails/refresh")
+def refresh_emails(data: dict = None, user: dict = Depends(get_current_user)):
+    """
+    获取最新验证码（支持 Gmail、Outlook、QQ、IMAP）
+    邮件由后台轮询服务拉取，这里只读库，并标记用户活跃让轮询切到活跃间隔
+    正在拉取的邮箱最多等 EMAIL_REFRESH_DEADLINE 秒，没赶上的在 pending 中返回，结果留给下次调用
+    同一用户的并发请求合并为一次等待和读库，见 EmailRefreshCoalescer
+    可传 after_id（上次返回的 cursor），只返回之后的新验证码
+    """
+    user_id = user['id']
+    email_poller.touch(user_id)
+    snapshot = email_refresh_flights.run(user_id, lambda: load_refresh_snapshot(user_id))
+    
+    after_id = (data or {}).get("after_id")
+    if after_id is not None:
+        after_id = int(after_id)
+        rows = [row for row in snapshot["rows"] if row["id"] > after_id]
+    else:
+        rows = [row for row in snapshot["rows"] if not row["is_read"]]
+    
+    new_codes = [{
+        "email": row["email"],
+        "service": row["service"],
+        "code": row["code"],
+        "expires_at": sqlite_time_to_iso(row["expires_at"])
+    } for row in rows[:10]]
     
-    return {"success": True, "new_codes": new_codes}
+    return {"success": True, "new_codes": new_codes, "cursor": snapshot["cursor"], "pending": snapshot["pending"]}
 
 @app.post("/api/emails/codes/{code_id}/read")
 def mark_code_read(code_id: int, user: dict = Depends(get_current_user)):
@@ -3213,6 +5847,7 @@ def mark_code_read(code_id: int, user: dict = Depends(get_current_user)):
     with get_db() as conn:
         conn.execute(f"UPDATE user_{user_id}_verification_codes SET is_read = 1 WHERE id = ?", (code_id,))
         conn.commit()
+    email_refresh_flights.invalidate(user_id)
     
     return {"success": True}
 
@@ -3224,10 +5859,433 @@ def mark_all_codes_read(user: dict = Depends(get_current_user)):
     with get_db() as conn:
         conn.execute(f"UPDATE user_{user_id}_verification_codes SET is_read = 1")
         conn.commit()
+    email_refresh_flights.invalidate(user_id)
     
     return {"success": True}
 
 
+# ==================== 后台任务 API ====================
+
+JOBS_DB_PATH = os.path.join(DATA_DIR, "jobs.db")  # 独立于 accounts.db，恢复备份不会覆盖任务记录
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")  # 任务的上传文件和导出结果
+JOB_WORKERS = max(1, int(os.environ.get("JOB_WORKERS", 2)))
+JOB_RETENTION_DAYS = 7  # 已结束任务记录的保留天数
+JOB_OUTPUT_TTL = 3600  # 导出结果含解密后的密码和 2FA 密钥，生成后只保留这么久
+JOB_OUTPUT_SWEEP_INTERVAL = 300
+# 运行中可以取消的任务类型（执行过程中会调用 job_checkpoint）；备份/恢复只能在排队时取消
+JOB_CANCELLABLE_KINDS = {"import", "import_csv", "export", "cleanup_invalid_combos"}
+JOB_PROGRESS_INTERVAL = 1.0  # 进度最多每秒写一次库
+JOB_LIST_LIMIT = 50
+
+job_queue = queue.Queue()
+job_cancel_events = {}  # 排队或运行中的任务: job_id -> threading.Event
+job_workers = []
+job_workers_lock = threading.Lock()
+job_context = threading.local()  # 当前线程正在执行的任务
+
+class JobCancelled(Exception):
+    """任务已被取消，由 job_checkpoint 抛出"""
+
+@contextmanager
+def get_jobs_db():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def init_jobs_db():
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with get_jobs_db() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                params TEXT DEFAULT '{}',
+                progress INTEGER DEFAULT 0,
+                total INTEGER,
+                result TEXT,
+                error TEXT,
+                created_at TEXT,
+                started_at TEXT,
+                finished_at TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id, created_at)")
+        conn.commit()
+
+def update_job(job_id: str, **fields):
+    with get_jobs_db() as conn:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                     (*fields.values(), job_id))
+        conn.commit()
+
+def job_file(job_id: str, suffix: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.{suffix}")
+
+def job_checkpoint(done: int, total: int = None):
+    """长循环中调用：汇报进度，任务已被取消时抛出 JobCancelled；不在后台任务中时什么也不做"""
+    job_id = getattr(job_context, "job_id", None)
+    if not job_id:
+        return
+    if job_cancel_events[job_id].is_set():
+        raise JobCancelled()
+    job_context.progress = done
+    now = time.monotonic()
+    if now - job_context.reported < JOB_PROGRESS_INTERVAL:
+        return
+    job_context.reported = now
+    fields = {"progress": done}
+    if total is not None:
+        fields["total"] = total
+    update_job(job_id, **fields)
+
+def open_upload_text(raw):
+    """
+    二进制文件 -> UTF-8 文本流，gzip 压缩的按魔数识别，边读边解压
+    压缩数据损坏或被截断时在读取处抛出 ValueError，按格式错误处理（接口返回 400，已提交的批次计入错误信息）
+    """
+    import gzip
+    import zlib
+    
+    class UploadGzipFile(gzip.GzipFile):
+        def read(self, size=-1):
+            try:
+                return super().read(size)
+            except (OSError, EOFError, zlib.error) as e:
+                raise ValueError(f"gzip 文件已损坏或不完整 ({e})") from e
+        
+        def read1(self, size=-1):
+            try:
+                return super().read1(size)
+            except (OSError, EOFError, zlib.error) as e:
+                raise ValueError(f"gzip 文件已损坏或不完整 ({e})") from e
+    
+    is_gzip = raw.read(2) == b"\x1f\x8b"
+    raw.seek(0)
+    return io.TextIOWrapper(UploadGzipFile(fileobj=raw) if is_gzip else raw,
+                            encoding="utf-8-sig", errors="replace", newline="")
+
+def run_job_import(job_id: str, user: dict, params: dict, handler, *args) -> dict:
+    """
+    任务输入文件交给 handler(fp, user_id, *args) 处理，摘要算法与 run_upload_import 相同，
+    同一文件无论同步上传还是后台任务提交都走同一套幂等检查
+    """
+    with open(job_file(job_id, "input"), "rb") as raw:
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: raw.read(1024 * 1024), b""):
+            hasher.update(chunk)
+        hasher.update(json.dumps([handler.__name__, args], default=str).encode())
+        raw.seek(0)
+        
+        fp = open_upload_text(raw)
+        try:
+            return run_idempotent_import(user['id'], hasher.hexdigest(), params.get("idempotency_key"),
+                                         bool(params.get("force")), handler, fp, user['id'], *args)
+        finally:
+            fp.detach()
+
+def run_import_job(job_id: str, user: dict, params: dict) -> dict:
+    return run_job_import(job_id, user, params, import_json_stream,
+                          params.get("import_mode"), params.get("format") == "ndjson")
+
+def run_import_csv_job(job_id: str, user: dict, params: dict) -> dict:
+    return run_job_import(job_id, user, params, import_csv_stream,
+                          params.get("import_mode") or "all", params.get("preset"), params.get("mapping"),
+                          params.get("has_header"), params.get("delimiter") or ",")
+
+def open_job_output(path: str):
+    """创建只有当前用户可读写的结果文件"""
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb")
+
+def prune_job_outputs():
+    """删除超过 JOB_OUTPUT_TTL 的导出结果"""
+    cutoff = time.time() - JOB_OUTPUT_TTL
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if name.endswith(".output") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def job_output_sweeper():
+    while True:
+        try:
+            prune_job_outputs()
+        except Exception as e:
+            print(f"清理导出结果失败: {e}")
+        time.sleep(JOB_OUTPUT_SWEEP_INTERVAL)
+
+def run_export_job(job_id: str, user: dict, params: dict) -> dict:
+    export_format = params.get("format", "json")
+    compress = params.get("compress") == "gzip"
+    since = parse_export_since(params["since"]) if params.get("since") else None
+    filename = f"accbox-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}" + (".gz" if compress else "")
+    path = job_file(job_id, "output")
+    
+    try:
+        if export_format == "ndjson":
+            with get_db() as conn:
+                total = conn.execute(f"SELECT COUNT(*) FROM user_{user['id']}_accounts" +
+                                     (" WHERE updated_at >= ?" if since else ""), (since,) if since else ()).fetchone()[0]
+            update_job(job_id, total=total)
+            with open_job_output(path) as out:
+                for chunk in iter_ndjson_export(user, params.get("include_emails", False), compress, since):
+                    out.write(chunk)
+        else:
+            result = export_data(params.get("include_emails", False), "json", params.get("compress"), since, user=user)
+            job_checkpoint(0)  # 整体导出期间被取消的，不再写出结果
+            with open_job_output(path) as out:
+                out.write(result.body if isinstance(result, Response) else json.dumps(result, ensure_ascii=False).encode())
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    
+    return {"filename": filename, "size": os.path.getsize(path), "download": f"/api/jobs/{job_id}/download"}
+
+JOB_RUNNERS = {
+    "import": run_import_job,
+    "import_csv": run_import_csv_job,
+    "export": run_export_job,
+    "backup": lambda job_id, user, params: create_backup(BackupConfig(**params), user=user),
+    "restore": lambda job_id, user, params: restore_backup(
+        params["filename"], RestoreConfig(backup_dir=params.get("backup_dir")), user=user),
+    "cleanup_invalid_combos": lambda job_id, user, params: cleanup_invalid_combos(user=user)
+}
+
+def run_job(job_id: str):
+    with get_jobs_db() as conn:
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    cancel = job_cancel_events.get(job_id)
+    if not job or job["status"] != "queued" or cancel is None:
+        return
+    
+    def now() -> str:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    
+    update_job(job_id, status="running", started_at=now())
+    job_context.job_id = job_id
+    job_context.reported = time.monotonic()
+    job_context.progress = 0
+    try:
+        result = JOB_RUNNERS[job["kind"]](job_id, {"id": job["user_id"], "username": job["username"]},
+                                          json.loads(job["params"] or "{}"))
+        update_job(job_id, status="succeeded", result=json.dumps(result, ensure_ascii=False, default=str),
+                   progress=job_context.progress, finished_at=now())
+    except JobCancelled:
+        update_job(job_id, status="cancelled", progress=job_context.progress, finished_at=now())
+    except HTTPException as e:
+        update_job(job_id, status="failed", error=str(e.detail), finished_at=now())
+    except Exception as e:
+        print(f"❌ 后台任务 {job_id} ({job['kind']}) 失败: {e}")
+        update_job(job_id, status="failed", error=str(e), finished_at=now())
+    finally:
+        job_context.job_id = None
+        job_cancel_events.pop(job_id, None)
+        if os.path.exists(job_file(job_id, "input")):
+            os.remove(job_file(job_id, "input"))
+
+def job_worker():
+    while True:
+        job_id = job_queue.get()
+        try:
+            run_job(job_id)
+        except Exception as e:
+            print(f"❌ 后台任务 {job_id} 执行异常: {e}")
+        finally:
+            job_queue.task_done()
+
+def start_job_workers():
+    """按需启动固定数量的任务线程"""
+    with job_workers_lock:
+        while len(job_workers) < JOB_WORKERS:
+            worker = threading.Thread(target=job_worker, daemon=True)
+            worker.start()
+            job_workers.append(worker)
+
+def enqueue_job(job_id: str):
+    job_cancel_events[job_id] = threading.Event()
+    start_job_workers()
+    job_queue.put(job_id)
+
+def submit_job(job_id: str, user: dict, kind: str, params: dict = None) -> dict:
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    with get_jobs_db() as conn:
+        conn.execute("""
+            INSERT INTO jobs (id, user_id, username, kind, status, params, created_at)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?)
+        """, (job_id, user['id'], user['username'], kind, json.dumps(params or {}, ensure_ascii=False), now))
+        conn.commit()
+    enqueue_job(job_id)
+    return {"message": "任务已提交", "job_id": job_id, "status": "queued"}
+
+def resume_jobs():
+    """启动时：中断的运行中任务标记失败，排队中的任务重新入队，清理过期任务"""
+    init_jobs_db()
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=JOB_RETENTION_DAYS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    with get_jobs_db() as conn:
+        conn.execute("UPDATE jobs SET status = 'failed', error = '服务重启，任务中断', finished_at = ? WHERE status = 'running'",
+                     (now,))
+        expired = [row["id"] for row in conn.execute("SELECT id FROM jobs WHERE finished_at < ?", (cutoff,))]
+        conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+        queued = [row["id"] for row in conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at")]
+        conn.commit()
+    for job_id in expired:
+        for suffix in ("input", "output"):
+            if os.path.exists(job_file(job_id, suffix)):
+                os.remove(job_file(job_id, suffix))
+    for job_id in queued:
+        enqueue_job(job_id)
+    if queued:
+        print(f"🔄 恢复 {len(queued)} 个排队中的后台任务")
+    threading.Thread(target=job_output_sweeper, daemon=True).start()
+
+def job_to_dict(row) -> dict:
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "params": json.loads(row["params"] or "{}"),
+        "progress": row["progress"],
+        "total": row["total"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"]
+    }
+
+def load_job(job_id: str, user: dict):
+    with get_jobs_db() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ? AND user_id = ?", (job_id, user['id'])).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return row
+
+async def submit_upload_job(request: Request, user: dict, kind: str, params: dict) -> dict:
+    """请求体流式写入任务目录，再提交任务"""
+    job_id = secrets.token_hex(8)
+    with open(job_file(job_id, "input"), "wb") as raw:
+        async for chunk in request.stream():
+            raw.write(chunk)
+    return submit_job(job_id, user, kind, params)
+
+@app.post("/api/jobs/import")
+async def submit_import_job(request: Request, import_mode: Optional[str] = None, format: str = "json",
+                            force: bool = False, user: dict = Depends(get_current_user),
+                            idempotency_key: Optional[str] = Header(None)):
+    """后台导入（请求体、force 与 Idempotency-Key 同 /api/import/upload）"""
+    if import_mode not in (None, "all", "skip", "overwrite"):
+        raise HTTPException(status_code=400, detail="无效的导入模式")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="不支持的导入格式")
+    return await submit_upload_job(request, user, "import", {
+        "import_mode": import_mode, "format": format, "force": force, "idempotency_key": idempotency_key
+    })
+
+@app.post("/api/jobs/import-csv")
+async def submit_import_csv_job(request: Request, import_mode: str = "all", preset: Optional[str] = None,
+                                mapping: Optional[str] = None, has_header: Optional[bool] = None,
+                                delimiter: str = ",", force: bool = False, user: dict = Depends(get_current_user),
+                                idempotency_key: Optional[str] = Header(None)):
+    """后台 CSV 导入（参数同 /api/import-csv/upload）"""
+    try:
+        column_mapping = json.loads(mapping) if mapping else None
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="mapping 不是有效的 JSON")
+    return await submit_upload_job(request, user, "import_csv", {
+        "import_mode": import_mode, "preset": preset, "mapping": column_mapping,
+        "has_header": has_header, "delimiter": delimiter, "force": force, "idempotency_key": idempotency_key
+    })
+
+@app.post("/api/jobs/export")
+def submit_export_job(include_emails: bool = False, format: str = "json", compress: Optional[str] = None,
+                      since: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """后台导出（参数同 /api/export），完成后从 /api/jobs/{id}/download 下载"""
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="不支持的导出格式")
+    if compress not in (None, "", "gzip"):
+        raise HTTPException(status_code=400, detail="不支持的压缩方式")
+    if since:
+        parse_export_since(since)
+    return submit_job(secrets.token_hex(8), user, "export", {
+        "include_emails": include_emails, "format": format, "compress": compress, "since": since
+    })
+
+@app.post("/api/jobs/backup")
+def submit_backup_job(config: BackupConfig = BackupConfig(), user: dict = Depends(get_current_user)):
+    return submit_job(secrets.token_hex(8), user, "backup", config.model_dump())
+
+@app.post("/api/jobs/restore/{filename}")
+def submit_restore_job(filename: str, config: RestoreConfig = RestoreConfig(), user: dict = Depends(get_current_user)):
+    return submit_job(secrets.token_hex(8), user, "restore", {"filename": filename, "backup_dir": config.backup_dir})
+
+@app.post("/api/jobs/cleanup-invalid-combos")
+def submit_cleanup_job(user: dict = Depends(get_current_user)):
+    return submit_job(secrets.token_hex(8), user, "cleanup_invalid_combos")
+
+@app.get("/api/jobs")
+def list_jobs(user: dict = Depends(get_current_user)):
+    with get_jobs_db() as conn:
+        rows = conn.execute("SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                            (user['id'], JOB_LIST_LIMIT)).fetchall()
+    return {"jobs": [job_to_dict(row) for row in rows]}
+
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: str, user: dict = Depends(get_current_user)):
+    return job_to_dict(load_job(job_id, user))
+
+@app.post("/api/jobs/{job_id}/cancel")
+def cancel_job(job_id: str, user: dict = Depends(get_current_user)):
+    """
+    取消任务：排队中的任务直接取消；运行中的任务在下一个检查点停止
+    （导入已提交的批次会保留，运行中的备份/恢复不可中断）
+    """
+    job = load_job(job_id, user)
+    if job["status"] not in ("queued", "running"):
+        raise HTTPException(status_code=400, detail="任务已结束")
+    if job["status"] == "running" and job["kind"] not in JOB_CANCELLABLE_KINDS:
+        raise HTTPException(status_code=400, detail="该任务运行中不可取消")
+    event = job_cancel_events.get(job_id)
+    if event:
+        event.set()
+    if job["status"] == "queued":
+        update_job(job_id, status="cancelled", finished_at=datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return {"message": "任务已取消", "status": "cancelled"}
+    return {"message": "正在取消", "status": "cancelling"}
+
+@app.get("/api/jobs/{job_id}/download")
+def download_job_result(job_id: str, user: dict = Depends(get_current_user)):
+    job = load_job(job_id, user)
+    path = job_file(job_id, "output")
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=404, detail="没有可下载的结果")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="导出结果已过期删除，请重新导出")
+    filename = json.loads(job["result"]).get("filename", f"{job_id}.out")
+    media_type = "application/gzip" if filename.endswith(".gz") else "application/json"
+    return FileResponse(path, media_type=media_type, filename=filename)
+
+@app.on_event("startup")
+def start_background_services():
+    """服务启动时才恢复后台任务、启动后台线程；仅 import main（脚本、基准测试）不建 jobs.db、不开线程"""
+    resume_jobs()
+    oauth_tokens.start()
+    email_poller.start()
+
+@app.on_event("shutdown")
+def stop_background_services():
+    email_poller.stop()
+    oauth_tokens.stop()
+
 STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
 
 @app.get("/")
@@ -3283,4 +6341,8 @@ if __name__ == "__main__":
     migrate_add_combos_column()
     migrate_add_2fa_columns()
     migrate_add_hidden_column()
+    migrate_add_change_tracking()
+    migrate_add_import_tracking()
+    migrate_add_mailbox_state()
+    migrate_add_code_constraints()
     uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")